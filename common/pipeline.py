@@ -0,0 +1,255 @@
+# coding: utf-8
+"""
+按内容hash跳过的数据处理阶段DAG
+- 每个阶段声明输入文件、参数和输出文件；阶段的key为 (阶段代码, 参数, 各输入文件内容hash) 的hash，
+  上次运行记录的key相同且输出文件仍为当时写入的内容时跳过
+- 依赖由路径推出（输入为另一个阶段的输出或在其输出目录中）；上游重跑但输出内容不变时，下游仍然跳过
+- 文件内容hash按 (大小, 修改时间) 缓存在状态文件中，没有改变的大文件不重新读取
+- 依赖都已完成的阶段并发运行（workers>1时用fork的进程池，子进程中profiler记录的阶段合并回主进程）
+- 只改模型参数（baseline.py的FLAGS）不影响任何阶段的key，不会重新生成特征和样本
+
+  python comm.py status                            # 各阶段是否需要重跑及原因（pytorch: python prepare_data.py status）
+  python comm.py run --workers=4 --force statis_feature
+"""
+import collections
+import concurrent.futures
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import time
+
+
+def _hash(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _contains(directory, path):
+    return path == directory or path.startswith(directory + os.sep)
+
+
+class Stage(object):
+    '''
+    DAG中的一个阶段：fun(**kwargs) 读取inputs、写入outputs
+    '''
+
+    def __init__(self, name, fun, inputs=(), outputs=(), params=None, kwargs=None, code=None):
+        '''
+        :param name: String. 阶段名
+        :param fun: 阶段函数
+        :param inputs: List of file or directory paths read by the stage
+        :param outputs: List of file or directory paths written by the stage
+        :param params: Dict. 阶段读取的模块常量（如ACTION_SAMPLE_RATE、SEED），改变后重跑
+        :param kwargs: Dict. fun的参数（同样计入key）
+        :param code: List of functions or modules whose source is part of the key (default [fun])
+        '''
+        self.name = name
+        self.fun = fun
+        self.inputs = [os.path.normpath(path) for path in inputs]
+        self.outputs = [os.path.normpath(path) for path in outputs]
+        self.params = params or {}
+        self.kwargs = kwargs or {}
+        self.code = code or [fun]
+
+    def code_hash(self):
+        sources = []
+        for fun in self.code:
+            fun = inspect.unwrap(fun)
+            try:
+                sources.append(inspect.getsource(fun))
+            except (OSError, TypeError):
+                sources.append(fun.__module__ + "." + fun.__qualname__)
+        return _hash(sources)
+
+
+# fork的子进程通过该变量找到阶段（不需要pickle阶段函数和profiler）
+_RUNNING = None
+
+
+def _call(name):
+    pipeline = _RUNNING
+    profiler = pipeline.profiler
+    start = len(profiler.stages) if profiler is not None else 0
+    stage = pipeline.stages[name]
+    stage.fun(**stage.kwargs)
+    return profiler.stages[start:] if profiler is not None else []
+
+
+class Pipeline(object):
+
+    def __init__(self, stages, state_path, workers=1, profiler=None):
+        '''
+        :param stages: List of Stage
+        :param state_path: String. 状态文件（各阶段上次运行的key和输出hash、文件hash缓存）
+        :param workers: Int. 并发运行的阶段数
+        :param profiler: profiler.StageProfiler or None. 合并子进程中记录的阶段
+        '''
+        self.stages = collections.OrderedDict((stage.name, stage) for stage in stages)
+        self.state_path = state_path
+        self.workers = workers
+        self.profiler = profiler
+        self.deps = {}
+        for stage in stages:
+            self.deps[stage.name] = [other.name for other in stages if other is not stage and any(
+                _contains(output, path) or _contains(path, output)
+                for output in other.outputs for path in stage.inputs)]
+        self._state = {"files": {}, "stages": {}}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self._state = json.load(f)
+
+    def digest(self, path):
+        '''
+        文件内容的sha1（目录为其中所有文件），不存在为None
+        '''
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+            return _hash([[os.path.relpath(file, path), self.digest(file)] for file in files])
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        cached = self._state["files"].get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        self._state["files"][path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def _parts(self, stage):
+        return {"code": stage.code_hash(), "params": _hash(stage.params, stage.kwargs),
+                "inputs": {path: self.digest(path) for path in stage.inputs}}
+
+    def check(self, name):
+        '''
+        :return: (Boolean, String). 是否可以跳过，需要重跑的原因
+        '''
+        stage = self.stages[name]
+        record = self._state["stages"].get(name)
+        if record is None:
+            return False, "never run"
+        parts = self._parts(stage)
+        if parts["code"] != record["code"]:
+            return False, "code changed"
+        if parts["params"] != record["params"]:
+            return False, "params changed"
+        for path, digest in parts["inputs"].items():
+            if record["inputs"].get(path) != digest:
+                return False, "input changed: %s" % path
+        for path, digest in record["outputs"].items():
+            if self.digest(path) != digest:
+                return False, "output changed or missing: %s" % path
+        return True, "up to date"
+
+    def _needed(self, targets):
+        needed = set()
+        pending = list(targets if targets is not None else self.stages)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise KeyError("unknown stage %s, stages: %s" % (name, ", ".join(self.stages)))
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.deps[name])
+        return [name for name in self.stages if name in needed]
+
+    def status(self, targets=None):
+        '''
+        打印各阶段是否需要重跑（上游需要重跑的阶段显示为stale upstream）
+        '''
+        stale = set()
+        for name in self._needed(targets):
+            upstream = [dep for dep in self.deps[name] if dep in stale]
+            valid, reason = (False, "stale upstream: %s" % ", ".join(upstream)) if upstream else self.check(name)
+            if not valid:
+                stale.add(name)
+            print("%-32s%s" % (name, reason))
+        self._save()
+        return stale
+
+    def run(self, targets=None, force=()):
+        '''
+        运行targets（None为所有阶段）及其上游阶段中需要重跑的阶段
+        :param force: List of stage names to rerun regardless of the hash
+        :return: List of stage names that ran
+        '''
+        global _RUNNING
+        needed = self._needed(targets)
+        produced = [output for name in needed for output in self.stages[name].outputs]
+        missing = sorted({path for name in needed for path in self.stages[name].inputs
+                          if not os.path.exists(path) and not any(_contains(output, path) for output in produced)})
+        if missing:
+            raise IOError("missing input files: %s" % ", ".join(missing))
+        executor = None
+        if self.workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            _RUNNING = self
+            executor = concurrent.futures.ProcessPoolExecutor(self.workers,
+                                                              mp_context=multiprocessing.get_context("fork"))
+        done, ran, running, started = set(), [], {}, {}
+        try:
+            while True:
+                ready = [name for name in needed if name not in done and name not in running.values()
+                         and all(dep in done for dep in self.deps[name])]
+                progressed = False
+                for name in ready:
+                    valid, reason = (False, "forced") if name in force else self.check(name)
+                    if valid:
+                        print("[pipeline] %s: up to date, skipped" % name)
+                        done.add(name)
+                        progressed = True
+                        continue
+                    print("[pipeline] %s: running (%s)" % (name, reason))
+                    started[name] = (self._parts(self.stages[name]), time.time())
+                    if executor is None:
+                        self.stages[name].fun(**self.stages[name].kwargs)
+                        self._finish(name, started[name], ran, done)
+                        progressed = True
+                    else:
+                        running[executor.submit(_call, name)] = name
+                if progressed:
+                    # 完成的阶段可能使下游阶段就绪
+                    continue
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    records = future.result()
+                    if self.profiler is not None:
+                        self.profiler.stages.extend(records)
+                    self._finish(name, started[name], ran, done)
+        finally:
+            if executor is not None:
+                # 出错时取消尚未开始的阶段（shutdown的cancel_futures参数需要Python>=3.9）
+                for future in running:
+                    future.cancel()
+                executor.shutdown(wait=True)
+                _RUNNING = None
+            self._save()
+        return ran
+
+    def _finish(self, name, started, ran, done):
+        parts, start = started
+        stage = self.stages[name]
+        outputs = {path: self.digest(path) for path in stage.outputs}
+        missing = [path for path, digest in outputs.items() if digest is None]
+        if missing:
+            raise IOError("stage %s did not write %s" % (name, ", ".join(missing)))
+        seconds = time.time() - start
+        self._state["stages"][name] = dict(parts, outputs=outputs, seconds=round(seconds, 3),
+                                           finished=time.strftime("%Y-%m-%d %H:%M:%S"))
+        self._save()
+        done.add(name)
+        ran.append(name)
+        print("[pipeline] %s: done in %.1fs" % (name, seconds))
+
+    def _save(self):
+        # 先写临时文件再替换，中断时不会留下损坏的状态文件
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._state, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.state_path)
@@ -0,0 +1,226 @@
+# coding: utf-8
+"""
+按 (userid, feedid, 版本) 缓存模型预测结果
+- 版本：模型和特征的标识（checkpoint/导出目录、样本文件、特征快照等）的hash，重新训练或特征更新后版本改变，旧结果自动失效
+- 内存层：LRU，最多capacity行（预测值存放在一个float32矩阵中），可选TTL（秒）
+- 磁盘层（可选）：每个版本一个目录（按key排序的keys.npy和values.npy，mmap读取），flush()时合并写入，
+  进程重启后（如evaluate/submit重新运行）仍可命中；只保留最近keep_versions个版本
+- stats() 返回命中率等统计
+"""
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+
+def version_hash(*parts):
+    '''
+    :param parts: 可json序列化的对象（路径、文件签名、参数等）
+    :return: String. 16位hex
+    '''
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def file_signature(*paths):
+    '''
+    文件（目录则为其中所有文件）的 (路径, 大小, 修改时间)，内容改变后签名改变
+    '''
+    signature = []
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        for file in files:
+            if os.path.exists(file):
+                stat = os.stat(file)
+                signature.append([file, stat.st_size, stat.st_mtime_ns])
+            else:
+                signature.append([file, None, None])
+    return signature
+
+
+def _keys(user_ids, feed_ids):
+    return (np.asarray(user_ids, dtype=np.int64) << 32) | (np.asarray(feed_ids, dtype=np.int64) & 0xFFFFFFFF)
+
+
+class PredictionCache(object):
+    '''
+    线程安全；get/put按行向量化调用，每行的预测值为长度width的向量（如每个行为一列），同一个cache的width固定
+    '''
+
+    def __init__(self, capacity=1 << 20, ttl=None, disk_path=None, keep_versions=8):
+        '''
+        :param capacity: Int. 内存层最多缓存的行数
+        :param ttl: Float or None. 内存层条目的有效时间（秒），None为不过期
+        :param disk_path: String or None. 磁盘层目录，None为只用内存
+        :param keep_versions: Int. 磁盘层保留的版本数（按写入时间）
+        '''
+        self.capacity = capacity
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.keep_versions = keep_versions
+        self._lru = collections.OrderedDict()
+        self._values = None
+        self._times = np.zeros(capacity, dtype=np.float64)
+        self._free = list(range(capacity - 1, -1, -1))
+        self._disk = {}
+        self._pending = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def _allocate(self, width):
+        if self._values is None:
+            self._values = np.zeros((self.capacity, width), dtype=np.float32)
+        elif self._values.shape[1] != width:
+            raise ValueError("cached predictions have width %d, got %d" % (self._values.shape[1], width))
+
+    def _disk_tier(self, version):
+        '''
+        :return: (sorted int64 keys, float32 values) or None
+        '''
+        if self.disk_path is None:
+            return None
+        if version not in self._disk:
+            path = os.path.join(self.disk_path, version)
+            self._disk[version] = (np.load(os.path.join(path, "keys.npy"), mmap_mode="r"),
+                                   np.load(os.path.join(path, "values.npy"), mmap_mode="r")) \
+                if os.path.exists(os.path.join(path, "values.npy")) else None
+        return self._disk[version]
+
+    def get(self, version, user_ids, feed_ids):
+        '''
+        :return: (hit mask bool [N], values float32 [N, width]，未命中的行为0；没有任何缓存时width为0)
+        '''
+        keys = _keys(user_ids, feed_ids)
+        hit = np.zeros(len(keys), dtype=bool)
+        with self._lock:
+            disk = self._disk_tier(version)
+            width = self._values.shape[1] if self._values is not None else disk[1].shape[1] if disk else 0
+            values = np.zeros((len(keys), width), dtype=np.float32)
+            if self._values is not None:
+                now = time.time()
+                slots = np.full(len(keys), -1, dtype=np.int64)
+                for i, key in enumerate(keys.tolist()):
+                    slot = self._lru.get((version, key))
+                    if slot is None:
+                        continue
+                    if self.ttl is not None and now - self._times[slot] > self.ttl:
+                        del self._lru[(version, key)]
+                        self._free.append(slot)
+                        self._stats["expired"] += 1
+                        continue
+                    self._lru.move_to_end((version, key))
+                    slots[i] = slot
+                hit = slots >= 0
+                values[hit] = self._values[slots[hit]]
+            self._stats["memory_hits"] += int(hit.sum())
+            if disk is not None and len(disk[0]) > 0 and not hit.all():
+                disk_keys, disk_values = disk
+                miss = np.flatnonzero(~hit)
+                index = np.minimum(np.searchsorted(disk_keys, keys[miss]), len(disk_keys) - 1)
+                found = disk_keys[index] == keys[miss]
+                if found.any():
+                    rows = miss[found]
+                    values[rows] = disk_values[index[found]]
+                    hit[rows] = True
+                    self._stats["disk_hits"] += len(rows)
+                    # 磁盘命中的行放入内存层
+                    self._insert(version, keys[rows], values[rows])
+            self._stats["lookups"] += len(keys)
+            self._stats["misses"] += int(len(keys) - hit.sum())
+        return hit, values
+
+    def put(self, version, user_ids, feed_ids, values):
+        '''
+        :param values: float array [N, width] or [N]
+        同一批中出现多次的 (userid, feedid) 其余特征可能不同（如device），不缓存
+        '''
+        values = np.asarray(values, dtype=np.float32)
+        if values.ndim == 1:
+            values = values.reshape(-1, 1)
+        keys = _keys(user_ids, feed_ids)
+        unique, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        if len(unique) < len(keys):
+            once = counts[inverse] == 1
+            keys, values = keys[once], values[once]
+        with self._lock:
+            self._insert(version, keys, values)
+            if self.disk_path is not None:
+                self._pending[version].append((keys, values))
+
+    def _insert(self, version, keys, values):
+        self._allocate(values.shape[1])
+        slots = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys.tolist()):
+            slot = self._lru.get((version, key))
+            if slot is None:
+                if self._free:
+                    slot = self._free.pop()
+                else:
+                    # 淘汰最久未使用的行
+                    _, slot = self._lru.popitem(last=False)
+                    self._stats["evictions"] += 1
+                self._lru[(version, key)] = slot
+            else:
+                self._lru.move_to_end((version, key))
+            slots[i] = slot
+        # 超过capacity时前面的行被同一批后面的行淘汰，slot重复时以后写入的为准
+        self._values[slots] = values
+        self._times[slots] = time.time()
+
+    def flush(self):
+        '''
+        把put的新结果合并写入磁盘层（先写临时目录再改名）
+        '''
+        if self.disk_path is None:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, collections.defaultdict(list)
+            if not pending:
+                return
+            for version, parts in pending.items():
+                disk = self._disk_tier(version)
+                if disk is not None:
+                    parts = [(np.asarray(disk[0]), np.asarray(disk[1]))] + parts
+                keys = np.concatenate([k for k, _ in parts])
+                values = np.concatenate([v for _, v in parts])
+                # put的行全部是同批重复的key时没有可写的结果
+                if len(keys) == 0:
+                    continue
+                # 相同key保留最后写入的值
+                order = np.argsort(keys, kind="stable")
+                keys, values = keys[order], values[order]
+                last = np.append(keys[1:] != keys[:-1], True)
+                path = os.path.join(self.disk_path, version)
+                tmp = path + ".tmp"
+                shutil.rmtree(tmp, ignore_errors=True)
+                os.makedirs(tmp)
+                np.save(os.path.join(tmp, "keys.npy"), keys[last])
+                np.save(os.path.join(tmp, "values.npy"), values[last])
+                self._disk.pop(version, None)
+                shutil.rmtree(path, ignore_errors=True)
+                os.rename(tmp, path)
+            # 清理旧版本
+            if not os.path.isdir(self.disk_path):
+                return
+            versions = sorted((name for name in os.listdir(self.disk_path) if not name.endswith(".tmp")),
+                              key=lambda name: os.path.getmtime(os.path.join(self.disk_path, name)))
+            for name in versions[:-self.keep_versions]:
+                self._disk.pop(name, None)
+                shutil.rmtree(os.path.join(self.disk_path, name), ignore_errors=True)
+
+    def stats(self):
+        '''
+        :return: Dict. lookups, memory_hits, disk_hits, misses, hit_rate, evictions, expired, size（内存层行数）
+        '''
+        with self._lock:
+            result = {name: self._stats[name] for name in
+                      ["lookups", "memory_hits", "disk_hits", "misses", "evictions", "expired"]}
+            result["hit_rate"] = (result["memory_hits"] + result["disk_hits"]) / float(max(result["lookups"], 1))
+            result["size"] = len(self._lru)
+        return result
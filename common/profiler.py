@@ -0,0 +1,309 @@
+# coding: utf-8
+"""
+数据处理和训练各阶段的耗时和内存统计
+- 每个阶段记录：墙钟时间、CPU时间（本进程及已结束子进程）、阶段内峰值RSS、阶段结束时RSS
+  峰值RSS：Linux下阶段开始时写 /proc/self/clear_refs 重置VmHWM，结束时读取（嵌套阶段的峰值计入外层阶段）；
+  其他系统为进程累计峰值（scope为process）
+- 可选tracemalloc（环境变量PROFILE_TRACEMALLOC=1，或StageProfiler(trace_malloc=True)）：
+  记录阶段内Python/NumPy分配的峰值（DataFrame的列数组由NumPy分配，会被计入），以及阶段结束时仍占用的新增分配
+  中最大的几处（按代码行汇总，用于查找阶段间残留的大对象）；每个阶段开始和结束各取一次快照，耗时明显增加
+  Python<3.9没有tracemalloc.reset_peak，分配峰值为开始跟踪以来的累计峰值（tracemalloc_peak_scope为process）
+- 进程退出时把报告写入 {report_dir}/{run_name}_{时间}.json，用 compare 对比两次运行
+
+  python ../common/profiler.py show data/profile/comm_20211001120000.json          # 在tensorflow/下运行
+  python ../common/profiler.py compare data/profile/comm_old.json data/profile/comm_new.json --threshold 0.1
+"""
+import argparse
+import atexit
+import contextlib
+import functools
+import inspect
+import json
+import os
+import platform
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+_STATUS = "/proc/self/status"
+_CLEAR_REFS = "/proc/self/clear_refs"
+
+
+def _status_kb(field):
+    try:
+        with open(_STATUS) as f:
+            return int(re.search(r"%s:\s+(\d+)" % field, f.read()).group(1))
+    except (IOError, OSError, AttributeError):
+        return None
+
+
+def _reset_peak():
+    '''
+    重置VmHWM
+    :return: Boolean. 是否成功（否则峰值为进程累计峰值）
+    '''
+    try:
+        with open(_CLEAR_REFS, "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss_mb():
+    peak = _status_kb("VmHWM")
+    if peak is None:
+        # ru_maxrss: Linux为KB，macOS为字节
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 if sys.platform == "darwin" else 1.0)
+    return peak / 1024.0
+
+
+def _rss_mb():
+    rss = _status_kb("VmRSS")
+    return None if rss is None else rss / 1024.0
+
+
+def _mem_total_mb():
+    try:
+        with open("/proc/meminfo") as f:
+            return int(re.search(r"MemTotal:\s+(\d+)", f.read()).group(1)) // 1024
+    except (IOError, OSError, AttributeError):
+        return None
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system, times.children_user + times.children_system
+
+
+class _Frame(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.peak_rss_mb = 0.0
+        self.start_wall = time.time()
+        self.start_cpu, self.start_children_cpu = _cpu_seconds()
+        self.start_rss_mb = _rss_mb()
+        self.tracemalloc_peak = 0
+        self.snapshot = None
+
+
+class StageProfiler(object):
+    '''
+    with PROFILER.stage("concat_sample"): ...    或    @PROFILER.profiled(key="stage")
+    同一进程中并发运行的阶段共用进程的RSS，峰值不能按阶段区分
+    '''
+
+    def __init__(self, report_dir, run_name=None, trace_malloc=None, top_allocations=5):
+        '''
+        :param report_dir: String. 报告目录
+        :param run_name: String or None. 报告文件名前缀，None为脚本名加第一个参数（如comm、baseline_submit）
+        :param trace_malloc: Boolean or None (环境变量PROFILE_TRACEMALLOC)
+        :param top_allocations: Int. tracemalloc时每个阶段记录的最大分配处数
+        '''
+        self.report_dir = report_dir
+        if run_name is None:
+            run_name = os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0]
+            if len(sys.argv) > 1 and not sys.argv[1].startswith("-"):
+                run_name += "_" + os.path.basename(sys.argv[1])
+        self.run_name = run_name
+        self.trace_malloc = os.environ.get("PROFILE_TRACEMALLOC", "0") == "1" if trace_malloc is None \
+            else trace_malloc
+        self.top_allocations = top_allocations
+        self.stages = []
+        self.start_time = time.time()
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._peak_scope = "stage" if _reset_peak() else "process"
+        self._saved = False
+        atexit.register(self.save)
+
+    @property
+    def _stack(self):
+        # 每个线程各自的阶段嵌套
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        with self._lock:
+            if self._stack:
+                self._stack[-1].peak_rss_mb = max(self._stack[-1].peak_rss_mb, _peak_rss_mb())
+            _reset_peak()
+            if self.trace_malloc:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                if self._stack:
+                    self._stack[-1].tracemalloc_peak = max(self._stack[-1].tracemalloc_peak,
+                                                           tracemalloc.get_traced_memory()[1])
+                # tracemalloc.reset_peak需要Python>=3.9，低版本的峰值为开始跟踪以来的累计峰值（scope为process）
+                if hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak()
+            frame = _Frame(name)
+            if self.trace_malloc:
+                frame.snapshot = self._snapshot()
+            self._stack.append(frame)
+        error = None
+        try:
+            yield frame
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            with self._lock:
+                self._finish(frame, error)
+
+    def _finish(self, frame, error):
+        cpu, children_cpu = _cpu_seconds()
+        peak = max(frame.peak_rss_mb, _peak_rss_mb())
+        record = {"stage": frame.name, "depth": len(self._stack) - 1,
+                  "start": round(frame.start_wall - self.start_time, 3),
+                  "wall_seconds": round(time.time() - frame.start_wall, 3),
+                  "cpu_seconds": round(cpu - frame.start_cpu, 3),
+                  "children_cpu_seconds": round(children_cpu - frame.start_children_cpu, 3),
+                  "peak_rss_mb": round(peak, 1), "peak_rss_scope": self._peak_scope,
+                  "start_rss_mb": frame.start_rss_mb and round(frame.start_rss_mb, 1),
+                  "end_rss_mb": _rss_mb() and round(_rss_mb(), 1)}
+        if error is not None:
+            record["error"] = error
+        if self.trace_malloc and tracemalloc.is_tracing():
+            traced_peak = max(frame.tracemalloc_peak, tracemalloc.get_traced_memory()[1])
+            record["tracemalloc_peak_mb"] = round(traced_peak / 2.0 ** 20, 1)
+            record["tracemalloc_peak_scope"] = "stage" if hasattr(tracemalloc, "reset_peak") else "process"
+            # 阶段结束时仍占用的新增分配（相对阶段开始），按代码行汇总
+            statistics = self._snapshot().compare_to(frame.snapshot, "lineno")
+            record["top_allocations"] = [{"line": "%s:%d" % (s.traceback[0].filename, s.traceback[0].lineno),
+                                          "size_mb": round(s.size_diff / 2.0 ** 20, 2), "count": s.count_diff}
+                                         for s in statistics[:self.top_allocations] if s.size_diff > 0]
+            frame.tracemalloc_peak = traced_peak
+        self._stack.pop()
+        if self._stack:
+            self._stack[-1].peak_rss_mb = max(self._stack[-1].peak_rss_mb, peak)
+            self._stack[-1].tracemalloc_peak = max(self._stack[-1].tracemalloc_peak, frame.tracemalloc_peak)
+        self.stages.append(record)
+        print("[profile] %s: %.2fs wall, %.2fs cpu, peak RSS %.0f MB" % (
+            frame.name, record["wall_seconds"], record["cpu_seconds"], record["peak_rss_mb"]))
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                          tracemalloc.Filter(False, "<frozen importlib.*>")])
+
+    def profiled(self, name=None, key=None):
+        '''
+        函数装饰器
+        :param name: String or None (function name)
+        :param key: String or None. 参数名，其值加在阶段名后，如 generate_sample[submit]
+        '''
+        def decorator(fun):
+            signature = inspect.signature(fun)
+
+            @functools.wraps(fun)
+            def wrapper(*args, **kwargs):
+                stage = name or fun.__name__
+                if key is not None:
+                    bound = signature.bind(*args, **kwargs)
+                    bound.apply_defaults()
+                    stage = "%s[%s]" % (stage, bound.arguments[key])
+                with self.stage(stage):
+                    return fun(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self):
+        return {"run_name": self.run_name, "argv": sys.argv,
+                "start_time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start_time)),
+                "wall_seconds": round(time.time() - self.start_time, 3),
+                "host": {"node": platform.node(), "python": platform.python_version(), "cpu_count": os.cpu_count(),
+                         "memory_mb": _mem_total_mb()},
+                "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+                "trace_malloc": self.trace_malloc, "stages": list(self.stages)}
+
+    def save(self):
+        '''
+        写入报告（进程退出时自动调用，没有阶段记录时不写）
+        :return: String or None. 报告路径
+        '''
+        if self._saved or not self.stages:
+            return None
+        self._saved = True
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, "%s_%s.json" % (
+            self.run_name, time.strftime("%Y%m%d%H%M%S", time.localtime(self.start_time))))
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=1)
+        print("[profile] report: %s" % path)
+        return path
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def show(path):
+    report = _load(path)
+    print("%s  %s  (%s, %s CPUs, %s MB)" % (report["run_name"], report["start_time"], report["host"]["node"],
+                                           report["host"]["cpu_count"], report["host"]["memory_mb"]))
+    print("%-40s%10s%10s%12s%12s" % ("stage", "wall s", "cpu s", "peak MB", "traced MB"))
+    for stage in sorted(report["stages"], key=lambda stage: (stage["start"], stage["depth"])):
+        print("%-40s%10.2f%10.2f%12.0f%12s" % ("  " * stage["depth"] + stage["stage"], stage["wall_seconds"],
+                                               stage["cpu_seconds"], stage["peak_rss_mb"],
+                                               stage.get("tracemalloc_peak_mb", "-")))
+        for allocation in stage.get("top_allocations", []):
+            print("%-40s%34.1f  %s" % ("", allocation["size_mb"], allocation["line"]))
+    print("process peak RSS %.0f MB, %.1fs" % (report["peak_rss_mb"], report["wall_seconds"]))
+
+
+# 对比时小于该绝对变化的不算退化（秒 / MB）
+_MIN_CHANGE = {"wall_seconds": 1.0, "cpu_seconds": 1.0, "peak_rss_mb": 50.0}
+
+
+def compare(old_path, new_path, threshold=0.1):
+    '''
+    按阶段名对比两次运行的耗时和峰值RSS，墙钟时间或峰值RSS增长超过threshold（比例）且超过_MIN_CHANGE的标记为REGRESSION
+    :return: List of regressed (stage, metric)
+    '''
+    old_report, new_report = _load(old_path), _load(new_path)
+    old = {stage["stage"]: stage for stage in old_report["stages"]}
+    new = new_report["stages"]
+    regressions = []
+    if old_report["trace_malloc"] != new_report["trace_malloc"]:
+        print("WARNING: tracemalloc %s -> %s, timings are not comparable" % (old_report["trace_malloc"],
+                                                                          new_report["trace_malloc"]))
+    print("%-40s%22s%22s%22s" % ("stage", "wall s", "cpu s", "peak MB"))
+    for stage in new:
+        before = old.get(stage["stage"])
+        cells = []
+        for metric in ["wall_seconds", "cpu_seconds", "peak_rss_mb"]:
+            if before is None:
+                cells.append("%22s" % ("%.1f (new)" % stage[metric]))
+                continue
+            change = (stage[metric] - before[metric]) / before[metric] if before[metric] else 0.0
+            flag = ""
+            if change > threshold and stage[metric] - before[metric] > _MIN_CHANGE[metric] \
+                    and metric != "cpu_seconds":
+                flag = "!"
+                regressions.append((stage["stage"], metric))
+            cells.append("%22s" % ("%.1f -> %.1f %+.0f%%%s" % (before[metric], stage[metric], change * 100, flag)))
+        print("%-40s%s" % (stage["stage"], "".join(cells)))
+    for name, metric in regressions:
+        print("REGRESSION: %s %s (> %+.0f%%)" % (name, metric, threshold * 100))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["show", "compare"])
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--threshold", type=float, default=0.1, help="compare: relative increase flagged")
+    args = parser.parse_args()
+    if args.command == "show":
+        for report_path in args.paths:
+            show(report_path)
+    else:
+        sys.exit(1 if compare(args.paths[0], args.paths[1], args.threshold) else 0)
@@ -0,0 +1,56 @@
+# coding: utf-8
+"""
+训练时按epoch重新抽取负样本（替代预先下采样并写入磁盘的各行为样本文件）
+- 样本只存一份：(userid, feedid) 去重后的全部曝光及所有行为标签（TF: comm.py的交互样本库；PyTorch: 编码后的train_data）
+- 每个epoch、每个行为：正样本全部保留，负样本按保留率rate独立抽样（seed + epoch，分布式训练各进程抽样相同）
+- 重要性权重：被抽中的负样本权重为1/rate，加权loss的期望与全量样本的loss相同；多个行为（多任务）时
+  每个行为各自抽样，样本为被任一行为选中的行，未选中该行为的位置权重为0（该任务的loss和指标不计入）
+- 改变采样比例只需改rate，不需要重新生成数据
+"""
+import numpy as np
+
+
+class NegativeSampler(object):
+
+    def __init__(self, labels, rates, seed=2021, rows=None, importance_weight=True):
+        '''
+        :param labels: Array [N] or [N, T]. 0/1标签（T个行为）
+        :param rates: Float or list of T floats. 各行为负样本的保留率（1为不采样）
+        :param seed: Int. 第e个epoch的随机种子为seed + e
+        :param rows: int array or None. 候选样本的行号（如训练日期窗口内的样本），None为全部
+        :param importance_weight: Boolean. 负样本权重为1/rate，否则为1
+        '''
+        labels = np.asarray(labels)
+        self.labels = labels.reshape(len(labels), -1) > 0.5
+        self.rates = np.broadcast_to(np.asarray(rates, dtype=np.float64), (self.labels.shape[1],)).copy()
+        self.seed = seed
+        self.rows = np.arange(len(labels), dtype=np.int64) if rows is None else np.asarray(rows, dtype=np.int64)
+        self.importance_weight = importance_weight
+        self._positive = self.labels[self.rows]
+
+    def __len__(self):
+        '''
+        每个epoch的期望样本数（多个行为时为各行为中最大的，实际行数不少于该值）
+        '''
+        positives = self._positive.sum(axis=0)
+        return int(np.max(positives + (len(self.rows) - positives) * self.rates))
+
+    def epoch(self, epoch):
+        '''
+        :return: (int64 rows [M]（升序）, float32 weights [M, T])
+        '''
+        rng = np.random.RandomState((self.seed + epoch) % 2 ** 32)
+        chosen = self._positive | (rng.random_sample(self._positive.shape) < self.rates)
+        keep = chosen.any(axis=1)
+        chosen, positive = chosen[keep], self._positive[keep]
+        negative_weight = 1.0 / self.rates if self.importance_weight else np.ones_like(self.rates)
+        weights = np.where(positive, 1.0, negative_weight) * chosen
+        return self.rows[keep], weights.astype(np.float32)
+
+
+def window_rows(dates, end_day, num_days):
+    '''
+    日期在 [end_day - num_days + 1, end_day] 内的行号
+    '''
+    dates = np.asarray(dates)
+    return np.flatnonzero((dates <= end_day) & (dates > end_day - num_days)).astype(np.int64)
@@ -3,6 +3,24 @@ from torch import nn, einsum
 import torch.nn.functional as F
 
 
+def aft_full_attention(Q, K, V, wbias):
+    '''
+    Q, K, V: (B, T, hidden_dim)
+    wbias: (T, T) pairwise position biases
+
+    Yt = sigmoid(Q_t) * sum_t' exp(w_tt' + K_t') V_t' / sum_t' exp(w_tt' + K_t')
+
+    exp(w) and exp(K) are computed once each, after subtracting the row max of w and the max of K over time.
+    The shifts cancel between numerator and denominator, so the result (and its gradient) is unchanged,
+    but exp can no longer overflow; the shifts are detached so autograd does not route gradients through max.
+    '''
+    exp_w = torch.exp(wbias - wbias.detach().amax(dim=-1, keepdim=True)).unsqueeze(0)
+    exp_k = torch.exp(K - K.detach().amax(dim=1, keepdim=True))
+    numerator = exp_w @ (exp_k * V)
+    denominator = exp_w @ exp_k
+    return torch.sigmoid(Q) * numerator / denominator.clamp_min(1e-30)
+
+
 class AFTFull(nn.Module):
     def __init__(self, max_seqlen, dim, hidden_dim=64, device='cpu'):
         super().__init__()
@@ -27,17 +45,9 @@ class AFTFull(nn.Module):
         Q = self.to_q(x).view(B, T, self.hidden_dim)
         K = self.to_k(x).view(B, T, self.hidden_dim)
         V = self.to_v(x).view(B, T, self.hidden_dim)
-        temp_wbias = self.wbias[:T, :T].unsqueeze(0)  # sequences can still be variable length
-
-        '''
-        From the paper
-        '''
-        Q_sig = torch.sigmoid(Q)
-        temp = torch.exp(temp_wbias) @ torch.mul(torch.exp(K), V)
-        weighted = temp / (torch.exp(temp_wbias) @ torch.exp(K))
-        Yt = torch.mul(Q_sig, weighted)
+        temp_wbias = self.wbias[:T, :T]  # sequences can still be variable length
 
-        Yt = Yt.view(B, T, self.hidden_dim)
+        Yt = aft_full_attention(Q, K, V, temp_wbias)
         Yt = self.project(Yt)
 
         return Yt
@@ -102,37 +112,110 @@ class AFTLocal(nn.Module):
         nn.init.xavier_uniform_(self.wbias)
         self.device = device
 
+        '''
+        w_tt' is learned only inside the window |t - t'| < s and is 0 outside of it.
+        local_mask: (max_seqlen, max_seqlen) band mask for the dense path.
+        band_position: (max_seqlen, 2 * window - 1) positions t' = t + offset for the banded path.
+        '''
+        position = torch.arange(max_seqlen, device=device)
+        self.register_buffer('local_mask', ((position[:, None] - position[None, :]).abs() < s).float(),
+                             persistent=False)
+        window = min(s, max_seqlen)
+        offset = torch.arange(-(window - 1), window, device=device)
+        self.register_buffer('band_position', position[:, None] + offset[None, :], persistent=False)
+
     def forward(self, x):
         B, T, _ = x.shape
         Q = self.to_q(x).view(B, T, self.hidden_dim)
         K = self.to_k(x).view(B, T, self.hidden_dim)
         V = self.to_v(x).view(B, T, self.hidden_dim)
-        self.wbias = nn.Parameter(torch.Tensor([
-            [self.wbias[i][j] if math.fabs(i - j) < self.s else 0 for j in range(self.max_seqlen)]
-            for i in range(self.max_seqlen)
-        ]).to(self.device))
-        temp_wbias = self.wbias[:T, :T].unsqueeze(0)  # sequences can still be variable length
 
-        '''
-        From the paper
-        '''
-        Q_sig = torch.sigmoid(Q)
-        temp = torch.exp(temp_wbias) @ torch.mul(torch.exp(K), V)
-        weighted = temp / (torch.exp(temp_wbias) @ torch.exp(K))
-        Yt = torch.mul(Q_sig, weighted)
+        if 2 * self.s - 1 < T:
+            Yt = self.banded_attention(Q, K, V)
+        else:
+            # the window covers (almost) the whole sequence, masked dense AFT-full is cheapest
+            temp_wbias = self.wbias[:T, :T] * self.local_mask[:T, :T]  # sequences can still be variable length
+            Yt = aft_full_attention(Q, K, V, temp_wbias)
 
-        Yt = Yt.view(B, T, self.hidden_dim)
         Yt = self.project(Yt)
 
         return Yt
 
+    def banded_attention(self, Q, K, V):
+        '''
+        O(T * s) AFT-local. Outside the window exp(w_tt') = 1, so
+
+        sum_t' exp(w_tt') exp(K_t') V_t' = sum_t' exp(K_t') V_t' + sum_{|t-t'|<s} (exp(w_tt') - 1) exp(K_t') V_t'
+
+        i.e. one global sum plus a windowed sum over 2s-1 neighbours (same for the denominator).
+        '''
+        B, T, _ = Q.shape
+        window = (self.band_position.shape[1] + 1) // 2
+        position = self.band_position[:T]
+        valid = (position >= 0) & (position < T)
+        band_wbias = self.wbias[:T, :T].gather(1, position.clamp(0, T - 1))
+        coef = (torch.exp(band_wbias) - 1) * valid  # (T, 2 * window - 1)
+
+        exp_k = torch.exp(K - K.detach().amax(dim=1, keepdim=True))
+        weighted = torch.cat([exp_k * V, exp_k], dim=-1)  # (B, T, 2 * hidden_dim)
+        # one shifted multiply-add per offset, no (B, T, hidden_dim, 2s - 1) intermediate
+        padded = F.pad(weighted, (0, 0, window - 1, window - 1))
+        local = weighted.sum(dim=1, keepdim=True)
+        for j in range(2 * window - 1):
+            local = local + padded[:, j:j + T] * coef[:, j:j + 1]
+        numerator, denominator = local.chunk(2, dim=-1)
+        return torch.sigmoid(Q) * numerator / denominator.clamp_min(1e-30)
+
 
 class AFTConv(nn.Module):
-    def __init__(self):
+    def __init__(self, max_seqlen, dim, hidden_dim=64, device='cpu', heads=4, s=3):
         super().__init__()
+        '''
+        max_seqlen: the maximum number of timesteps (sequence length) to be fed in
+        dim: the embedding dimension of the tokens
+        hidden_dim: the hidden dimension used inside AFT Conv
+        heads: number of heads, the hidden_dim / heads channels of a head share one kernel
+        s: the (odd) kernel size, i.e. the local window of AFT-Conv in the paper
+
+        Position biases are a per-head 1d kernel shared across positions, so the layer is
+        linear in the sequence length; max_seqlen is kept for the common AFT constructor signature.
+        '''
+        assert hidden_dim % heads == 0, "hidden_dim must be divisible by heads"
+        assert s % 2 == 1, "kernel size s must be odd"
+        self.dim = dim
+        self.hidden_dim = hidden_dim
+        self.heads = heads
+        self.s = s
+        self.to_q = nn.Linear(dim, hidden_dim).to(device)
+        self.to_k = nn.Linear(dim, hidden_dim).to(device)
+        self.to_v = nn.Linear(dim, hidden_dim).to(device)
+        self.project = nn.Linear(hidden_dim, dim).to(device)
+        self.wbias = nn.Parameter(torch.Tensor(heads, s).to(device))
+        nn.init.xavier_uniform_(self.wbias)
 
     def forward(self, x):
-        raise NotImplementedError
+        B, T, _ = x.shape
+        Q = self.to_q(x).view(B, T, self.hidden_dim)
+        K = self.to_k(x).view(B, T, self.hidden_dim)
+        V = self.to_v(x).view(B, T, self.hidden_dim)
+
+        '''
+        From the paper: global sum plus a depthwise convolution with kernel exp(w) - 1,
+        numerator [exp(K) * V] and denominator [exp(K)] share one grouped conv1d call.
+        '''
+        exp_k = torch.exp(K - K.detach().amax(dim=1, keepdim=True))
+        weighted = torch.cat([exp_k * V, exp_k], dim=-1)  # (B, T, 2 * hidden_dim)
+        total = weighted.sum(dim=1, keepdim=True)
+        kernel = (torch.exp(self.wbias) - 1).repeat_interleave(self.hidden_dim // self.heads, dim=0)
+        kernel = kernel.repeat(2, 1).unsqueeze(1)  # (2 * hidden_dim, 1, s)
+        local = F.conv1d(weighted.transpose(1, 2), kernel, padding=self.s // 2,
+                         groups=2 * self.hidden_dim).transpose(1, 2)
+        numerator, denominator = (total + local).chunk(2, dim=-1)
+        Yt = torch.sigmoid(Q) * numerator / denominator.clamp_min(1e-30)
+
+        Yt = self.project(Yt)
+
+        return Yt
 
 
 '''
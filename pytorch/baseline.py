@@ -1,21 +1,48 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import os
+import sys
 import numpy as np
 import pandas as pd
 import torch
-from sklearn.preprocessing import LabelEncoder, MinMaxScaler
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 from transformers.optimization import (
     AdamW, get_linear_schedule_with_warmup, get_constant_schedule)
 from tqdm import tqdm
+from deepctr_torch.callbacks import ModelCheckpoint
 from deepctr_torch.inputs import SparseFeat, DenseFeat, get_feature_names
 from deepctr_torch.models.deepfm import *
 from deepctr_torch.models.xdeepfm import *
 from deepctr_torch.models.basemodel import *
 from aft_pytorch import *
+# tensorflow/ 和 pytorch/ 共用的模块（pipeline、profiler、prediction_cache、sampler）在 ../common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from batch_loader import ArrayBatchLoader, ModelInputs
+from evaluation import uAUC
+from export import export_model
+from prediction_cache import PredictionCache, file_signature, version_hash
+from quantize import quantize_model
+from sampler import NegativeSampler
+from sparse_optim import SPARSE_OPTIMIZERS, CombinedOptimizer
+from prepare_data import ENCODED_PATH, SPARSE_FEATURES, DENSE_FEATURES, build_pipeline, load_encoded, \
+    load_vocabulary_sizes, load_feed_embedding, PROFILER
 
 # 存储数据的根目录
 ROOT_PATH = "../data"
 # 比赛数据集路径
 DATASET_PATH = ROOT_PATH + '/wechat_algo_data1/'
+# TorchScript推理模型
+MODEL_PATH = ROOT_PATH + '/model'
+# 预测/导出前做训练后int8量化（CPU推理，uAUC影响见quantize.py）
+QUANTIZE_INFERENCE = False
+# 测试集预测按 (模型参数hash, 编码数据) 缓存在该目录，重新运行时相同模型只预测新的 (userid, feedid)；None为不缓存
+PREDICTION_CACHE_PATH = MODEL_PATH + '/prediction_cache'
+# DNN输入加入降维后的feed多模态向量（prepare_data.compress_feed_embeddings）
+USE_FEED_EMBEDDING = True
+# Embedding表的稀疏优化器：None（全部参数dense AdamW）/ 'lazy_adamw' / 'rowwise_adagrad'
+SPARSE_OPTIMIZER = None
 # 训练集
 USER_ACTION = DATASET_PATH + "user_action.csv"
 FEED_INFO = DATASET_PATH + "feed_info.csv"
@@ -24,21 +51,86 @@ FEED_EMBEDDINGS = DATASET_PATH + "feed_embeddings.csv"
 TEST_FILE = DATASET_PATH + "test_a.csv"
 # 初赛待预测行为列表
 ACTION_LIST = ["read_comment", "like", "click_avatar", "forward"]
+# 比赛各行为uAUC的加权权重（多任务模型的汇总指标）
+ACTION_WEIGHT = {"read_comment": 4, "like": 3, "click_avatar": 2, "forward": 1}
 FEA_COLUMN_LIST = ["read_comment", "like", "click_avatar", "forward", "comment", "follow", "favorite"]
 FEA_FEED_LIST = ['feedid', 'authorid', 'videoplayseconds', 'bgm_song_id', 'bgm_singer_id']
-# 负样本下采样比例(负样本:正样本)
+# 负样本下采样比例(负样本:正样本)：每个epoch保留1/rate的负样本，权重为rate
 ACTION_SAMPLE_RATE = {"read_comment": 5, "like": 5, "click_avatar": 5, "forward": 10, "comment": 10, "follow": 10,
                       "favorite": 10}
 
 class MyBaseModel(BaseModel):
+    # uAUC按该离散特征分组
+    user_feature = 'userid'
+    # 多任务模型的输出列（每个行为一列），None为单任务
+    task_names = None
+
+    def __init__(self, linear_feature_columns, dnn_feature_columns, *args, feed_embedding=None, **kwargs):
+        """
+        :param feed_embedding: Array [feedid vocabulary size, k] or None. Frozen feed vectors (prepare_data
+            compress_feed_embeddings), looked up by feedid and appended to the dense inputs of the DNN.
+        Other parameters are the same as `BaseModel`.
+        """
+        super(MyBaseModel, self).__init__(linear_feature_columns, dnn_feature_columns, *args, **kwargs)
+        # 固定的feed向量表，float16存放，不参与训练
+        self.feed_embedding_dim = 0 if feed_embedding is None else feed_embedding.shape[1]
+        self.register_buffer('feed_embedding', None if feed_embedding is None else
+                             torch.as_tensor(np.asarray(feed_embedding), dtype=torch.float16, device=self.device))
+        # 离散特征按列存放在一个整型矩阵中，连续特征按列存放在一个float32矩阵中
+        feature_columns = {feat.name: feat for feat in linear_feature_columns + dnn_feature_columns}
+        self.sparse_feature_names = [name for name in self.feature_index
+                                     if isinstance(feature_columns[name], SparseFeat)]
+        self.dense_feature_names = [name for name in self.feature_index
+                                    if isinstance(feature_columns[name], DenseFeat)]
+        self.sparse_index = {name: i for i, name in enumerate(self.sparse_feature_names)}
+        self.dense_index = {}
+        start = 0
+        for name in self.dense_feature_names:
+            self.dense_index[name] = (start, start + feature_columns[name].dimension)
+            start += feature_columns[name].dimension
+        self.sparse_dtype = np.int32 if all(
+            feature_columns[name].vocabulary_size < 2 ** 31 for name in self.sparse_feature_names) else np.int64
 
     def fit(self, x=None, y=None, batch_size=None, epochs=1, verbose=1, initial_epoch=0, validation_split=0.,
-            validation_data=None, shuffle=True, callbacks=None):
+            validation_data=None, shuffle=True, callbacks=None, metric_steps=1, validation_time=None,
+            validation_periods=1, early_stopping_patience=None, monitor='val_uauc', sample_weight=None,
+            negative_rate=None, importance_weight=True):
+        """
 
-        if isinstance(x, dict):
-            x = [x[feature] for feature in self.feature_index]
+        :param sample_weight: Array [N] or [N, number of outputs] or None. Per-sample (per-task) weight of the loss,
+            e.g. the task masks of a multi-task model; samples with weight 0 are also left out of the metrics.
+        :param negative_rate: Float, list of floats (one per output) or None. Every epoch keeps all positives and
+            this fraction of the negatives of the training set, drawn again per epoch (see ../common/sampler.py);
+            the validation set is not sampled. None trains on all samples.
+        :param importance_weight: Boolean. With `negative_rate`, weight the drawn negatives by 1 / negative_rate
+            (multiplied with `sample_weight`) so the loss estimates the loss on all samples.
+
+        :param validation_time: Array aligned with `x` giving the time of every sample (e.g. the `date_` column).
+            If set, the samples of the last `validation_periods` distinct times are the validation set
+            (instead of the random tail rows of `validation_split`).
+        :param validation_periods: Integer. Number of latest distinct `validation_time` values held out.
+        :param early_stopping_patience: Integer or None. Stop when `monitor` has not improved for this many epochs.
+            With validation, the weights of the best epoch (by `monitor`) are kept in memory and restored
+            at the end of training.
+        :param monitor: String. Epoch log used for early stopping and best weights, e.g. "val_uauc", "val_auc",
+            "val_binary_crossentropy" (higher is better for names ending with "auc", lower otherwise).
+        :param metric_steps: Integer. Keep the predictions of every `metric_steps`-th batch on device and compute the
+            training metrics once at the end of each epoch (1 = every batch, i.e. exact epoch metrics).
+        Other parameters are the same as `BaseModel.fit`.
+
+        If a `torch.distributed` process group is initialized (see distributed.py), the model is wrapped in
+        `DistributedDataParallel`: every process trains on its own shard of `x` with `batch_size` samples per step,
+        gradients are all-reduced, the epoch loss is averaged over all processes (training metrics are computed on
+        the local shard) and `ModelCheckpoint` callbacks only run on rank 0.
+        """
+
+        x = self._typed_inputs(x)
+        y = self._typed_target(y)
+        if sample_weight is not None:
+            sample_weight = self._typed_target(sample_weight)
 
         do_validation = False
+        val_sample_weight = None
         if validation_data:
             do_validation = True
             if len(validation_data) == 2:
@@ -54,30 +146,30 @@ class MyBaseModel(BaseModel):
                     'or alternatively it could be a dataset or a '
                     'dataset or a dataset iterator. '
                     'However we received `validation_data=%s`' % validation_data)
-            if isinstance(val_x, dict):
-                val_x = [val_x[feature] for feature in self.feature_index]
+            val_x = self._typed_inputs(val_x)
+
+        elif validation_time is not None:
+            do_validation = True
+            validation_time = np.asarray(validation_time).reshape(-1)
+            val_mask = np.isin(validation_time, np.unique(validation_time)[-validation_periods:])
+            x, val_x = (ModelInputs(x.sparse[~val_mask], x.dense[~val_mask]),
+                        ModelInputs(x.sparse[val_mask], x.dense[val_mask]))
+            y, val_y = y[~val_mask], y[val_mask]
+            if sample_weight is not None:
+                sample_weight, val_sample_weight = sample_weight[~val_mask], sample_weight[val_mask]
 
         elif validation_split and 0. < validation_split < 1.:
             do_validation = True
-            if hasattr(x[0], 'shape'):
-                split_at = int(x[0].shape[0] * (1. - validation_split))
-            else:
-                split_at = int(len(x[0]) * (1. - validation_split))
-            x, val_x = (slice_arrays(x, 0, split_at),
-                        slice_arrays(x, split_at))
-            y, val_y = (slice_arrays(y, 0, split_at),
-                        slice_arrays(y, split_at))
+            split_at = int(len(y) * (1. - validation_split))
+            x, val_x = (ModelInputs(x.sparse[:split_at], x.dense[:split_at]),
+                        ModelInputs(x.sparse[split_at:], x.dense[split_at:]))
+            y, val_y = y[:split_at], y[split_at:]
+            if sample_weight is not None:
+                sample_weight, val_sample_weight = sample_weight[:split_at], sample_weight[split_at:]
         else:
             val_x = []
             val_y = []
-        for i in range(len(x)):
-            if len(x[i].shape) == 1:
-                x[i] = np.expand_dims(x[i], axis=1)
-
-        train_tensor_data = Data.TensorDataset(
-            torch.from_numpy(
-                np.concatenate(x, axis=-1)),
-            torch.from_numpy(y))
+
         if batch_size is None:
             batch_size = 256
 
@@ -85,21 +177,35 @@ class MyBaseModel(BaseModel):
         loss_func = self.loss_func
         optim = self.optim
 
-        if self.gpus:
+        distributed = dist.is_available() and dist.is_initialized()
+        rank, world_size = (dist.get_rank(), dist.get_world_size()) if distributed else (0, 1)
+        if distributed:
+            print('distributed data parallel, rank {0} of {1}'.format(rank, world_size))
+            model = DistributedDataParallel(model, device_ids=None if self.device == 'cpu' else [self.device])
+        elif self.gpus:
             print('parallel running on these gpus:', self.gpus)
             model = torch.nn.DataParallel(model, device_ids=self.gpus)
             batch_size *= len(self.gpus)  # input `batch_size` is batch_size per gpu
         else:
             print(self.device)
 
-        train_loader = DataLoader(
-            dataset=train_tensor_data, shuffle=shuffle, batch_size=batch_size)
+        sampler = None
+        if negative_rate is not None:
+            sampler = NegativeSampler(y, negative_rate, importance_weight=importance_weight)
+        train_arrays = [x.sparse, x.dense, y] + ([sample_weight] if sample_weight is not None else [])
+        train_loader = ArrayBatchLoader(train_arrays, batch_size=batch_size, shuffle=shuffle,
+                                        pin_memory=self.device != 'cpu', prefetch=2,
+                                        num_shards=world_size, shard_id=rank, sampler=sampler)
 
-        sample_num = len(train_tensor_data)
-        steps_per_epoch = (sample_num - 1) // batch_size + 1
+        sample_num = train_loader.num_samples
+        steps_per_epoch = len(train_loader)
 
         # configure callbacks
-        callbacks = (callbacks or []) + [self.history]  # add history callback
+        callbacks = callbacks or []
+        if rank != 0:
+            # 只由rank 0保存checkpoint
+            callbacks = [callback for callback in callbacks if not isinstance(callback, ModelCheckpoint)]
+        callbacks = callbacks + [self.history]  # add history callback
         callbacks = CallbackList(callbacks)
         callbacks.on_train_begin()
         callbacks.set_model(self)
@@ -107,58 +213,75 @@ class MyBaseModel(BaseModel):
             callbacks.__setattr__('model', self)
         callbacks.model.stop_training = False
 
+        keep_best = do_validation and early_stopping_patience is not None
+        higher_is_better = monitor.endswith('auc')
+        best, best_epoch, best_state, wait = None, None, None, 0
+        user_column = self.sparse_index.get(self.user_feature) if 'uauc' in self.metrics else None
+
         # Train
         print("Train on {0} samples, validate on {1} samples, {2} steps per epoch".format(
-            len(train_tensor_data), len(val_y), steps_per_epoch))
+            sample_num, len(val_y), steps_per_epoch))
         for epoch in range(initial_epoch, epochs):
             callbacks.on_epoch_begin(epoch)
+            train_loader.set_epoch(epoch)
+            # 负采样时每个epoch的样本数不同
+            sample_num = train_loader.num_samples
             epoch_logs = {}
             start_time = time.time()
-            loss_epoch = 0
-            total_loss_epoch = 0
-            train_result = {}
+            # 在设备上累加，epoch结束时同步一次
+            total_loss_epoch = torch.zeros((), device=self.device)
+            y_epoch, y_pred_epoch, user_epoch, weight_epoch = [], [], [], []
             try:
                 with tqdm(enumerate(train_loader), disable=verbose != 1) as t:
-                    for _, (x_train, y_train) in t:
-                        x = x_train.to(self.device).float()
-                        y = y_train.to(self.device).float()
-
-                        y_pred = model(x).squeeze()
+                    for step, batch in t:
+                        sparse_ids = batch[0].to(self.device, non_blocking=True).long()
+                        dense_values = batch[1].to(self.device, non_blocking=True)
+                        y = batch[2].to(self.device, non_blocking=True)
+                        # sample_weight与负采样的重要性权重相乘
+                        weight = None
+                        for tensor in batch[3:]:
+                            tensor = tensor.to(self.device, non_blocking=True)
+                            weight = tensor if weight is None else weight * tensor
+
+                        y_pred = model(sparse_ids, dense_values).squeeze()
 
                         optim.zero_grad()
-                        loss = loss_func(y_pred, y.squeeze(), reduction='sum')
+                        loss = loss_func(y_pred, y.squeeze(), weight=None if weight is None else weight.squeeze(),
+                                         reduction='sum')
                         reg_loss = self.get_regularization_loss()
 
                         total_loss = loss + reg_loss + self.aux_loss
 
-                        loss_epoch += loss.item()
-                        total_loss_epoch += total_loss.item()
+                        total_loss_epoch += total_loss.detach().sum()
                         total_loss.backward()
                         optim.step()
 
-                        if verbose > 0:
-                            for name, metric_fun in self.metrics.items():
-                                if name not in train_result:
-                                    train_result[name] = []
-                                try:
-                                    temp = metric_fun(
-                                        y.cpu().data.numpy(), y_pred.cpu().data.numpy().astype("float64"))
-                                except Exception:
-                                    temp = 0
-                                finally:
-                                    train_result[name].append(temp)
+                        if verbose > 0 and self.metrics and step % metric_steps == 0:
+                            y_epoch.append(y.detach().reshape(y.shape[0], -1))
+                            y_pred_epoch.append(y_pred.detach().reshape(y.shape[0], -1))
+                            if user_column is not None:
+                                user_epoch.append(sparse_ids[:, user_column])
+                            if weight is not None:
+                                weight_epoch.append(weight.detach().reshape(y.shape[0], -1))
             except KeyboardInterrupt:
                 t.close()
                 raise
             t.close()
 
             # Add epoch_logs
-            epoch_logs["loss"] = total_loss_epoch / sample_num
-            for name, result in train_result.items():
-                epoch_logs[name] = np.sum(result) / steps_per_epoch
+            if distributed:
+                dist.all_reduce(total_loss_epoch)
+                epoch_logs["loss"] = total_loss_epoch.item() / (train_loader.shard_size * world_size)
+            else:
+                epoch_logs["loss"] = total_loss_epoch.item() / sample_num
+            if y_epoch:
+                epoch_logs.update(self._compute_metrics(
+                    torch.cat(y_epoch).cpu().numpy(), torch.cat(y_pred_epoch).cpu().numpy().astype("float64"),
+                    torch.cat(user_epoch).cpu().numpy() if user_epoch else None,
+                    torch.cat(weight_epoch).cpu().numpy() if weight_epoch else None))
 
             if do_validation:
-                eval_result = self.evaluate(val_x, val_y, batch_size)
+                eval_result = self.evaluate(val_x, val_y, batch_size, val_sample_weight)
                 for name, result in eval_result.items():
                     epoch_logs["val_" + name] = result
             # verbose
@@ -178,73 +301,292 @@ class MyBaseModel(BaseModel):
                         eval_str += " - " + "val_" + name + \
                                     ": {0: .4f}".format(epoch_logs["val_" + name])
                 print(eval_str)
+
+            if keep_best and monitor in epoch_logs:
+                current = epoch_logs[monitor]
+                if best is None or (current > best if higher_is_better else current < best):
+                    # 最优权重保存在内存中（与模型同设备）
+                    best, best_epoch, wait = current, epoch, 0
+                    best_state = {name: value.detach().clone() for name, value in self.state_dict().items()}
+                else:
+                    wait += 1
+                    if wait >= early_stopping_patience:
+                        self.stop_training = True
             callbacks.on_epoch_end(epoch, epoch_logs)
             if self.stop_training:
                 break
 
+        if best_state is not None:
+            self.load_state_dict(best_state)
+            if verbose > 0:
+                print('Restored the weights of epoch {0} ({1}: {2: .4f})'.format(best_epoch + 1, monitor, best))
         callbacks.on_train_end()
 
         return self.history
 
-    def evaluate(self, x, y, batch_size=256):
+    def evaluate(self, x, y, batch_size=256, sample_weight=None):
         """
 
         :param x: Numpy array of test data (if the model has a single input), or list of Numpy arrays (if the model has multiple inputs).
         :param y: Numpy array of target (label) data (if the model has a single output), or list of Numpy arrays (if the model has multiple outputs).
         :param batch_size: Integer or `None`. Number of samples per evaluation step. If unspecified, `batch_size` will default to 256.
+        :param sample_weight: Array or None. Samples (tasks) with weight 0 are left out of the metrics.
         :return: Dict contains metric names and metric values.
         """
+        x = self._typed_inputs(x)
         pred_ans = self.predict(x, batch_size)
-        eval_result = {}
+        user_column = self.sparse_index.get(self.user_feature)
+        return self._compute_metrics(y, pred_ans, x.sparse[:, user_column] if user_column is not None else None,
+                                     sample_weight)
+
+    def _get_metrics(self, metrics, set_eps=False):
+        metrics_ = super(MyBaseModel, self)._get_metrics(metrics, set_eps)
+        if metrics and 'uauc' in metrics:
+            # 比赛评估指标：按用户分组的AUC的平均
+            metrics_['uauc'] = uAUC
+        return metrics_
+
+    def _compute_metrics(self, y, pred_ans, user_ids=None, sample_weight=None):
+        """
+        Compute every compiled metric once over the whole set of labels and predictions.
+        AUC is exact over all samples instead of an average of per-batch AUCs, "uauc" needs `user_ids`.
+        Samples with `sample_weight` 0 are left out.
+        """
+        y = np.asarray(y).reshape(-1)
+        pred_ans = np.asarray(pred_ans).reshape(-1)
+        if sample_weight is not None:
+            keep = np.asarray(sample_weight).reshape(-1) > 0
+            y, pred_ans = y[keep], pred_ans[keep]
+            user_ids = None if user_ids is None else np.asarray(user_ids)[keep]
+        result = {}
         for name, metric_fun in self.metrics.items():
             try:
-                temp = metric_fun(y, pred_ans)
+                if name == 'uauc':
+                    result[name] = metric_fun(y, pred_ans, user_ids)
+                else:
+                    result[name] = metric_fun(y, pred_ans)
             except Exception:
-                temp = 0
-            finally:
-                eval_result[name] = metric_fun(y, pred_ans)
-        return eval_result
+                result[name] = 0
+        return result
 
-    def predict(self, x, batch_size=256):
+    def predict(self, x, batch_size=256, cache=None, data_version=None):
         """
 
         :param x: The input data, as a Numpy array (or list of Numpy arrays if the model has multiple inputs).
         :param batch_size: Integer. If unspecified, it will default to 256.
+        :param cache: prediction_cache.PredictionCache or None. Only the (userid, feedid) rows not predicted before
+            by a model with the same weights (`weights_hash`) on the same `data_version` are predicted.
+        :param data_version: Json-serializable identity of the input data, part of the cache version
+            (e.g. `file_signature` of the encoded data).
         :return: Numpy array(s) of predictions.
         """
+        x = self._typed_inputs(x)
+        if cache is None:
+            return self._predict(x, batch_size)
+        version = version_hash(self.weights_hash(), data_version)
+        user_ids = x.sparse[:, self.sparse_index[self.user_feature]]
+        feed_ids = x.sparse[:, self.sparse_index['feedid']]
+        hit, cached = cache.get(version, user_ids, feed_ids)
+        if hit.all():
+            return cached.astype("float64")
+        miss = ~hit
+        pred_miss = self._predict(ModelInputs(x.sparse[miss], x.dense[miss]), batch_size)
+        cache.put(version, user_ids[miss], feed_ids[miss], pred_miss)
+        pred_ans = np.zeros((len(hit), pred_miss.shape[1]), dtype="float64")
+        if hit.any():
+            pred_ans[hit] = cached[hit]
+        pred_ans[miss] = pred_miss
+        return pred_ans
+
+    def weights_hash(self):
+        """
+        Hash of all parameters and buffers (the model part of the prediction cache version).
+        """
+        digest = hashlib.sha1()
+        for name, value in self.state_dict().items():
+            digest.update(name.encode('utf-8'))
+            values = value if isinstance(value, (tuple, list)) else [value]
+            for v in values:
+                if isinstance(v, torch.Tensor):
+                    v = v.dequantize() if v.is_quantized else v
+                    digest.update(v.detach().cpu().contiguous().numpy().tobytes())
+                else:
+                    digest.update(repr(v).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _predict(self, x, batch_size):
         model = self.eval()
-        if isinstance(x, dict):
-            x = [x[feature] for feature in self.feature_index]
-        for i in range(len(x)):
-            if len(x[i].shape) == 1:
-                x[i] = np.expand_dims(x[i], axis=1)
-
-        tensor_data = Data.TensorDataset(
-            torch.from_numpy(np.concatenate(x, axis=-1)))
-        test_loader = DataLoader(
-            dataset=tensor_data, shuffle=False, batch_size=batch_size)
+        test_loader = ArrayBatchLoader([x.sparse, x.dense], batch_size=batch_size, shuffle=False,
+                                       pin_memory=self.device != 'cpu', prefetch=2)
 
         pred_ans = []
         with torch.no_grad():
-            for _, x_test in enumerate(test_loader):
-                x = x_test[0].to(self.device).float()
+            for sparse_test, dense_test in test_loader:
+                sparse_ids = sparse_test.to(self.device, non_blocking=True).long()
+                dense_values = dense_test.to(self.device, non_blocking=True)
 
-                y_pred = model(x).cpu().data.numpy()  # .squeeze()
+                y_pred = model(sparse_ids, dense_values).cpu().data.numpy()  # .squeeze()
                 pred_ans.append(y_pred)
 
         return np.concatenate(pred_ans).astype("float64")
 
+    def candidate_inputs(self, user, candidates):
+        """
+        Typed inputs of the candidates of one user: every column of `user` is written once for all rows
+        instead of being repeated per row by the caller.
+
+        :param user: Dict. feature name -> one (encoded) value, e.g. {'userid': 12}.
+        :param candidates: Dict. feature name -> array [N], the other columns of `feature_index`.
+        :return: ModelInputs with N rows.
+        """
+        num_samples = len(next(iter(candidates.values())))
+        sparse = np.empty((num_samples, len(self.sparse_feature_names)), dtype=self.sparse_dtype)
+        for name, i in self.sparse_index.items():
+            sparse[:, i] = user[name] if name in user else np.asarray(candidates[name]).reshape(num_samples)
+        dense = np.empty((num_samples, sum(end - start for start, end in self.dense_index.values())),
+                         dtype=np.float32)
+        for name, (start, end) in self.dense_index.items():
+            values = user[name] if name in user else candidates[name]
+            dense[:, start:end] = np.asarray(values, dtype=np.float32).reshape(-1, end - start)
+        return ModelInputs(sparse, dense)
+
+    def _typed_inputs(self, x):
+        """
+        Convert model input (dict of columns, or list of columns in `feature_index` order) into a
+        `ModelInputs` of an int32/int64 id matrix and a float32 dense matrix.
+        """
+        if isinstance(x, ModelInputs):
+            return x
+        if isinstance(x, dict):
+            x = [x[feature] for feature in self.feature_index]
+        columns = dict(zip(self.feature_index, x))
+        num_samples = len(x[0])
+        sparse = np.empty((num_samples, len(self.sparse_feature_names)), dtype=self.sparse_dtype)
+        for name, i in self.sparse_index.items():
+            sparse[:, i] = np.asarray(columns[name]).reshape(num_samples)
+        dense = np.empty((num_samples, sum(end - start for start, end in self.dense_index.values())),
+                         dtype=np.float32)
+        for name, (start, end) in self.dense_index.items():
+            dense[:, start:end] = np.asarray(columns[name]).reshape(num_samples, end - start)
+        return ModelInputs(sparse, dense)
+
+    @staticmethod
+    def _typed_target(y):
+        y = np.array(y, dtype=np.float32)
+        if y.ndim == 1:
+            y = y.reshape(-1, 1)
+        return y
+
+    def enable_sparse_embeddings(self):
+        """
+        Switch every embedding table (dnn and linear part) to sparse gradients, for a row-wise sparse optimizer.
+
+        The L2 regularization of the tables is removed from `regularization_weight`: a penalty on the whole
+        table has a dense gradient. It is returned as the weight decay of the tables (2 * l2, the gradient of
+        l2 * w ** 2) for the sparse optimizer, which only decays the rows of the batch.
+        :return: List of param groups {'params': [embedding weights], 'weight_decay': 2 * l2}.
+        """
+        # 包括QREmbedding/MixedDimEmbedding内部的表，投影层仍为dense参数
+        tables = [module for embedding_dict in (self.embedding_dict, self.linear_model.embedding_dict)
+                  for module in embedding_dict.modules() if isinstance(module, nn.Embedding)]
+        for table in tables:
+            table.sparse = True
+        sparse_ids = set(id(table.weight) for table in tables)
+        weight_decay = {}
+        regularization_weight = []
+        # regularization_weight中的元素为参数或 (name, 参数)
+        for weight_list, l1, l2 in self.regularization_weight:
+            dense_weights = []
+            for w in weight_list:
+                parameter = w[1] if isinstance(w, tuple) else w
+                if id(parameter) in sparse_ids:
+                    weight_decay[id(parameter)] = weight_decay.get(id(parameter), 0.0) + 2 * l2
+                else:
+                    dense_weights.append(w)
+            regularization_weight.append((dense_weights, l1, l2))
+        self.regularization_weight = regularization_weight
+
+        param_groups = {}
+        for table in tables:
+            decay = weight_decay.get(id(table.weight), 0.0)
+            param_groups.setdefault(decay, []).append(table.weight)
+        return [{'params': params, 'weight_decay': decay} for decay, params in param_groups.items()]
+
+    def replace_embedding(self, embedding_dict, name, module):
+        """
+        Replace the table `name` of `embedding_dict` (`self.embedding_dict` or `self.linear_model.embedding_dict`)
+        by `module` (same input ids and output dimension, e.g. hashed_embedding.QREmbedding), and move its
+        regularization to the parameters of `module`. Call it before `compile`.
+        """
+        old_ids = set(id(p) for p in embedding_dict[name].parameters())
+        embedding_dict[name] = module.to(self.device)
+        regularization_weight = []
+        for weight_list, l1, l2 in self.regularization_weight:
+            kept = [w for w in weight_list if id(w[1] if isinstance(w, tuple) else w) not in old_ids]
+            if len(kept) != len(weight_list):
+                kept += list(module.parameters())
+            regularization_weight.append((kept, l1, l2))
+        self.regularization_weight = regularization_weight
+
+    def compute_input_dim(self, feature_columns, include_sparse=True, include_dense=True, feature_group=False):
+        """
+        Same as `BaseModel.compute_input_dim`, the dense part includes the frozen feed vector.
+        """
+        input_dim = super(MyBaseModel, self).compute_input_dim(feature_columns, include_sparse, include_dense,
+                                                               feature_group)
+        return input_dim + (self.feed_embedding_dim if include_dense else 0)
+
+    def dnn_dense_inputs(self, sparse_ids, dense_value_list):
+        """
+        Dense inputs of the DNN: `dense_value_list` plus the frozen feed vector of every sample.
+        """
+        if self.feed_embedding is None:
+            return dense_value_list
+        feed_ids = sparse_ids[:, self.sparse_index['feedid']]
+        return dense_value_list + [F.embedding(feed_ids, self.feed_embedding).float()]
+
+    def input_from_batch(self, sparse_ids, dense_values, feature_columns, embedding_dict):
+        """
+        Same as `input_from_feature_columns`, but reads ids and dense values from the typed batch.
+        """
+        sparse_embedding_list = [embedding_dict[feat.embedding_name](
+            sparse_ids[:, self.sparse_index[feat.name]:self.sparse_index[feat.name] + 1]) for
+            feat in feature_columns if isinstance(feat, SparseFeat)]
+
+        dense_value_list = [dense_values[:, self.dense_index[feat.name][0]:self.dense_index[feat.name][1]] for
+                            feat in feature_columns if isinstance(feat, DenseFeat)]
+
+        return sparse_embedding_list, dense_value_list
+
+    def linear_logit(self, sparse_ids, dense_values):
+        """
+        Same as `self.linear_model(X)`, but reads ids and dense values from the typed batch.
+        """
+        linear_model = self.linear_model
+        sparse_embedding_list, dense_value_list = self.input_from_batch(
+            sparse_ids, dense_values, linear_model.sparse_feature_columns + linear_model.dense_feature_columns,
+            linear_model.embedding_dict)
+
+        linear_logit = dense_values.new_zeros((sparse_ids.shape[0], 1))
+        if len(sparse_embedding_list) > 0:
+            sparse_embedding_cat = torch.cat(sparse_embedding_list, dim=-1)
+            linear_logit += torch.sum(sparse_embedding_cat, dim=-1, keepdim=False)
+        if len(dense_value_list) > 0:
+            linear_logit += torch.cat(dense_value_list, dim=-1).matmul(linear_model.weight)
+        return linear_logit
+
 class MyDeepFM(MyBaseModel):
     def __init__(self,
                  linear_feature_columns, dnn_feature_columns, use_fm=True,
                  dnn_hidden_units=(256, 128),
                  l2_reg_linear=0.00001, l2_reg_embedding=0.00001, l2_reg_dnn=0, init_std=0.0001, seed=1024,
                  dnn_dropout=0,
-                 dnn_activation='relu', dnn_use_bn=False, task='binary', device='cpu', gpus=None):
+                 dnn_activation='relu', dnn_use_bn=False, task='binary', device='cpu', gpus=None,
+                 feed_embedding=None):
 
         super(MyDeepFM, self).__init__(linear_feature_columns, dnn_feature_columns, l2_reg_linear=l2_reg_linear,
                                      l2_reg_embedding=l2_reg_embedding, init_std=init_std, seed=seed, task=task,
-                                     device=device, gpus=gpus)
+                                     device=device, gpus=gpus, feed_embedding=feed_embedding)
 
         self.use_fm = use_fm
         self.use_dnn = len(dnn_feature_columns) > 0 and len(
@@ -264,11 +606,11 @@ class MyDeepFM(MyBaseModel):
             self.add_regularization_weight(self.dnn_linear.weight, l2=l2_reg_dnn)
         self.to(device)
 
-    def forward(self, X):
+    def forward(self, sparse_ids, dense_values):
 
-        sparse_embedding_list, dense_value_list = self.input_from_feature_columns(X, self.dnn_feature_columns,
-                                                                                  self.embedding_dict)
-        logit = self.linear_model(X)
+        sparse_embedding_list, dense_value_list = self.input_from_batch(sparse_ids, dense_values,
+                                                                        self.dnn_feature_columns, self.embedding_dict)
+        logit = self.linear_logit(sparse_ids, dense_values)
 
         if self.use_fm and len(sparse_embedding_list) > 0:
             fm_input = torch.cat(sparse_embedding_list, dim=1)
@@ -276,7 +618,7 @@ class MyDeepFM(MyBaseModel):
 
         if self.use_dnn:
             dnn_input = combined_dnn_input(
-                sparse_embedding_list, dense_value_list)
+                sparse_embedding_list, self.dnn_dense_inputs(sparse_ids, dense_value_list))
             dnn_output = self.dnn(dnn_input)
             dnn_logit = self.dnn_linear(dnn_output)
             logit += dnn_logit
@@ -292,11 +634,12 @@ class MyAFTDeepFM(MyBaseModel):
                  dnn_hidden_units=(256, 64),
                  l2_reg_linear=0.00001, l2_reg_embedding=0.00001, l2_reg_dnn=0, init_std=0.0001, seed=1024,
                  dnn_dropout=0,
-                 dnn_activation='relu', dnn_use_bn=False, task='binary', device='cpu', gpus=None):
+                 dnn_activation='relu', dnn_use_bn=False, task='binary', device='cpu', gpus=None,
+                 aft_module=AFTFull, feed_embedding=None):
 
         super(MyAFTDeepFM, self).__init__(linear_feature_columns, dnn_feature_columns, l2_reg_linear=l2_reg_linear,
                                      l2_reg_embedding=l2_reg_embedding, init_std=init_std, seed=seed, task=task,
-                                     device=device, gpus=gpus)
+                                     device=device, gpus=gpus, feed_embedding=feed_embedding)
 
         self.use_fm = use_fm
         self.use_dnn = len(dnn_feature_columns) > 0 and len(
@@ -316,7 +659,7 @@ class MyAFTDeepFM(MyBaseModel):
         #     device=device
         # )
         self.aftfulls = nn.ModuleList(
-            [self.make_layer(AFTFull, device) for i in range(self.layers_count)])
+            [self.make_layer(aft_module, device) for i in range(self.layers_count)])
         # self.aftsimple = AFTSimple(
         #     max_seqlen=len(sparse_feature_columns),
         #     dim=4,  # Embedding 4
@@ -349,11 +692,11 @@ class MyAFTDeepFM(MyBaseModel):
             device=device
         )
 
-    def forward(self, X):
+    def forward(self, sparse_ids, dense_values):
 
-        sparse_embedding_list, dense_value_list = self.input_from_feature_columns(X, self.dnn_feature_columns,
-                                                                                  self.embedding_dict)
-        logit = self.linear_model(X)
+        sparse_embedding_list, dense_value_list = self.input_from_batch(sparse_ids, dense_values,
+                                                                        self.dnn_feature_columns, self.embedding_dict)
+        logit = self.linear_logit(sparse_ids, dense_values)
 
         if self.use_fm and len(sparse_embedding_list) > 0:
             fm_input = torch.cat(sparse_embedding_list, dim=1)
@@ -367,8 +710,9 @@ class MyAFTDeepFM(MyBaseModel):
 
         for i in range(self.layers_count):
             if i % 4 == 0:
-                dnn_input_p = dnn_input.clone().detach()
-                dnn_input_x_p = dnn_input_x.clone().detach()
+                # 残差分支不回传梯度；残差相加不是原地操作，无需clone
+                dnn_input_p = dnn_input.detach()
+                dnn_input_x_p = dnn_input_x.detach()
 
             dnn_input = self.aftfulls[i](dnn_input)
             dnn_input =  torch.nn.functional.relu(dnn_input)
@@ -376,8 +720,8 @@ class MyAFTDeepFM(MyBaseModel):
             dnn_input_x =  torch.nn.functional.relu(dnn_input_x)
 
             if i % 4 == 0:
-                dnn_input += dnn_input_p
-                dnn_input_x += dnn_input_x_p
+                dnn_input = dnn_input + dnn_input_p
+                dnn_input_x = dnn_input_x + dnn_input_x_p
 
         aft_input = torch.cat([dnn_input, dnn_input_x], dim=-1)
         aft_input = aft_input.view((aft_input.shape[0], -1))
@@ -386,7 +730,7 @@ class MyAFTDeepFM(MyBaseModel):
 
         if self.use_dnn:
             dnn_input = combined_dnn_input(
-                sparse_embedding_list, dense_value_list)
+                sparse_embedding_list, self.dnn_dense_inputs(sparse_ids, dense_value_list))
             dnn_output = self.dnn(dnn_input)
             dnn_logit = self.dnn_linear(dnn_output)
             logit += dnn_logit
@@ -395,39 +739,342 @@ class MyAFTDeepFM(MyBaseModel):
 
         return y_pred
 
-import sys
+class MyMMoE(MyBaseModel):
+    """
+    Multi-task ranker: shared embeddings (plus shared linear / FM logit), MMoE experts with one softmax gate per
+    task, and one tower per task. `forward` returns the probabilities of all tasks [B, number of tasks].
+    With `shared_bottom=True` a single expert feeds every tower (no gates).
+    """
+
+    def __init__(self,
+                 linear_feature_columns, dnn_feature_columns, task_names=ACTION_LIST, task_weights=ACTION_WEIGHT,
+                 num_experts=4, expert_dnn_hidden_units=(256, 128), tower_dnn_hidden_units=(64,),
+                 shared_bottom=False, use_fm=True,
+                 l2_reg_linear=0.00001, l2_reg_embedding=0.00001, l2_reg_dnn=0, init_std=0.0001, seed=1024,
+                 dnn_dropout=0,
+                 dnn_activation='relu', dnn_use_bn=False, device='cpu', gpus=None, feed_embedding=None):
+        """
+        :param task_names: List of task (action) names, the output columns in this order.
+        :param task_weights: Dict. task name -> weight of its metrics in the aggregated metrics (e.g. "uauc").
+        :param num_experts: Integer. Number of experts (ignored with `shared_bottom`).
+        :param expert_dnn_hidden_units: Tuple. Hidden units of every expert.
+        :param tower_dnn_hidden_units: Tuple. Hidden units of every task tower, () = linear tower.
+        :param shared_bottom: Boolean. One shared expert instead of gated experts.
+        Other parameters are the same as `MyDeepFM`.
+        """
+
+        super(MyMMoE, self).__init__(linear_feature_columns, dnn_feature_columns, l2_reg_linear=l2_reg_linear,
+                                     l2_reg_embedding=l2_reg_embedding, init_std=init_std, seed=seed, task='binary',
+                                     device=device, gpus=gpus, feed_embedding=feed_embedding)
+        self.task_names = list(task_names)
+        self.task_weights = dict(task_weights)
+        self.shared_bottom = shared_bottom
+        self.use_fm = use_fm
+        if use_fm:
+            self.fm = FM()
+
+        num_experts = 1 if shared_bottom else num_experts
+        input_dim = self.compute_input_dim(dnn_feature_columns)
+        self.experts = nn.ModuleList([DNN(input_dim, expert_dnn_hidden_units, activation=dnn_activation,
+                                          l2_reg=l2_reg_dnn, dropout_rate=dnn_dropout, use_bn=dnn_use_bn,
+                                          init_std=init_std, device=device) for _ in range(num_experts)])
+        self.gates = nn.ModuleList([] if shared_bottom else [
+            nn.Linear(input_dim, num_experts, bias=False) for _ in self.task_names])
+        self.towers = nn.ModuleList([DNN(expert_dnn_hidden_units[-1], tower_dnn_hidden_units,
+                                         activation=dnn_activation, l2_reg=l2_reg_dnn, dropout_rate=dnn_dropout,
+                                         use_bn=dnn_use_bn, init_std=init_std, device=device)
+                                     if len(tower_dnn_hidden_units) > 0 else nn.Identity() for _ in self.task_names])
+        tower_dim = tower_dnn_hidden_units[-1] if len(tower_dnn_hidden_units) > 0 else expert_dnn_hidden_units[-1]
+        self.tower_linears = nn.ModuleList([nn.Linear(tower_dim, 1, bias=False) for _ in self.task_names])
+        # 每个任务各自的偏置
+        self.outs = nn.ModuleList([PredictionLayer('binary') for _ in self.task_names])
+
+        for module in (self.experts, self.gates, self.towers, self.tower_linears):
+            self.add_regularization_weight(
+                filter(lambda x: 'weight' in x[0] and 'bn' not in x[0], module.named_parameters()), l2=l2_reg_dnn)
+        self.to(device)
+
+    def forward(self, sparse_ids, dense_values):
+
+        sparse_embedding_list, dense_value_list = self.input_from_batch(sparse_ids, dense_values,
+                                                                        self.dnn_feature_columns, self.embedding_dict)
+        # 各任务共用的linear + FM logit
+        shared_logit = self.linear_logit(sparse_ids, dense_values)
+        if self.use_fm and len(sparse_embedding_list) > 0:
+            shared_logit = shared_logit + self.fm(torch.cat(sparse_embedding_list, dim=1))
+
+        dnn_input = combined_dnn_input(sparse_embedding_list, self.dnn_dense_inputs(sparse_ids, dense_value_list))
+        # [B, num_experts, expert_dim]
+        expert_output = torch.stack([expert(dnn_input) for expert in self.experts], dim=1)
+
+        y_pred = []
+        for i in range(len(self.task_names)):
+            if self.shared_bottom:
+                tower_input = expert_output[:, 0]
+            else:
+                gate = torch.softmax(self.gates[i](dnn_input), dim=-1).unsqueeze(-1)
+                tower_input = torch.sum(expert_output * gate, dim=1)
+            logit = self.tower_linears[i](self.towers[i](tower_input)) + shared_logit
+            y_pred.append(self.outs[i](logit))
+        return torch.cat(y_pred, dim=-1)
+
+    def _compute_metrics(self, y, pred_ans, user_ids=None, sample_weight=None):
+        """
+        Metrics of every task on its own samples (`sample_weight` column > 0), logged as "{metric}_{task}",
+        and the `task_weights` weighted average of every metric under the metric name (e.g. "uauc").
+        """
+        num_tasks = len(self.task_names)
+        y = np.asarray(y).reshape(-1, num_tasks)
+        pred_ans = np.asarray(pred_ans).reshape(-1, num_tasks)
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight).reshape(-1, num_tasks)
+        result = {}
+        total_weight = float(sum(self.task_weights.get(task, 1.0) for task in self.task_names))
+        for i, task in enumerate(self.task_names):
+            task_result = super(MyMMoE, self)._compute_metrics(
+                y[:, i], pred_ans[:, i], user_ids, None if sample_weight is None else sample_weight[:, i])
+            for name, value in task_result.items():
+                result[name + '_' + task] = value
+                result[name] = result.get(name, 0.0) + value * self.task_weights.get(task, 1.0) / total_weight
+        return result
+
+
+def get_feature_columns(vocabulary_sizes):
+    """
+    离散特征（词表大小来自编码缓存）+ 连续特征，linear与dnn部分共用
+    """
+    return [SparseFeat(feat, vocabulary_sizes[feat]) for feat in SPARSE_FEATURES] + \
+           [DenseFeat(feat, 1, ) for feat in DENSE_FEATURES]
+
+
+def build_model(x, feature_columns, device='cpu', feed_embedding=None):
+    """
+    第x组模型结构（0-3），submit_base_{x}.csv即由第x组模型生成
+    :param feed_embedding: 降维后的feed向量表（load_feed_embedding），None表示不使用
+    """
+    # DataParallel只用于GPU，CPU上（含distributed.py多进程训练）不设置gpus
+    gpus = ([0, 1] if x == 3 else [0]) if str(device).startswith('cuda') else None
+    # score=0.6430
+    if x==0:
+        model = MyAFTDeepFM(linear_feature_columns=feature_columns, dnn_feature_columns=feature_columns,
+                         task='binary',
+                         l2_reg_embedding=1e-1, device=device, gpus=gpus,
+                         feed_embedding=feed_embedding)
+    if x==1:
+        model = MyAFTDeepFM(linear_feature_columns=feature_columns,
+                            dnn_feature_columns=feature_columns,
+                            dnn_hidden_units=(),
+                            task='binary',
+                            l2_reg_embedding=1e-1, device=device, gpus=gpus,
+                            feed_embedding=feed_embedding)
+    if x==2:
+        model = MyAFTDeepFM(linear_feature_columns=feature_columns,
+                            dnn_feature_columns=feature_columns,
+                            use_fm=False,
+                            task='binary',
+                            l2_reg_embedding=1e-1, device=device, gpus=gpus,
+                            feed_embedding=feed_embedding)
+    if x==3:
+        model = MyAFTDeepFM(linear_feature_columns=feature_columns,
+                            dnn_feature_columns=feature_columns,
+                            use_fm=False,
+                            dnn_hidden_units=(),
+                            task='binary',
+                            l2_reg_embedding=1e-1, device=device, gpus=gpus,
+                            feed_embedding=feed_embedding)
+    # score=0.6431 nn_dropout=0.5  score=0.6430
+    # model = MyAFTDeepFM(linear_feature_columns=feature_columns, dnn_feature_columns=feature_columns,
+    #                  task='binary',
+    #                  l2_reg_embedding=1e-1, device=device, gpus=gpus)
+    # score=0.64
+    # model = MyDeepFM(linear_feature_columns=feature_columns, dnn_feature_columns=feature_columns,
+    #                   task='binary',
+    #                   l2_reg_embedding=1e-1, device=device, gpus=gpus)
+    # score=0.6346
+    # model = MyxDeepFM(linear_feature_columns=feature_columns, dnn_feature_columns=feature_columns,
+    #                task='binary',
+    #                l2_reg_embedding=1e-1, device=device, gpus=gpus)
+    # score = 0.62
+    # model = MyxDeepFM(linear_feature_columns=feature_columns, dnn_feature_columns=feature_columns,
+    #                   dnn_hidden_units=(256, 256, 128, 128, 64, 64, 32),
+    #                   cin_layer_size=(256, 128, 128, 64, 64, 32),
+    #                    task='binary',
+    #                    l2_reg_embedding=1e-1, device=device, gpus=gpus)
+    return model
+
+
+def build_multitask_model(feature_columns, device='cpu', feed_embedding=None, shared_bottom=False):
+    """
+    所有行为共用一个模型（MMoE或shared-bottom），一次前向输出ACTION_LIST各行为的概率
+    """
+    gpus = [0] if str(device).startswith('cuda') else None
+    return MyMMoE(linear_feature_columns=feature_columns, dnn_feature_columns=feature_columns,
+                  shared_bottom=shared_bottom, l2_reg_embedding=1e-1, device=device, gpus=gpus,
+                  feed_embedding=feed_embedding)
+
+
+def compile_model(model, sparse_optimizer=SPARSE_OPTIMIZER):
+    """
+    :param sparse_optimizer: None, "lazy_adamw" or "rowwise_adagrad". If set, the embedding tables use sparse
+        gradients and this row-wise optimizer (their L2 becomes its weight decay), the rest dense AdamW.
+    """
+    sparse_optimizer_ = None
+    if sparse_optimizer:
+        sparse_optimizer_ = SPARSE_OPTIMIZERS[sparse_optimizer](model.enable_sparse_embeddings(), lr=1e-1)
+    embedding_ids = set(id(p) for group in sparse_optimizer_.param_groups
+                        for p in group['params']) if sparse_optimizer_ else set()
+    named_parameters = [(n, p) for n, p in model.named_parameters() if id(p) not in embedding_ids]
+    # baseline opt = adagrad, loss =binary_crossentropy
+    no_decay = ['bias', 'gamma', 'beta']
+    optimizer_parameters = [
+        {'params': [p for n, p in named_parameters
+                    if not any(nd in n for nd in no_decay)],
+         'weight_decay_rate': 0.01},
+        {'params': [p for n, p in named_parameters
+                    if any(nd in n for nd in no_decay)],
+         'weight_decay_rate': 0.0}]
+    optimizer = AdamW(
+        optimizer_parameters,
+        lr=1e-1,
+        betas=(0.9, 0.999),
+        weight_decay=1e-4,
+        correct_bias=False)
+    if sparse_optimizer_ is not None:
+        optimizer = CombinedOptimizer(optimizer, sparse_optimizer_)
+    model.compile(optimizer=optimizer, loss='binary_crossentropy', metrics=['binary_crossentropy', "auc", "uauc"])
+    return model
+
+
+def top_k(scores, k):
+    """
+    Indices of the k largest scores, in descending order: argpartition, then only the k selected scores are
+    sorted.
+    """
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top])]
+
+
+def action_scores(models, inputs, batch_size=2048):
+    """
+    :param models: Dict. action -> single-task model, or one multi-task model (`task_names`).
+    :param inputs: ModelInputs.
+    :return: (list of actions, array [N, number of actions] of probabilities)
+    """
+    if isinstance(models, MyBaseModel):
+        return list(models.task_names), models.predict(inputs, batch_size)
+    actions = list(models)
+    return actions, np.concatenate([models[action].predict(inputs, batch_size) for action in actions], axis=1)
+
+
+def weighted_scores(scores, actions, weights=ACTION_WEIGHT):
+    """
+    Weighted average of the action probabilities, with the weights of the weighted uAUC.
+    """
+    weights = np.array([float(weights[action]) for action in actions])
+    return scores.dot(weights / weights.sum())
+
+
+def rank(models, user, candidates, k=10, weights=ACTION_WEIGHT):
+    """
+    Top-k candidates of one user by the weighted score of all actions. The user columns are broadcast once
+    (`MyBaseModel.candidate_inputs`) and every action is predicted in one pass over the candidates.
+
+    :param models: Dict. action -> single-task model, or one multi-task model.
+    :param user: Dict. feature name -> one encoded value, e.g. {'userid': 12}.
+    :param candidates: Dict. feature name -> array [N] (encoded feedid, authorid, ..., videoplayseconds).
+    :return: (indices of the top k candidates, their weighted scores, their action probabilities [k, actions])
+    """
+    model = models if isinstance(models, MyBaseModel) else next(iter(models.values()))
+    actions, scores = action_scores(models, model.candidate_inputs(user, candidates))
+    weighted = weighted_scores(scores, actions, weights)
+    top = top_k(weighted, k)
+    return top, weighted[top], scores[top]
+
+
+def rank_many(models, users, candidates, k=10, weights=ACTION_WEIGHT):
+    """
+    `rank` for several users with one prediction over the candidates of all of them.
+
+    :param users: List of dicts (one per user, see `rank`).
+    :param candidates: List of dicts (the candidates of every user).
+    :return: List of `rank` results.
+    """
+    model = models if isinstance(models, MyBaseModel) else next(iter(models.values()))
+    parts = [model.candidate_inputs(u, c) for u, c in zip(users, candidates)]
+    inputs = ModelInputs(np.concatenate([x.sparse for x in parts]), np.concatenate([x.dense for x in parts]))
+    actions, scores = action_scores(models, inputs)
+    weighted = weighted_scores(scores, actions, weights)
+    results = []
+    start = 0
+    for x in parts:
+        end = start + len(x.sparse)
+        top = top_k(weighted[start:end], k)
+        results.append((top, weighted[start:end][top], scores[start:end][top]))
+        start = end
+    return results
+
+
+def train_multitask(mode, submit, test, feature_columns, device='cpu', feed_embedding=None, cache=None):
+    """
+    在去重后的训练集上训练一个多任务模型（每个epoch各行为分别抽取负样本，未抽中的行为loss权重为0），预测所有行为并导出
+    :param mode: String. "mmoe" or "shared_bottom"
+    :param submit: DataFrame. 写入各行为的预测列
+    :param test: Dict. 编码后的测试集
+    :param cache: PredictionCache or None. 测试集预测缓存
+    """
+    train = load_encoded('train_data')
+    model = compile_model(build_multitask_model(feature_columns, device, feed_embedding,
+                                                shared_bottom=mode == 'shared_bottom'))
+    labels = np.stack([train[action] for action in model.task_names], axis=1).astype(np.float32)
+    with PROFILER.stage(f'fit[{mode}]'):
+        model.fit({name: train[name] for name in model.feature_index}, labels,
+                  negative_rate=[1.0 / ACTION_SAMPLE_RATE[action] for action in model.task_names], batch_size=1024,
+                  epochs=5, verbose=1, validation_time=train['date_'], early_stopping_patience=1)
+    if QUANTIZE_INFERENCE:
+        model = quantize_model(model)
+    with PROFILER.stage(f'predict[{mode}]'):
+        pred_ans = model.predict({name: test[name] for name in model.feature_index}, 128, cache,
+                                 file_signature(ENCODED_PATH + '/test_data'))
+    for i, action in enumerate(model.task_names):
+        submit[action] = pred_ans[:, i]
+    export_model(model, MODEL_PATH + '/multitask_{}.pt'.format(mode))
+    return model
+
+
 if __name__ == "__main__":
+    # 参数为起始模型组号（0-3，逐行为训练），或 mmoe / shared_bottom（所有行为一个多任务模型）
+    multitask = sys.argv[1] if sys.argv[1] in ('mmoe', 'shared_bottom') else None
+    start = 0 if multitask else int(sys.argv[1])
+    # 一次性编码：词表和归一化参数在所有行为、所有模型间共用；
+    # 原始数据或代码改变时重新生成，否则只比较hash（prepare_data.build_pipeline）
+    build_pipeline().run(['encode_data'] + (['compress_feed_embeddings'] if USE_FEED_EMBEDDING else []))
     submit = pd.read_csv(ROOT_PATH + '/test_data.csv')[['userid', 'feedid']]
-    start =  int(sys.argv[1])
+    vocabulary_sizes = load_vocabulary_sizes()
+    test = load_encoded('test_data')
+    feed_embedding = load_feed_embedding() if USE_FEED_EMBEDDING else None
+    os.makedirs(MODEL_PATH, exist_ok=True)
+    cache = PredictionCache(disk_path=PREDICTION_CACHE_PATH) if PREDICTION_CACHE_PATH else None
+    if multitask:
+        device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+        train_multitask(multitask, submit, test, get_feature_columns(vocabulary_sizes), device, feed_embedding,
+                        cache)
+        submit.to_csv("./submit_{}.csv".format(multitask), index=False)
+        if cache is not None:
+            cache.flush()
+            print('Prediction cache:', cache.stats())
+        sys.exit(0)
+    # 所有行为共用去重后的训练集，负样本在训练时按行为抽取
+    train = load_encoded('train_data')
     for x in range(start, 4):
         for action in ACTION_LIST:
-            USE_FEAT = ['userid', 'feedid', action] + FEA_FEED_LIST[1:]
-            train = pd.read_csv(ROOT_PATH + f'/train_data_for_{action}.csv')[USE_FEAT]
-            train = train.sample(frac=1, random_state=42).reset_index(drop=True)
             print("posi prop:")
-            print(sum((train[action]==1)*1)/train.shape[0])
-            test = pd.read_csv(ROOT_PATH + '/test_data.csv')[[i for i in USE_FEAT if i != action]]
-            target = [action]
-            test[target[0]] = 0
-            test = test[USE_FEAT]
-            data = pd.concat((train, test)).reset_index(drop=True)
-            dense_features = ['videoplayseconds']
-            sparse_features = [i for i in USE_FEAT if i not in dense_features and i not in target]
-
-            data[sparse_features] = data[sparse_features].fillna(0)
-            data[dense_features] = data[dense_features].fillna(0)
-
-            # 1.Label Encoding for sparse features,and do simple Transformation for dense features
-            for feat in sparse_features:
-                lbe = LabelEncoder()
-                data[feat] = lbe.fit_transform(data[feat])
-            mms = MinMaxScaler(feature_range=(0, 1))
-            data[dense_features] = mms.fit_transform(data[dense_features])
+            print(np.mean(train[action]))
 
             # 2.count #unique features for each sparse field,and record dense feature field name
-            fixlen_feature_columns = [SparseFeat(feat, data[feat].nunique())
-                                      for feat in sparse_features] + [DenseFeat(feat, 1, )
-                                                                      for feat in dense_features]
+            fixlen_feature_columns = get_feature_columns(vocabulary_sizes)
             dnn_feature_columns = fixlen_feature_columns
             linear_feature_columns = fixlen_feature_columns
 
@@ -435,7 +1082,6 @@ if __name__ == "__main__":
                 linear_feature_columns + dnn_feature_columns)
 
             # 3.generate input data for model
-            train, test = data.iloc[:train.shape[0]].reset_index(drop=True), data.iloc[train.shape[0]:].reset_index(drop=True)
             train_model_input = {name: train[name] for name in feature_names}
             test_model_input = {name: test[name] for name in feature_names}
 
@@ -446,69 +1092,21 @@ if __name__ == "__main__":
                 print('cuda ready...')
                 device = 'cuda:0'
 
-            # score=0.6430
-            if x==0:
-                model = MyAFTDeepFM(linear_feature_columns=linear_feature_columns, dnn_feature_columns=dnn_feature_columns,
-                                 task='binary',
-                                 l2_reg_embedding=1e-1, device=device, gpus=[0])
-            if x==1:
-                model = MyAFTDeepFM(linear_feature_columns=linear_feature_columns,
-                                    dnn_feature_columns=dnn_feature_columns,
-                                    dnn_hidden_units=(),
-                                    task='binary',
-                                    l2_reg_embedding=1e-1, device=device, gpus=[0])
-            if x==2:
-                model = MyAFTDeepFM(linear_feature_columns=linear_feature_columns,
-                                    dnn_feature_columns=dnn_feature_columns,
-                                    use_fm=False,
-                                    task='binary',
-                                    l2_reg_embedding=1e-1, device=device, gpus=[0])
-            if x==3:
-                model = MyAFTDeepFM(linear_feature_columns=linear_feature_columns,
-                                    dnn_feature_columns=dnn_feature_columns,
-                                    use_fm=False,
-                                    dnn_hidden_units=(),
-                                    task='binary',
-                                    l2_reg_embedding=1e-1, device=device, gpus=[0, 1])
-            # score=0.6431 nn_dropout=0.5  score=0.6430
-            # model = MyAFTDeepFM(linear_feature_columns=linear_feature_columns, dnn_feature_columns=dnn_feature_columns,
-            #                  task='binary',
-            #                  l2_reg_embedding=1e-1, device=device, gpus=[0, 1])
-            # score=0.64
-            # model = MyDeepFM(linear_feature_columns=linear_feature_columns, dnn_feature_columns=dnn_feature_columns,
-            #                   task='binary',
-            #                   l2_reg_embedding=1e-1, device=device, gpus=[0, 1])
-            # score=0.6346
-            # model = MyxDeepFM(linear_feature_columns=linear_feature_columns, dnn_feature_columns=dnn_feature_columns,
-            #                task='binary',
-            #                l2_reg_embedding=1e-1, device=device, gpus=[0, 1])
-            # score = 0.62
-            # model = MyxDeepFM(linear_feature_columns=linear_feature_columns, dnn_feature_columns=dnn_feature_columns,
-            #                   dnn_hidden_units=(256, 256, 128, 128, 64, 64, 32),
-            #                   cin_layer_size=(256, 128, 128, 64, 64, 32),
-            #                    task='binary',
-            #                    l2_reg_embedding=1e-1, device=device, gpus=[0, 1])
-            # baseline opt = adagrad, loss =binary_crossentropy
-            no_decay = ['bias', 'gamma', 'beta']
-            optimizer_parameters = [
-                {'params': [p for n, p in model.named_parameters()
-                            if not any(nd in n for nd in no_decay)],
-                 'weight_decay_rate': 0.01},
-                {'params': [p for n, p in model.named_parameters()
-                            if any(nd in n for nd in no_decay)],
-                 'weight_decay_rate': 0.0}]
-            optimizer = AdamW(
-                optimizer_parameters,
-                lr=1e-1,
-                betas=(0.9, 0.999),
-                weight_decay=1e-4,
-                correct_bias=False)
-            model.compile(optimizer=optimizer, loss='binary_crossentropy', metrics=['binary_crossentropy', "auc"])
-
-            history = model.fit(train_model_input, train[target].values, batch_size=1024, epochs=5, verbose=1,
-                                validation_split=0.2)
-            pred_ans = model.predict(test_model_input, 128)
+            model = compile_model(build_model(x, fixlen_feature_columns, device, feed_embedding))
+
+            with PROFILER.stage(f'fit[{action}_{x}]'):
+                history = model.fit(train_model_input, np.array(train[action], dtype=np.float32).reshape(-1, 1),
+                                    negative_rate=1.0 / ACTION_SAMPLE_RATE[action], batch_size=1024, epochs=5,
+                                    verbose=1, validation_time=train['date_'], early_stopping_patience=1)
+            if QUANTIZE_INFERENCE:
+                model = quantize_model(model)
+            with PROFILER.stage(f'predict[{action}_{x}]'):
+                pred_ans = model.predict(test_model_input, 128, cache, file_signature(ENCODED_PATH + '/test_data'))
             submit[action] = pred_ans
+            export_model(model, MODEL_PATH + '/{}_{}.pt'.format(action, x))
             torch.cuda.empty_cache()
         # 保存提交文件
         submit.to_csv("./submit_base_{}.csv".format(x), index=False)
+        if cache is not None:
+            cache.flush()
+            print('Prediction cache:', cache.stats())
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+from collections import namedtuple
+
+import numpy as np
+import torch
+
+# 模型输入：离散特征id矩阵（int32/int64）和连续特征矩阵（float32）
+ModelInputs = namedtuple('ModelInputs', ['sparse', 'dense'])
+
+
+class ArrayBatchLoader(object):
+    """
+    Batch iterator over a group of numpy arrays sharing the first dimension.
+
+    Every batch is one contiguous slice (no shuffle) or one gather of a permuted index block (shuffle),
+    so there is no per-sample collation and every array keeps its own dtype.
+    """
+
+    def __init__(self, arrays, batch_size=256, shuffle=False, pin_memory=False, prefetch=0, num_shards=1,
+                 shard_id=0, seed=0, sampler=None):
+        """
+        :param arrays: List of numpy arrays with the same length, e.g. [sparse_ids, dense_values, y].
+        :param batch_size: Integer. Number of samples per batch.
+        :param shuffle: Boolean. Whether to permute the samples at the beginning of every iteration.
+        :param pin_memory: Boolean. Whether to copy batches into page-locked memory for async host-to-device copy.
+        :param prefetch: Integer. Number of batches prepared ahead by a background thread (0 = no thread).
+        :param num_shards: Integer. Number of distributed workers sharing the arrays, each iterates over its own shard.
+        :param shard_id: Integer. Shard of this worker (its rank), in [0, num_shards).
+        :param seed: Integer. Sharded shuffling uses `seed + epoch` so every worker draws the same permutation.
+        :param sampler: sampler.NegativeSampler or None. Every epoch iterates over the rows drawn by
+            `sampler.epoch(epoch)` only, and their weights [M, T] are appended to every batch as the last array.
+        """
+        self.arrays = arrays
+        self.num_samples = len(arrays[0])
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.prefetch = prefetch
+        self.num_shards = num_shards
+        self.shard_id = shard_id
+        self.seed = seed
+        self.sampler = sampler
+        self.rows, self.weights = None, None
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        """
+        Set the epoch of the sharded shuffle (and draw the rows of the sampler),
+        call it at the beginning of every epoch like `DistributedSampler`. The rows of an epoch are drawn once.
+        """
+        if self.rows is not None and epoch == self.epoch:
+            # 本epoch的行已抽取（__init__抽取了epoch 0）
+            return
+        self.epoch = epoch
+        if self.sampler is not None:
+            # 各worker的sampler种子相同，抽到的行相同
+            self.rows, self.weights = self.sampler.epoch(epoch)
+            self.num_samples = len(self.rows)
+        # 各分片样本数相同（不足时从头补齐），保证每个worker的step数一致
+        self.shard_size = (self.num_samples - 1) // self.num_shards + 1
+
+    def __len__(self):
+        return (self.shard_size - 1) // self.batch_size + 1
+
+    def __iter__(self):
+        batches = self._batches(self._indices())
+        if self.prefetch > 0:
+            return self._prefetch(batches)
+        return batches
+
+    def _indices(self):
+        if self.num_shards > 1:
+            if self.shuffle:
+                generator = torch.Generator()
+                generator.manual_seed(self.seed + self.epoch)
+                indices = torch.randperm(self.num_samples, generator=generator).numpy()
+            else:
+                indices = np.arange(self.num_samples)
+            padding = self.shard_size * self.num_shards - self.num_samples
+            if padding > 0:
+                indices = np.concatenate([indices, indices[:padding]])
+            indices = indices[self.shard_id * self.shard_size:(self.shard_id + 1) * self.shard_size]
+            return indices if self.shuffle else np.sort(indices)
+        if self.shuffle:
+            return torch.randperm(self.num_samples).numpy()
+        return None
+
+    def _batches(self, indices):
+        num_samples = self.num_samples if indices is None else len(indices)
+        for start in range(0, num_samples, self.batch_size):
+            end = min(start + self.batch_size, num_samples)
+            # 块内排序，gather时访问更连续
+            index = slice(start, end) if indices is None else np.sort(indices[start:end])
+            if self.rows is not None:
+                batch = [np.take(array, self.rows[index], axis=0) for array in self.arrays] + [self.weights[index]]
+            elif indices is None:
+                batch = [array[index] for array in self.arrays]
+            else:
+                batch = [np.take(array, index, axis=0) for array in self.arrays]
+            batch = [torch.from_numpy(np.ascontiguousarray(array)) for array in batch]
+            if self.pin_memory:
+                batch = [tensor.pin_memory() for tensor in batch]
+            yield batch
+
+    def _prefetch(self, batches):
+        buffer = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for batch in batches:
+                    if not put(batch):
+                        return
+                put(end)
+            except BaseException as e:
+                put(e)
+
+        worker = threading.Thread(target=produce, daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is end:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            worker.join()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+AFT 层微基准
+- 对比AFTFull原始实现与当前实现的输出误差和前向/反向耗时
+  用法: python benchmark_aft.py --batch_size 1024 [--compile]
+- CPU上AFTFull/AFTLocal/AFTSimple/AFTConv吞吐随序列长度的变化
+  用法: python benchmark_aft.py --sweep --seq_lens 16 64 256 1024 4096
+"""
+import argparse
+import statistics
+import time
+
+import torch
+
+from aft_pytorch import AFTFull, AFTLocal, AFTSimple, AFTConv
+
+
+def aft_full_reference(layer, x):
+    '''
+    The previous AFTFull.forward: exp(w) and exp(K) evaluated twice, no overflow protection.
+    '''
+    B, T, _ = x.shape
+    Q = layer.to_q(x).view(B, T, layer.hidden_dim)
+    K = layer.to_k(x).view(B, T, layer.hidden_dim)
+    V = layer.to_v(x).view(B, T, layer.hidden_dim)
+    temp_wbias = layer.wbias[:T, :T].unsqueeze(0)
+    Q_sig = torch.sigmoid(Q)
+    temp = torch.exp(temp_wbias) @ torch.mul(torch.exp(K), V)
+    weighted = temp / (torch.exp(temp_wbias) @ torch.exp(K))
+    Yt = torch.mul(Q_sig, weighted)
+    return layer.project(Yt.view(B, T, layer.hidden_dim))
+
+
+def timeit(fn, x, repeat, trials, backward=False):
+    '''
+    Median milliseconds per call over `trials` runs of `repeat` calls.
+    '''
+    results = []
+    for _ in range(trials):
+        for _ in range(3):
+            fn(x)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            if backward:
+                fn(x).sum().backward()
+            else:
+                with torch.no_grad():
+                    fn(x)
+        results.append((time.perf_counter() - start) / repeat * 1000.0)
+    return statistics.median(results)
+
+
+def bench_full(args):
+    torch.manual_seed(2021)
+    layer = AFTFull(max_seqlen=args.seqlen, dim=args.dim, hidden_dim=args.hidden_dim)
+    x = torch.rand(args.batch_size, args.seqlen, args.dim)
+    with torch.no_grad():
+        diff = (layer(x) - aft_full_reference(layer, x)).abs().max().item()
+        # 大幅值输入：原实现exp溢出为nan，当前实现保持有限值
+        overflow = (aft_full_reference(layer, x * 1e3).isnan().any().item(), layer(x * 1e3).isnan().any().item())
+    print('AFTFull B=%d T=%d dim=%d hidden=%d, max abs diff: %.3e, nan on large inputs (reference, current): %s' % (
+        args.batch_size, args.seqlen, args.dim, args.hidden_dim, diff, overflow))
+
+    candidates = [('reference', lambda t: aft_full_reference(layer, t)), ('current', layer),
+                  ('current+script', torch.jit.script(layer))]
+    if args.compile and hasattr(torch, 'compile'):
+        candidates.append(('reference+compile', torch.compile(lambda t: aft_full_reference(layer, t))))
+        candidates.append(('current+compile', torch.compile(layer)))
+    for name, fn in candidates:
+        forward_ms = timeit(fn, x, args.repeat, args.trials)
+        backward_ms = timeit(fn, x, args.repeat, args.trials, backward=True)
+        print('%-18s forward: %8.3f ms  forward+backward: %8.3f ms' % (name, forward_ms, backward_ms))
+
+
+def bench_sweep(args):
+    '''
+    Forward throughput (tokens/s) of every AFT variant against the sequence length.
+    '''
+    torch.manual_seed(2021)
+    layers = [
+        ('AFTFull', lambda T: AFTFull(max_seqlen=T, dim=args.dim, hidden_dim=args.hidden_dim)),
+        ('AFTLocal', lambda T: AFTLocal(max_seqlen=T, dim=args.dim, hidden_dim=args.hidden_dim, s=args.window)),
+        ('AFTSimple', lambda T: AFTSimple(max_seqlen=T, dim=args.dim, hidden_dim=args.hidden_dim)),
+        ('AFTConv', lambda T: AFTConv(max_seqlen=T, dim=args.dim, hidden_dim=args.hidden_dim, heads=args.heads,
+                                      s=2 * args.window - 1)),
+    ]
+    print('B=%d dim=%d hidden=%d window=%d, forward tokens/s' % (
+        args.batch_size, args.dim, args.hidden_dim, args.window))
+    print('%8s' % 'T' + ''.join('%14s' % name for name, _ in layers))
+    for T in args.seq_lens:
+        x = torch.rand(args.batch_size, T, args.dim)
+        row = '%8d' % T
+        for name, build in layers:
+            forward_ms = timeit(build(T), x, args.repeat, args.trials)
+            row += '%14.0f' % (args.batch_size * T / forward_ms * 1000.0)
+        print(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--seqlen', type=int, default=5)
+    parser.add_argument('--dim', type=int, default=4)
+    parser.add_argument('--hidden_dim', type=int, default=192)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads, 0 = default')
+    parser.add_argument('--compile', action='store_true', help='also benchmark torch.compile (torch>=2.0)')
+    parser.add_argument('--sweep', action='store_true', help='throughput of all AFT variants against seq_lens')
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[16, 64, 256, 1024, 4096])
+    parser.add_argument('--window', type=int, default=16, help='AFTLocal s, AFTConv kernel size is 2 * s - 1')
+    parser.add_argument('--heads', type=int, default=4, help='AFTConv heads')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.sweep:
+        bench_sweep(args)
+    else:
+        bench_full(args)
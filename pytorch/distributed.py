@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+多进程DistributedDataParallel CPU训练（gloo后端）
+- 每台机器启动nproc个worker进程，每个进程训练训练集的一个分片，反向时all-reduce梯度
+- 训练数据在父进程编码一次，放在共享内存中供本机所有worker读取
+- 最后一天为验证集（validation_time=date_），验证集uAUC不再提升时提前停止
+- rank 0保存验证集uAUC最优的checkpoint；训练结束后父进程加载权重并导出TorchScript模型
+
+单机4进程:
+  python distributed.py --action like --variant 0 --nproc 4
+两台机器各4进程（每台机器各运行一次，node_rank分别为0和1）:
+  python distributed.py --action like --nproc 4 --nnodes 2 --node_rank 0 --master_addr 10.0.0.1
+也可以由torchrun启动（读取RANK/WORLD_SIZE/MASTER_ADDR/MASTER_PORT环境变量）:
+  torchrun --nproc_per_node 4 distributed.py --action like
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from baseline import ACTION_SAMPLE_RATE, MODEL_PATH, USE_FEED_EMBEDDING, build_model, compile_model, \
+    get_feature_columns
+from batch_loader import ModelInputs
+from deepctr_torch.callbacks import ModelCheckpoint
+from export import export_model
+from prepare_data import load_encoded, load_feed_embedding, load_vocabulary_sizes
+from sampler import NegativeSampler
+
+
+def load_training_arrays(model, action):
+    """
+    Encoded training set (labels of `action`) as (ModelInputs, float32 labels, date_) in the column order of `model`.
+    """
+    data = load_encoded('train_data')
+    x = model._typed_inputs({name: data[name] for name in model.feature_index})
+    y = model._typed_target(data[action])
+    return x, y, np.asarray(data['date_'])
+
+
+def share_arrays(x, y, date):
+    """
+    Move the training arrays into shared memory, worker processes receive them without a copy.
+    """
+    return [torch.from_numpy(np.ascontiguousarray(array)).share_memory_() for array in (x.sparse, x.dense, y, date)]
+
+
+def train_worker(local_rank, args, shared=None):
+    """
+    One DDP process: join the process group, train on its shard, rank 0 writes `args.checkpoint`.
+
+    :param local_rank: Integer. Process index on this machine.
+    :param args: Parsed command line arguments.
+    :param shared: List of shared tensors [sparse, dense, y, date], or None to load the encoded data in this process.
+    """
+    rank = args.node_rank * args.nproc + local_rank
+    world_size = args.nnodes * args.nproc
+    # 各进程平分本机CPU，避免线程超额订阅
+    torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // args.nproc))
+    dist.init_process_group('gloo', init_method='tcp://{}:{}'.format(args.master_addr, args.master_port),
+                            rank=rank, world_size=world_size)
+    try:
+        feed_embedding = load_feed_embedding() if USE_FEED_EMBEDDING else None
+        model = compile_model(build_model(args.variant, get_feature_columns(load_vocabulary_sizes()), 'cpu',
+                                          feed_embedding))
+        if shared is None:
+            x, y, date = load_training_arrays(model, args.action)
+        else:
+            sparse, dense, y, date = [tensor.numpy() for tensor in shared]
+            x = ModelInputs(sparse, dense)
+        start_time = time.time()
+        negative_rate = 1.0 / ACTION_SAMPLE_RATE[args.action]
+        history = model.fit(x, y, batch_size=args.batch_size, epochs=args.epochs, verbose=1 if rank == 0 else 0,
+                            validation_time=date, early_stopping_patience=args.patience, negative_rate=negative_rate,
+                            callbacks=[ModelCheckpoint(args.checkpoint, monitor='val_uauc', save_best_only=True,
+                                                       save_weights_only=True)])
+        if rank == 0:
+            elapsed = time.time() - start_time
+            # 每个epoch抽样后的期望样本数（最后一天为验证集，不参与训练）
+            sample_num = len(NegativeSampler(y[date < date.max()], negative_rate))
+            print('{0} processes: {1:.1f}s, {2:.0f} samples/s'.format(
+                world_size, elapsed, sample_num * len(history.epoch) / elapsed))
+    finally:
+        dist.destroy_process_group()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--action', default='read_comment')
+    parser.add_argument('--variant', type=int, default=0, help='baseline.build_model 第x组模型')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=1024, help='batch size per process')
+    parser.add_argument('--patience', type=int, default=1, help='early stopping patience on the last-day val_uauc')
+    parser.add_argument('--nproc', type=int, default=2, help='worker processes per machine')
+    parser.add_argument('--nnodes', type=int, default=1)
+    parser.add_argument('--node_rank', type=int, default=0)
+    parser.add_argument('--master_addr', default=os.environ.get('MASTER_ADDR', '127.0.0.1'))
+    parser.add_argument('--master_port', type=int, default=int(os.environ.get('MASTER_PORT', 29500)))
+    parser.add_argument('--threads', type=int, default=0, help='torch threads per process, 0 = cpu_count / nproc')
+    parser.add_argument('--checkpoint', default=None, help='default: MODEL_PATH/{action}_{variant}.pth')
+    args = parser.parse_args()
+    if args.checkpoint is None:
+        args.checkpoint = MODEL_PATH + '/{}_{}.pth'.format(args.action, args.variant)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.makedirs(os.path.dirname(args.checkpoint) or '.', exist_ok=True)
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        # torchrun：每个进程各自加载数据
+        args.nproc = int(os.environ.get('LOCAL_WORLD_SIZE', os.environ['WORLD_SIZE']))
+        args.nnodes = int(os.environ['WORLD_SIZE']) // args.nproc
+        args.node_rank = int(os.environ['RANK']) // args.nproc
+        train_worker(int(os.environ['RANK']) % args.nproc, args)
+    else:
+        model = build_model(args.variant, get_feature_columns(load_vocabulary_sizes()), 'cpu',
+                            load_feed_embedding() if USE_FEED_EMBEDDING else None)
+        shared = share_arrays(*load_training_arrays(model, args.action))
+        mp.spawn(train_worker, args=(args, shared), nprocs=args.nproc, join=True)
+        if args.node_rank == 0:
+            model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+            export_model(model, MODEL_PATH + '/{}_{}.pt'.format(args.action, args.variant))
+            print('checkpoint: {}, TorchScript: {}'.format(
+                args.checkpoint, MODEL_PATH + '/{}_{}.pt'.format(args.action, args.variant)))
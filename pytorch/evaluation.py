@@ -0,0 +1,43 @@
+# coding: utf-8
+import numpy as np
+
+
+def uAUC(labels, preds, user_id_list):
+    """
+    Calculate user AUC: mean of per-user AUC over users with both positive and negative samples.
+
+    Vectorized over all users (one lexsort), ties get the average rank like `scipy.stats.rankdata`.
+    :param labels: 1-d array of 0/1 labels.
+    :param preds: 1-d array of scores.
+    :param user_id_list: 1-d array of user ids.
+    :return: Float. uAUC, 0.0 if no user has both labels.
+    """
+    labels = np.asarray(labels, dtype=np.float64).reshape(-1)
+    preds = np.asarray(preds, dtype=np.float64).reshape(-1)
+    users = np.asarray(user_id_list).reshape(-1)
+    num_samples = len(labels)
+    if num_samples == 0:
+        return 0.0
+
+    # 按用户、预测值排序，同一用户内的位置即为秩
+    order = np.lexsort((preds, users))
+    users, preds, labels = users[order], preds[order], labels[order]
+    user_start = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    user_index = np.repeat(np.arange(len(user_start)), np.diff(np.r_[user_start, num_samples]))
+    ranks = np.arange(num_samples) - user_start[user_index] + 1.0
+
+    # 同一用户内预测值相同的样本取平均秩
+    tie_start = np.flatnonzero(np.r_[True, (users[1:] != users[:-1]) | (preds[1:] != preds[:-1])])
+    tie_index = np.repeat(np.arange(len(tie_start)), np.diff(np.r_[tie_start, num_samples]))
+    ranks = (np.bincount(tie_index, weights=ranks) / np.bincount(tie_index))[tie_index]
+
+    n_pos = np.bincount(user_index, weights=labels)
+    n_neg = np.bincount(user_index) - n_pos
+    rank_sum = np.bincount(user_index, weights=ranks * labels)
+    # 若全是正样本或全是负样本，则不计入
+    valid = (n_pos > 0) & (n_neg > 0)
+    if not valid.any():
+        return 0.0
+    n_pos, n_neg, rank_sum = n_pos[valid], n_neg[valid], rank_sum[valid]
+    return float(np.mean((rank_sum - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)))
+
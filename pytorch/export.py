@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+推理导出：把训练好的 MyDeepFM/MyAFTDeepFM 转为 TorchScript 文件，
+输入为扁平张量 (sparse_ids int64 [B, n_sparse], dense_values float32 [B, n_dense])，
+加载时只依赖 torch（不需要 deepctr / transformers）。
+
+基准: python export.py --batch_sizes 1 128 2000
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import torch
+
+META_FILE = 'meta.json'
+
+
+def example_inputs(model, batch_size=2):
+    """
+    Flat example inputs matching `model.forward(sparse_ids, dense_values)`.
+    """
+    sparse_ids = torch.zeros((batch_size, len(model.sparse_feature_names)), dtype=torch.long, device=model.device)
+    dense_values = torch.zeros((batch_size, sum(end - start for start, end in model.dense_index.values())),
+                               dtype=torch.float32, device=model.device)
+    return sparse_ids, dense_values
+
+
+def export_model(model, path, method='trace'):
+    """
+    Save `model` as a standalone TorchScript artifact.
+
+    :param model: A trained `MyBaseModel` (MyDeepFM, MyAFTDeepFM, ...).
+    :param path: String. Output file.
+    :param method: String. "trace" (works for every model) or "script".
+    :return: The TorchScript module.
+    """
+    model = model.eval()
+    with torch.no_grad():
+        if method == 'script':
+            module = torch.jit.script(model)
+        else:
+            module = torch.jit.trace(model, example_inputs(model), check_trace=False)
+    meta = {
+        'sparse_feature_names': model.sparse_feature_names,
+        'dense_feature_names': model.dense_feature_names,
+        'dense_index': model.dense_index,
+    }
+    if getattr(model, 'task_names', None):
+        # 多任务模型的输出列
+        meta['task_names'] = model.task_names
+    torch.jit.save(module, path, _extra_files={META_FILE: json.dumps(meta)})
+    return module
+
+
+def optimize_module(module):
+    """
+    Freeze an eval-mode TorchScript module and apply inference-only graph optimizations.
+    torch.jit.freeze / optimize_for_inference need torch>=1.10, older versions keep the scripted module.
+    """
+    if not hasattr(torch.jit, 'optimize_for_inference'):
+        return module
+    return torch.jit.optimize_for_inference(torch.jit.freeze(module))
+
+
+def load_exported(path, device='cpu', optimize=True):
+    """
+    Load an artifact written by `export_model`.
+
+    :param path: String. File written by `export_model`.
+    :param device: String. Device to map the weights to.
+    :param optimize: Boolean. Freeze and apply inference-only graph optimizations (torch>=1.10).
+    :return: (TorchScript module taking (sparse_ids, dense_values), meta dict of input column names)
+    """
+    extra_files = {META_FILE: ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    module.eval()
+    if optimize:
+        module = optimize_module(module)
+    return module, json.loads(extra_files[META_FILE])
+
+
+def benchmark_latency(models, batch_sizes, num_sparse, num_dense, vocabulary_size, repeat=20, trials=5):
+    """
+    Median milliseconds per forward call of every model at every batch size.
+
+    :param models: List of (name, callable taking (sparse_ids, dense_values)).
+    :return: Dict. name -> {batch_size: ms}
+    """
+    result = {name: {} for name, _ in models}
+    for batch_size in batch_sizes:
+        sparse_ids = torch.randint(0, vocabulary_size, (batch_size, num_sparse), dtype=torch.long)
+        dense_values = torch.rand(batch_size, num_dense)
+        for name, model in models:
+            times = []
+            with torch.no_grad():
+                for _ in range(trials):
+                    for _ in range(3):
+                        model(sparse_ids, dense_values)
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        model(sparse_ids, dense_values)
+                    times.append((time.perf_counter() - start) / repeat * 1000.0)
+            result[name][batch_size] = statistics.median(times)
+    return result
+
+
+if __name__ == "__main__":
+    from baseline import MyAFTDeepFM, MyDeepFM, SparseFeat, DenseFeat, SPARSE_FEATURES, DENSE_FEATURES
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='MyAFTDeepFM', choices=['MyAFTDeepFM', 'MyDeepFM'])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 128, 2000])
+    parser.add_argument('--vocabulary_size', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads, 0 = default')
+    parser.add_argument('--compile', action='store_true', help='also benchmark torch.compile (torch>=2.0)')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    # 延迟与权重无关，用随机初始化的模型测试
+    feature_columns = [SparseFeat(feat, args.vocabulary_size) for feat in SPARSE_FEATURES] + \
+                      [DenseFeat(feat, 1) for feat in DENSE_FEATURES]
+    model_class = MyAFTDeepFM if args.model == 'MyAFTDeepFM' else MyDeepFM
+    model = model_class(linear_feature_columns=feature_columns, dnn_feature_columns=feature_columns,
+                        task='binary').eval()
+    path = os.path.join(tempfile.mkdtemp(), 'model.pt')
+    export_model(model, path)
+    exported, meta = load_exported(path)
+    print('exported to %s, inputs: %s' % (path, meta))
+
+    candidates = [('eager', model), ('torchscript', exported)]
+    if args.compile and hasattr(torch, 'compile'):
+        candidates.append(('compile', torch.compile(model)))
+    latency = benchmark_latency(candidates, args.batch_sizes, len(meta['sparse_feature_names']),
+                                len(meta['dense_feature_names']), args.vocabulary_size)
+    print('%12s' % 'batch_size' + ''.join('%14s' % name for name, _ in candidates) + '   (ms per batch)')
+    for batch_size in args.batch_sizes:
+        print('%12d' % batch_size + ''.join('%14.3f' % latency[name][batch_size] for name, _ in candidates))
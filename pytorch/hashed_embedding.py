@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+高基数id的省内存Embedding
+- QREmbedding: 商余（quotient-remainder）组合哈希，参数量 (V / m + m) * dim
+- MixedDimEmbedding: 按出现频次分块，高频id用宽向量，长尾用窄向量（投影到同一维度）或共享哈希行
+输出维度与nn.Embedding相同，可直接替换MyDeepFM/MyAFTDeepFM中的Embedding表（compress_embeddings）
+
+评估（最后一天为验证集，对比全量Embedding的参数量、查表吞吐和uAUC）:
+  python hashed_embedding.py --action like --mode qr --features userid feedid --num_collisions 4
+  python hashed_embedding.py --action like --mode mixed --features userid feedid --tail_buckets 1000
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class QREmbedding(nn.Module):
+    """
+    Compositional embedding: id -> (id // num_collisions, id % num_collisions), two small tables combined
+    by element-wise product ("mult") or sum ("add"). Each (quotient, remainder) pair is unique, so no two ids
+    share the same vector even though each table is shared by many ids.
+    """
+
+    def __init__(self, num_embeddings, embedding_dim, num_collisions=4, operation='mult', init_std=0.0001):
+        """
+        :param num_embeddings: Integer. Vocabulary size.
+        :param embedding_dim: Integer. Output dimension.
+        :param num_collisions: Integer. Number of ids sharing one quotient row (the remainder table size).
+        :param operation: String. "mult" or "add".
+        :param init_std: Float. Initialization std of the quotient table (and of both tables for "add").
+        """
+        super(QREmbedding, self).__init__()
+        if operation not in ('mult', 'add'):
+            raise ValueError('operation must be "mult" or "add"')
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.num_collisions = num_collisions
+        self.operation = operation
+        self.quotient = nn.Embedding((num_embeddings - 1) // num_collisions + 1, embedding_dim)
+        self.remainder = nn.Embedding(num_collisions, embedding_dim)
+        nn.init.normal_(self.quotient.weight, mean=0, std=init_std)
+        if operation == 'mult':
+            # 乘积时余数表初始化为1，初始向量即商表向量，避免两个小量相乘梯度过小
+            nn.init.ones_(self.remainder.weight)
+        else:
+            nn.init.normal_(self.remainder.weight, mean=0, std=init_std)
+
+    def forward(self, input):
+        quotient = self.quotient(torch.div(input, self.num_collisions, rounding_mode='floor'))
+        remainder = self.remainder(torch.remainder(input, self.num_collisions))
+        if self.operation == 'mult':
+            return quotient * remainder
+        return quotient + remainder
+
+    def extra_repr(self):
+        return '{}, {}, num_collisions={}, operation={}'.format(
+            self.num_embeddings, self.embedding_dim, self.num_collisions, self.operation)
+
+
+class MixedDimEmbedding(nn.Module):
+    """
+    Frequency-based mixed-dimension embedding: ids are sorted by frequency and split into blocks covering
+    `block_coverage` of the occurrences, block b has its own table of dimension `block_dims[b]` projected to
+    `embedding_dim`. The last block (long tail) can be hashed into `tail_buckets` shared rows.
+    """
+
+    def __init__(self, frequencies, embedding_dim, block_dims=(4, 2, 1), block_coverage=(0.5, 0.9),
+                 tail_buckets=None, init_std=0.0001):
+        """
+        :param frequencies: 1-d array. Number of occurrences of every id in the training data, len = vocabulary size.
+        :param embedding_dim: Integer. Output dimension.
+        :param block_dims: Tuple of integers. Dimension of every block, from the most to the least frequent ids
+            (clipped to `embedding_dim`).
+        :param block_coverage: Tuple of floats. Cumulative share of the occurrences covered by each block except the
+            last, len = len(block_dims) - 1.
+        :param tail_buckets: Integer or None. Number of shared rows for the last block (None = one row per id).
+        :param init_std: Float. Initialization std.
+        """
+        super(MixedDimEmbedding, self).__init__()
+        if len(block_coverage) != len(block_dims) - 1:
+            raise ValueError('block_coverage must have len(block_dims) - 1 values')
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        self.num_embeddings = len(frequencies)
+        self.embedding_dim = embedding_dim
+        self.block_dims = tuple(min(dim, embedding_dim) for dim in block_dims)
+
+        # 按频次降序，累计占比落在第b个区间的id属于第b块
+        order = np.argsort(-frequencies, kind='stable')
+        coverage = np.cumsum(frequencies[order]) / max(frequencies.sum(), 1.0)
+        block_of_sorted = np.searchsorted(np.asarray(block_coverage), coverage, side='left')
+        block_of = np.empty(self.num_embeddings, dtype=np.int64)
+        block_of[order] = block_of_sorted
+        row_of = np.empty(self.num_embeddings, dtype=np.int64)
+        block_sizes = []
+        for block in range(len(self.block_dims)):
+            ids = order[block_of_sorted == block]
+            if block == len(self.block_dims) - 1 and tail_buckets:
+                size = min(tail_buckets, max(len(ids), 1))
+                row_of[ids] = ids % size
+                block_sizes.append(size)
+            else:
+                row_of[ids] = np.arange(len(ids))
+                block_sizes.append(max(len(ids), 1))
+        self.register_buffer('block_of', torch.from_numpy(block_of))
+        self.register_buffer('row_of', torch.from_numpy(row_of))
+
+        self.tables = nn.ModuleList([nn.Embedding(size, dim) for size, dim in zip(block_sizes, self.block_dims)])
+        for table in self.tables:
+            nn.init.normal_(table.weight, mean=0, std=init_std)
+        self.projections = nn.ModuleList([nn.Identity() if dim == embedding_dim else
+                                          nn.Linear(dim, embedding_dim, bias=False) for dim in self.block_dims])
+
+    def forward(self, input):
+        flat = input.reshape(-1)
+        block_of = self.block_of[flat]
+        rows = self.row_of[flat]
+        output = torch.zeros((flat.shape[0], self.embedding_dim), dtype=self.tables[0].weight.dtype,
+                             device=flat.device)
+        for block, (table, projection) in enumerate(zip(self.tables, self.projections)):
+            index = torch.nonzero(block_of == block, as_tuple=True)[0]
+            output = output.index_copy(0, index, projection(table(rows[index])))
+        return output.view(input.shape + (self.embedding_dim,))
+
+    def extra_repr(self):
+        return '{}, {}, block_dims={}, block_sizes={}'.format(
+            self.num_embeddings, self.embedding_dim, self.block_dims, [table.num_embeddings for table in self.tables])
+
+
+def compress_embeddings(model, features, mode='qr', frequencies=None, linear=True, **kwargs):
+    """
+    Replace the embedding tables of `features` in a `MyBaseModel` by QR or mixed-dimension embeddings.
+
+    :param model: A `MyBaseModel` (before `compile`, so that the optimizer sees the new parameters).
+    :param features: List of sparse feature names.
+    :param mode: String. "qr" or "mixed".
+    :param frequencies: Dict. feature name -> id counts, required by "mixed".
+    :param linear: Boolean. Also replace the 1-d tables of the linear part.
+    :param kwargs: Arguments of `QREmbedding` / `MixedDimEmbedding`.
+    :return: The model.
+    """
+    embedding_dicts = [model.embedding_dict] + ([model.linear_model.embedding_dict] if linear else [])
+    for embedding_dict in embedding_dicts:
+        for feat in features:
+            table = embedding_dict[feat]
+            if mode == 'qr':
+                module = QREmbedding(table.num_embeddings, table.embedding_dim, **kwargs)
+            elif mode == 'mixed':
+                module = MixedDimEmbedding(frequencies[feat], table.embedding_dim, **kwargs)
+            else:
+                raise ValueError('mode must be "qr" or "mixed"')
+            model.replace_embedding(embedding_dict, feat, module)
+    return model
+
+
+def embedding_parameters(model):
+    """
+    Number of parameters of all embedding modules (dnn and linear part).
+    """
+    return sum(p.numel() for embedding_dict in (model.embedding_dict, model.linear_model.embedding_dict)
+               for p in embedding_dict.parameters())
+
+
+def lookup_throughput(module, ids, repeat=20):
+    """
+    Forward + backward lookups per second of `module` on the id tensor `ids` [N, 1].
+    """
+    times = []
+    for _ in range(3 + repeat):
+        module.zero_grad()
+        start = time.perf_counter()
+        module(ids).sum().backward()
+        times.append(time.perf_counter() - start)
+    return ids.numel() / float(np.median(times[3:]))
+
+
+if __name__ == "__main__":
+    from baseline import ACTION_SAMPLE_RATE, USE_FEED_EMBEDDING, build_model, compile_model, get_feature_columns
+    from prepare_data import SPARSE_FEATURES, load_encoded, load_feed_embedding, load_vocabulary_sizes
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--action', default='read_comment')
+    parser.add_argument('--variant', type=int, default=0, help='baseline.build_model 第x组模型')
+    parser.add_argument('--mode', default='qr', choices=['qr', 'mixed'])
+    parser.add_argument('--features', nargs='+', default=['userid', 'feedid'])
+    parser.add_argument('--num_collisions', type=int, default=4, help='qr')
+    parser.add_argument('--operation', default='mult', choices=['mult', 'add'], help='qr')
+    parser.add_argument('--block_dims', type=int, nargs='+', default=[4, 2, 1], help='mixed')
+    parser.add_argument('--block_coverage', type=float, nargs='+', default=[0.5, 0.9], help='mixed')
+    parser.add_argument('--tail_buckets', type=int, default=None, help='mixed')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--tolerance', type=float, default=0.002, help='allowed uAUC drop')
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads, 0 = default')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    vocabulary_sizes = load_vocabulary_sizes()
+    feature_columns = get_feature_columns(vocabulary_sizes)
+    feed_embedding = load_feed_embedding() if USE_FEED_EMBEDDING else None
+    data = load_encoded('train_data')
+    date = np.asarray(data['date_'])
+    eval_mask = date == date.max()
+    if args.mode == 'qr':
+        options = dict(num_collisions=args.num_collisions, operation=args.operation)
+    else:
+        options = dict(block_dims=tuple(args.block_dims), block_coverage=tuple(args.block_coverage),
+                       tail_buckets=args.tail_buckets)
+    # 频次只统计训练部分
+    frequencies = {feat: np.bincount(np.asarray(data[feat])[~eval_mask], minlength=vocabulary_sizes[feat])
+                   for feat in SPARSE_FEATURES}
+
+    results = {}
+    for name in ('full', args.mode):
+        torch.manual_seed(1024)
+        model = build_model(args.variant, feature_columns, 'cpu', feed_embedding)
+        if name != 'full':
+            compress_embeddings(model, args.features, args.mode, frequencies, **options)
+        model = compile_model(model)
+        model.fit({feat: data[feat] for feat in model.feature_index}, np.asarray(data[args.action]),
+                  negative_rate=1.0 / ACTION_SAMPLE_RATE[args.action], batch_size=args.batch_size, epochs=args.epochs, verbose=1, validation_time=date,
+                  early_stopping_patience=1)
+        uauc = model.evaluate({feat: data[feat][eval_mask] for feat in model.feature_index},
+                              np.asarray(data[args.action][eval_mask]), 2000)['uauc']
+        throughput = {}
+        for feat in args.features:
+            ids = torch.from_numpy(np.asarray(data[feat][:8192], dtype=np.int64)).view(-1, 1)
+            throughput[feat] = lookup_throughput(model.embedding_dict[feat], ids)
+        results[name] = (embedding_parameters(model), uauc, throughput)
+
+    print('%-8s%16s%10s  %s' % ('mode', 'embedding params', 'uAUC', 'lookups/s (forward+backward)'))
+    for name, (params, uauc, throughput) in results.items():
+        print('%-8s%16d%10.5f  %s' % (name, params, uauc, ', '.join(
+            '%s %.0f' % (feat, value) for feat, value in throughput.items())))
+    drop = results['full'][1] - results[args.mode][1]
+    print('parameters x%.3f, uAUC drop %.5f (tolerance %.5f): %s' % (
+        results[args.mode][0] / float(results['full'][0]), drop, args.tolerance,
+        'OK' if drop <= args.tolerance else 'EXCEEDED'))
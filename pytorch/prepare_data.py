@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+# tensorflow/ 和 pytorch/ 共用的模块（pipeline、profiler等）在 ../common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from pipeline import Pipeline, Stage
+from profiler import StageProfiler
+
 
 # 存储数据的根目录
 ROOT_PATH = "../data"
@@ -18,9 +25,22 @@ TEST_FILE = DATASET_PATH + "test_a.csv"
 ACTION_LIST = ["read_comment", "like", "click_avatar", "forward"]
 FEA_COLUMN_LIST = ["read_comment", "like", "click_avatar", "forward", "comment", "follow", "favorite"]
 FEA_FEED_LIST = ['feedid', 'authorid', 'videoplayseconds', 'bgm_song_id', 'bgm_singer_id']
-# 负样本下采样比例(负样本:正样本)
+# 负样本下采样比例(负样本:正样本)：训练时每个epoch按保留率1/rate重新抽取负样本，权重为rate（见../common/sampler.py）
 ACTION_SAMPLE_RATE = {"read_comment": 5, "like": 5, "click_avatar": 5, "forward": 10, "comment": 10, "follow": 10,
                       "favorite": 10}
+# 编码缓存目录：词表、归一化参数和编码后的列
+ENCODED_PATH = ROOT_PATH + '/encoded'
+SPARSE_FEATURES = ['userid', 'feedid', 'authorid', 'bgm_song_id', 'bgm_singer_id']
+DENSE_FEATURES = ['videoplayseconds']
+# feed多模态向量（512维）降维后的维度，按编码后的feedid存为float16表
+FEED_EMBEDDING_DIM = 32
+FEED_EMBEDDING_TABLE = ENCODED_PATH + '/feed_embedding.npy'
+# 各阶段耗时和峰值内存，进程退出时写入 ../data/profile/{脚本名}_{参数}_{时间}.json（见../common/profiler.py）
+PROFILER = StageProfiler(ROOT_PATH + '/profile')
+# 数据处理DAG的状态（各阶段上次运行的key和输出hash，见../common/pipeline.py）
+PIPELINE_STATE = ENCODED_PATH + '/pipeline_state.json'
+# 编码的数据集（ROOT_PATH下的csv -> ENCODED_PATH下的同名目录）
+DATASETS = ['train_data', 'test_data']
 
 def process_embed(train):
     feed_embed_array = np.zeros((train.shape[0], 512))
@@ -35,25 +55,161 @@ def process_embed(train):
     train = pd.concat((train, temp), axis=1)
     return train
 
+@PROFILER.profiled()
 def prepare_data():
     feed_info_df = pd.read_csv(FEED_INFO)
     user_action_df = pd.read_csv(USER_ACTION)[["userid", "date_", "feedid"] + FEA_COLUMN_LIST]
-    feed_embed = pd.read_csv(FEED_EMBEDDINGS)
     test = pd.read_csv(TEST_FILE)
     # add feed feature
     train = pd.merge(user_action_df, feed_info_df[FEA_FEED_LIST], on='feedid', how='left')
     test = pd.merge(test, feed_info_df[FEA_FEED_LIST], on='feedid', how='left')
     test["videoplayseconds"] = np.log(test["videoplayseconds"] + 1.0)
     test.to_csv(ROOT_PATH + f'/test_data.csv', index=False)
-    for action in tqdm(ACTION_LIST):
-        print(f"prepare data for {action}")
-        tmp = train.drop_duplicates(['userid', 'feedid', action], keep='last')
-        df_neg = tmp[tmp[action] == 0]
-        df_neg = df_neg.sample(frac=1.0 / ACTION_SAMPLE_RATE[action], random_state=42, replace=False)
-        df_all = pd.concat([df_neg, tmp[tmp[action] == 1]])
-        df_all["videoplayseconds"] = np.log(df_all["videoplayseconds"] + 1.0)
-        df_all.to_csv(ROOT_PATH + f'/train_data_for_{action}.csv', index=False)
+    # 训练集只存一份：(userid, feedid)去重后的全部样本和所有行为标签，负样本在训练时按epoch抽取
+    train = train.drop_duplicates(['userid', 'feedid'], keep='last').reset_index(drop=True)
+    train["videoplayseconds"] = np.log(train["videoplayseconds"] + 1.0)
+    train.to_csv(ROOT_PATH + '/train_data.csv', index=False)
+
+
+def read_feed_embeddings():
+    """
+    :return: (int64 array of feedids [num_feeds], float32 array of vectors [num_feeds, 512])
+    """
+    feed_embed = pd.read_csv(FEED_EMBEDDINGS)
+    vectors = np.stack([np.fromstring(str(x), dtype=np.float32, sep=' ') for x in feed_embed['feed_embedding']])
+    return feed_embed['feedid'].values.astype(np.int64), vectors
+
+
+@PROFILER.profiled()
+def compress_feed_embeddings(k=FEED_EMBEDDING_DIM, method='pca'):
+    """
+    在所有feed的512维向量上拟合一次PCA/随机投影，保存 [feedid词表大小, k] 的float16表（行号为编码后的feedid，
+    没有向量的feed为0），模型按feedid查表作为固定的dense输入，不需要在每条样本上存512维向量
+    :param k: Integer. 降维后的维度
+    :param method: String. "pca" or "random_projection"
+    """
+    from sklearn.decomposition import PCA
+    from sklearn.random_projection import GaussianRandomProjection
+
+    feedids, vectors = read_feed_embeddings()
+    if method == 'pca':
+        projection = PCA(n_components=k, random_state=42)
+    else:
+        projection = GaussianRandomProjection(n_components=k, random_state=42)
+    projected = projection.fit_transform(vectors)
+    # 整体缩放到单位标准差，float16下保持精度
+    projected = projected / max(float(projected.std()), 1e-12)
+
+    vocab = np.load(ENCODED_PATH + '/vocab_feedid.npy')
+    position = np.searchsorted(vocab, feedids)
+    found = (position < len(vocab)) & (vocab[np.minimum(position, len(vocab) - 1)] == feedids)
+    table = np.zeros((len(vocab), k), dtype=np.float16)
+    table[position[found]] = projected[found]
+    np.save(FEED_EMBEDDING_TABLE, table)
+    print(f'feed embedding table {table.shape} ({method}) saved to {FEED_EMBEDDING_TABLE}')
+
+
+def load_feed_embedding():
+    """
+    :return: float16 array [feedid vocabulary size, k]
+    """
+    return np.load(FEED_EMBEDDING_TABLE)
+
+
+@PROFILER.profiled()
+def encode_data():
+    """
+    一次性编码：在所有行为的训练集和测试集上拟合离散特征词表和连续特征归一化参数，
+    保存为数组，并把每个数据集编码为int32/float32列，供各行为、各模型复用（np.load mmap）
+    """
+    frames = {}
+    for name in DATASETS:
+        df = pd.read_csv(ROOT_PATH + f'/{name}.csv')
+        if name != 'test_data':
+            # 与原先各行为的打乱方式一致，validation_split取最后的样本
+            df = df.sample(frac=1, random_state=42).reset_index(drop=True)
+        df[SPARSE_FEATURES] = df[SPARSE_FEATURES].fillna(0).astype(np.int64)
+        df[DENSE_FEATURES] = df[DENSE_FEATURES].fillna(0)
+        frames[name] = df
+
+    os.makedirs(ENCODED_PATH, exist_ok=True)
+    # 1.Label Encoding词表：所有数据集上的取值并集
+    vocabs = {}
+    for feat in SPARSE_FEATURES:
+        vocabs[feat] = np.unique(np.concatenate([np.unique(df[feat].values) for df in frames.values()]))
+        np.save(ENCODED_PATH + f'/vocab_{feat}.npy', vocabs[feat])
+    # 2.MinMax归一化参数
+    scalers = {}
+    for feat in DENSE_FEATURES:
+        scalers[feat] = np.array([min(df[feat].min() for df in frames.values()),
+                                  max(df[feat].max() for df in frames.values())], dtype=np.float64)
+        np.save(ENCODED_PATH + f'/scaler_{feat}.npy', scalers[feat])
+
+    # 3.编码并按列保存
+    for name, df in tqdm(frames.items()):
+        out_dir = ENCODED_PATH + f'/{name}'
+        os.makedirs(out_dir, exist_ok=True)
+        for feat in SPARSE_FEATURES:
+            np.save(out_dir + f'/{feat}.npy', np.searchsorted(vocabs[feat], df[feat].values).astype(np.int32))
+        for feat in DENSE_FEATURES:
+            low, high = scalers[feat]
+            scale = high - low if high > low else 1.0
+            np.save(out_dir + f'/{feat}.npy', ((df[feat].values - low) / scale).astype(np.float32))
+        for col in ACTION_LIST + ['date_']:
+            if col in df.columns:
+                np.save(out_dir + f'/{col}.npy', df[col].values.astype(np.int8))
+
+
+def load_vocabulary_sizes():
+    """
+    读取离散特征词表大小
+    :return: Dict. feature name -> vocabulary size
+    """
+    return {feat: np.load(ENCODED_PATH + f'/vocab_{feat}.npy', mmap_mode='r').shape[0] for feat in SPARSE_FEATURES}
+
+
+def load_encoded(name):
+    """
+    以内存映射方式读取编码后的数据集
+    :param name: String. 数据集名称，train_data/test_data
+    :return: Dict. column name -> np.memmap
+    """
+    data_dir = ENCODED_PATH + f'/{name}'
+    return {file[:-len('.npy')]: np.load(os.path.join(data_dir, file), mmap_mode='r')
+            for file in os.listdir(data_dir) if file.endswith('.npy')}
+
+
+def build_pipeline(workers=1):
+    """
+    数据处理DAG：样本集 -> 编码 -> feed向量表，输入文件、参数或代码没有改变且输出完好的阶段跳过
+    （负采样在训练时进行，ACTION_SAMPLE_RATE不影响任何阶段）
+    :param workers: Int. 并发运行的阶段数
+    :return: Pipeline
+    """
+    csv_files = [ROOT_PATH + f'/{name}.csv' for name in DATASETS]
+    vocab_feedid = ENCODED_PATH + '/vocab_feedid.npy'
+    stages = [
+        Stage('prepare_data', prepare_data, inputs=[USER_ACTION, FEED_INFO, TEST_FILE], outputs=csv_files,
+              params={'FEA_COLUMN_LIST': FEA_COLUMN_LIST, 'FEA_FEED_LIST': FEA_FEED_LIST}),
+        Stage('encode_data', encode_data, inputs=csv_files,
+              outputs=[ENCODED_PATH + f'/vocab_{feat}.npy' for feat in SPARSE_FEATURES] +
+                      [ENCODED_PATH + f'/scaler_{feat}.npy' for feat in DENSE_FEATURES] +
+                      [ENCODED_PATH + f'/{name}' for name in DATASETS],
+              params={'SPARSE_FEATURES': SPARSE_FEATURES, 'DENSE_FEATURES': DENSE_FEATURES, 'ACTION_LIST': ACTION_LIST}),
+        Stage('compress_feed_embeddings', compress_feed_embeddings, inputs=[FEED_EMBEDDINGS, vocab_feedid],
+              outputs=[FEED_EMBEDDING_TABLE], kwargs={'k': FEED_EMBEDDING_DIM}),
+    ]
+    return Pipeline(stages, PIPELINE_STATE, workers, PROFILER)
 
 
 if __name__ == "__main__":
-    prepare_data()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'status'])
+    parser.add_argument('--force', nargs='+', default=[], help='stages to rerun even if up to date')
+    args = parser.parse_args()
+    pipeline = build_pipeline()
+    if args.command == 'status':
+        pipeline.status()
+    else:
+        print('Ran stages:', pipeline.run(force=args.force))
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+训练后量化（CPU推理）
+- nn.Linear（AFT层q/k/v/project、aft_linear、DNN）：动态int8量化，权重int8，激活按batch动态量化
+- Embedding表：按行8bit量化，每行一个float16 scale/offset
+
+评估（最后一天为evaluate集，其余天训练）：
+  python quantize.py --variant 0 --epochs 1
+输出每个行为 fp32 / 仅Linear / 仅Embedding / 全部量化 的uAUC、uAUC下降、推理耗时、模型大小
+"""
+import argparse
+import copy
+import io
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+# 动态量化接口在torch>=1.10位于torch.ao.quantization
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    from torch.quantization import quantize_dynamic
+
+
+class RowwiseInt8Embedding(nn.Module):
+    """
+    Embedding table stored as uint8 with one (scale, offset) pair per row:
+    weight[i] ~= qweight[i] * scale[i] + offset[i].
+    """
+
+    def __init__(self, num_embeddings, embedding_dim):
+        super(RowwiseInt8Embedding, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.register_buffer('qweight', torch.zeros((num_embeddings, embedding_dim), dtype=torch.uint8))
+        self.register_buffer('scale', torch.ones((num_embeddings, 1), dtype=torch.float16))
+        self.register_buffer('offset', torch.zeros((num_embeddings, 1), dtype=torch.float16))
+
+    @classmethod
+    def from_float(cls, embedding):
+        """
+        :param embedding: A trained `nn.Embedding`.
+        :return: The row-wise 8-bit quantized copy.
+        """
+        weight = embedding.weight.detach().float().cpu()
+        module = cls(weight.shape[0], weight.shape[1])
+        low = weight.min(dim=1, keepdim=True).values.half().float()
+        high = weight.max(dim=1, keepdim=True).values
+        scale = ((high - low) / 255.0).clamp_min(1e-8).half().float()
+        module.qweight.copy_(torch.round((weight - low) / scale).clamp(0, 255).to(torch.uint8))
+        module.scale.copy_(scale.half())
+        module.offset.copy_(low.half())
+        return module
+
+    def forward(self, input):
+        return self.qweight[input].float() * self.scale[input].float() + self.offset[input].float()
+
+    def extra_repr(self):
+        return '{}, {}'.format(self.num_embeddings, self.embedding_dim)
+
+
+def quantize_model(model, linear=True, embedding=True, min_embedding_dim=2):
+    """
+    Post-training quantized copy of a `MyBaseModel` for CPU inference. `predict` and `export_model` work as before.
+
+    :param model: A trained `MyBaseModel`.
+    :param linear: Boolean. Dynamic int8 quantization of every `nn.Linear`.
+    :param embedding: Boolean. Row-wise 8-bit quantization of the embedding tables.
+    :param min_embedding_dim: Integer. Tables with a smaller dimension stay fp32
+        (the linear part's 1-d tables would grow: 1 byte + 4 bytes scale/offset > 4 bytes).
+    :return: The quantized model, on cpu.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    model.device = 'cpu'
+    if embedding:
+        for embedding_dict in (model.embedding_dict, model.linear_model.embedding_dict):
+            for name, table in embedding_dict.items():
+                if isinstance(table, nn.Embedding) and table.embedding_dim >= min_embedding_dim:
+                    embedding_dict[name] = RowwiseInt8Embedding.from_float(table)
+    if linear:
+        model = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def model_size(model):
+    """
+    Serialized size of the state dict in bytes (packed int8 weights included).
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def predict_latency(model, x, batch_size, trials=3):
+    """
+    :return: (predictions of the last trial, median seconds of one `predict` over x)
+    """
+    times = []
+    for _ in range(trials):
+        start = time.perf_counter()
+        pred = model.predict(x, batch_size)
+        times.append(time.perf_counter() - start)
+    return pred, float(np.median(times))
+
+
+if __name__ == "__main__":
+    from baseline import ACTION_LIST, ACTION_SAMPLE_RATE, USE_FEED_EMBEDDING, build_model, compile_model, \
+        get_feature_columns
+    from evaluation import uAUC
+    from prepare_data import load_encoded, load_feed_embedding, load_vocabulary_sizes
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', type=int, default=0, help='baseline.build_model 第x组模型')
+    parser.add_argument('--actions', nargs='+', default=ACTION_LIST)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--predict_batch_size', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads, 0 = default')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    feature_columns = get_feature_columns(load_vocabulary_sizes())
+    feed_embedding = load_feed_embedding() if USE_FEED_EMBEDDING else None
+    rows = []
+    data = load_encoded('train_data')
+    date = np.asarray(data['date_'])
+    train_mask = date < date.max()
+    for action in args.actions:
+        model = compile_model(build_model(args.variant, feature_columns, 'cpu', feed_embedding))
+        model.fit({name: data[name][train_mask] for name in model.feature_index},
+                  np.asarray(data[action][train_mask], dtype=np.float32).reshape(-1, 1),
+                  negative_rate=1.0 / ACTION_SAMPLE_RATE[action], batch_size=args.batch_size, epochs=args.epochs, verbose=1)
+
+        eval_mask = ~train_mask
+        eval_input = model._typed_inputs({name: data[name][eval_mask] for name in model.feature_index})
+        labels = np.asarray(data[action][eval_mask])
+        users = np.asarray(data['userid'][eval_mask])
+        modes = [('fp32', model),
+                 ('int8 linear', quantize_model(model, embedding=False)),
+                 ('int8 embedding', quantize_model(model, linear=False)),
+                 ('int8 all', quantize_model(model))]
+        base_auc = None
+        for mode, m in modes:
+            pred, seconds = predict_latency(m, eval_input, args.predict_batch_size)
+            auc = uAUC(labels, pred.reshape(-1), users)
+            base_auc = auc if base_auc is None else base_auc
+            rows.append((action, mode, auc, base_auc - auc, seconds / len(labels) * 1e6, model_size(m) / 2 ** 20))
+
+    print('%-14s%-16s%10s%12s%16s%12s' % ('action', 'mode', 'uAUC', 'uAUC drop', 'us / sample', 'size MB'))
+    for row in rows:
+        print('%-14s%-16s%10.5f%12.5f%16.2f%12.3f' % row)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+并行训练baseline.py的多组模型（build_model第x组）并融合预测
+- 编码后的训练集/测试集在父进程读取一次，放在共享内存中，worker进程按 (模型组, 行为) 取任务并行训练
+- 每个任务完成后写入 {out_dir}/{action}_{x}.npz（验证集预测、测试集预测、验证uAUC），
+  中断后重新运行只训练缺少结果的任务
+- 所有任务完成后逐模型流式累加预测，生成一个融合提交文件：
+  rank: 各模型预测的排序分位数等权平均；weighted: 在验证集上按uAUC贪心选择模型（可重复选择）得到权重，对概率加权平均
+
+  python run_variants.py --variants 0 1 2 3 --nproc 2 --method weighted
+"""
+import argparse
+import os
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from scipy.stats import rankdata
+
+from baseline import ACTION_LIST, ACTION_SAMPLE_RATE, MODEL_PATH, ROOT_PATH, USE_FEED_EMBEDDING, build_model, \
+    compile_model, get_feature_columns
+from batch_loader import ModelInputs
+from evaluation import uAUC
+from prepare_data import load_encoded, load_feed_embedding, load_vocabulary_sizes
+
+
+def result_path(out_dir, action, x):
+    return os.path.join(out_dir, '{}_{}.npz'.format(action, x))
+
+
+def share_datasets(actions):
+    """
+    Encode the training set (shared by every action) and the test set once, as shared memory tensors.
+
+    :return: (dict action -> [sparse, dense, y, date], [test sparse, test dense])
+    """
+    model = build_model(0, get_feature_columns(load_vocabulary_sizes()), 'cpu')
+
+    def shared(*arrays):
+        return [torch.from_numpy(np.ascontiguousarray(array)).share_memory_() for array in arrays]
+
+    # 所有行为共用一份特征，负样本在训练时按行为抽取
+    data = load_encoded('train_data')
+    x = model._typed_inputs({name: data[name] for name in model.feature_index})
+    sparse, dense, date = shared(x.sparse, x.dense, np.asarray(data['date_'], dtype=np.int64))
+    train = {action: [sparse, dense] + shared(model._typed_target(data[action])) + [date] for action in actions}
+    data = load_encoded('test_data')
+    test = model._typed_inputs({name: data[name] for name in model.feature_index})
+    return train, shared(test.sparse, test.dense)
+
+
+def train_job(x, action, train, test, args):
+    """
+    Train variant `x` on `action` (the last day is the validation set, early stopping on its uAUC)
+    and write the validation / test predictions to `result_path`.
+    """
+    sparse, dense, y, date = [tensor.numpy() for tensor in train]
+    feed_embedding = load_feed_embedding() if USE_FEED_EMBEDDING else None
+    model = compile_model(build_model(x, get_feature_columns(load_vocabulary_sizes()), 'cpu', feed_embedding))
+    model.fit(ModelInputs(sparse, dense), y, negative_rate=1.0 / ACTION_SAMPLE_RATE[action], batch_size=args.batch_size,
+              epochs=args.epochs, verbose=args.verbose, validation_time=date, early_stopping_patience=1)
+
+    val_mask = date == date.max()
+    val_pred = model.predict(ModelInputs(sparse[val_mask], dense[val_mask]), 2000).reshape(-1)
+    val_uauc = uAUC(y[val_mask].reshape(-1), val_pred, sparse[val_mask, model.sparse_index['userid']])
+    test_pred = model.predict(ModelInputs(*[tensor.numpy() for tensor in test]), 2000).reshape(-1)
+    # 先写临时文件再改名，中断时不会留下不完整的结果
+    path = result_path(args.out_dir, action, x)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, val_pred=val_pred, test_pred=test_pred, val_uauc=val_uauc)
+    os.replace(path + '.tmp', path)
+    return val_uauc
+
+
+def worker(index, jobs, train, test, args):
+    """
+    Worker process: take (x, action) jobs from the queue until it gets None. A failed job is reported and skipped.
+    """
+    torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // args.nproc))
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        x, action = job
+        start_time = time.time()
+        try:
+            val_uauc = train_job(x, action, train[action], test, args)
+            print('[worker {}] variant {} {}: val uAUC {:.5f}, {:.0f}s'.format(
+                index, x, action, val_uauc, time.time() - start_time))
+        except Exception:
+            print('[worker {}] variant {} {} failed:\n{}'.format(index, x, action, traceback.format_exc()))
+
+
+def ensemble_weights(val_preds, labels, users, rounds=20):
+    """
+    Greedy ensemble selection with replacement: every round adds the model that maximizes the validation uAUC
+    of the averaged predictions.
+
+    :param val_preds: Dict. variant -> validation predictions.
+    :return: Dict. variant -> weight (number of selections / rounds).
+    """
+    counts = dict.fromkeys(val_preds, 0)
+    total = np.zeros(len(labels), dtype=np.float64)
+    for step in range(1, rounds + 1):
+        scores = {x: uAUC(labels, (total + pred) / step, users) for x, pred in val_preds.items()}
+        best = max(scores, key=scores.get)
+        counts[best] += 1
+        total += val_preds[best]
+    return {x: count / float(rounds) for x, count in counts.items()}
+
+
+def blend(variants, actions, out_dir, method='rank', rounds=20):
+    """
+    Blend the test predictions of every variant into one submission, reading one variant at a time.
+
+    :param method: String. "rank" (equal-weight average of rank quantiles) or "weighted" (probabilities weighted
+        by `ensemble_weights` on the validation set).
+    :return: DataFrame. userid, feedid and one column per action.
+    """
+    submit = pd.read_csv(ROOT_PATH + '/test_data.csv')[['userid', 'feedid']]
+    for action in actions:
+        weights = dict.fromkeys(variants, 1.0 / len(variants))
+        if method == 'weighted':
+            data = load_encoded('train_data')
+            date = np.asarray(data['date_'])
+            val_mask = date == date.max()
+            val_preds = {}
+            for x in variants:
+                with np.load(result_path(out_dir, action, x)) as result:
+                    val_preds[x] = result['val_pred']
+            weights = ensemble_weights(val_preds, np.asarray(data[action])[val_mask],
+                                       np.asarray(data['userid'])[val_mask], rounds)
+        blended = np.zeros(len(submit), dtype=np.float64)
+        for x, weight in weights.items():
+            if weight == 0:
+                continue
+            with np.load(result_path(out_dir, action, x)) as result:
+                pred = result['test_pred']
+            if method == 'rank':
+                pred = rankdata(pred) / len(pred)
+            blended += weight * pred
+        submit[action] = blended
+        print('{}: weights {}'.format(action, ', '.join('{}={:.2f}'.format(x, w) for x, w in weights.items())))
+    return submit
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variants', type=int, nargs='+', default=[0, 1, 2, 3], help='baseline.build_model 第x组模型')
+    parser.add_argument('--actions', nargs='+', default=ACTION_LIST)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--nproc', type=int, default=2, help='parallel worker processes')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads per process, 0 = cpu_count / nproc')
+    parser.add_argument('--verbose', type=int, default=0)
+    parser.add_argument('--out_dir', default=MODEL_PATH + '/variants')
+    parser.add_argument('--restart', action='store_true', help='ignore finished results and train every job')
+    parser.add_argument('--method', default='rank', choices=['rank', 'weighted'])
+    parser.add_argument('--rounds', type=int, default=20, help='weighted: greedy selection rounds')
+    parser.add_argument('--submit', default='./submit_blend.csv')
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    jobs = [(x, action) for x in args.variants for action in args.actions
+            if args.restart or not os.path.exists(result_path(args.out_dir, action, x))]
+    print('{} of {} jobs to train'.format(len(jobs), len(args.variants) * len(args.actions)))
+    if jobs:
+        train, test = share_datasets(sorted(set(action for _, action in jobs)))
+        ctx = mp.get_context('spawn')
+        queue = ctx.SimpleQueue()
+        for job in jobs:
+            queue.put(job)
+        for _ in range(args.nproc):
+            queue.put(None)
+        workers = [ctx.Process(target=worker, args=(i, queue, train, test, args))
+                   for i in range(min(args.nproc, len(jobs)))]
+        for p in workers:
+            p.start()
+        for p in workers:
+            p.join()
+
+    missing = [(x, action) for x in args.variants for action in args.actions
+               if not os.path.exists(result_path(args.out_dir, action, x))]
+    if missing:
+        raise SystemExit('unfinished jobs {}, run again to resume'.format(missing))
+    blend(args.variants, args.actions, args.out_dir, args.method, args.rounds).to_csv(args.submit, index=False)
+    print('Save to: {}'.format(args.submit))
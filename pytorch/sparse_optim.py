@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Embedding表的稀疏梯度优化器
+一个batch只涉及词表中很少的行，稀疏梯度 + 按行更新的优化器使每步耗时与词表大小无关
+- LazyAdamW: 只更新本batch出现的行的一/二阶矩和权重（含解耦weight decay）
+- RowWiseAdagrad: 每行一个累加量，优化器状态为 [vocabulary_size] 而不是 [vocabulary_size, dim]
+- CombinedOptimizer: Embedding表用稀疏优化器，其余参数用dense AdamW
+
+基准: python sparse_optim.py --vocabulary_sizes 10000 100000 1000000
+"""
+import argparse
+import statistics
+import time
+
+import torch
+from torch.optim import Optimizer
+
+
+class LazyAdamW(Optimizer):
+    """
+    AdamW for sparse gradients (`nn.Embedding(sparse=True)`): moments, bias correction steps and decoupled weight
+    decay are applied only to the rows present in the gradient.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.0):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super(LazyAdamW, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if not p.grad.is_sparse:
+                    raise RuntimeError('LazyAdamW expects sparse gradients, use nn.Embedding(sparse=True)')
+                grad = p.grad.coalesce()
+                rows, values = grad._indices()[0], grad._values()
+                if rows.numel() == 0:
+                    continue
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+                state['step'] += 1
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
+
+                exp_avg = state['exp_avg'][rows].mul_(beta1).add_(values, alpha=1 - beta1)
+                exp_avg_sq = state['exp_avg_sq'][rows].mul_(beta2).addcmul_(values, values, value=1 - beta2)
+                state['exp_avg'].index_copy_(0, rows, exp_avg)
+                state['exp_avg_sq'].index_copy_(0, rows, exp_avg_sq)
+
+                update = (exp_avg / bias_correction1) / (exp_avg_sq / bias_correction2).sqrt_().add_(group['eps'])
+                if group['weight_decay'] != 0:
+                    update.add_(p[rows], alpha=group['weight_decay'])
+                p.index_add_(0, rows, update, alpha=-group['lr'])
+        return loss
+
+
+class RowWiseAdagrad(Optimizer):
+    """
+    Adagrad for sparse gradients with one accumulator per row (mean of the squared gradient over the row),
+    the optimizer state is 1 / dim of the table. Weight decay is L2 on the rows present in the gradient.
+    """
+
+    def __init__(self, params, lr=1e-2, eps=1e-10, weight_decay=0.0, initial_accumulator_value=0.0):
+        defaults = dict(lr=lr, eps=eps, weight_decay=weight_decay, initial_accumulator_value=initial_accumulator_value)
+        super(RowWiseAdagrad, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if not p.grad.is_sparse:
+                    raise RuntimeError('RowWiseAdagrad expects sparse gradients, use nn.Embedding(sparse=True)')
+                grad = p.grad.coalesce()
+                rows, values = grad._indices()[0], grad._values()
+                if rows.numel() == 0:
+                    continue
+                state = self.state[p]
+                if len(state) == 0:
+                    state['sum'] = torch.full((p.shape[0],), group['initial_accumulator_value'],
+                                              dtype=p.dtype, device=p.device)
+                if group['weight_decay'] != 0:
+                    values = values.add(p[rows], alpha=group['weight_decay'])
+                state['sum'].index_add_(0, rows, values.pow(2).mean(dim=1))
+                std = state['sum'][rows].sqrt_().add_(group['eps']).unsqueeze(1)
+                p.index_add_(0, rows, values / std, alpha=-group['lr'])
+        return loss
+
+
+class CombinedOptimizer(object):
+    """
+    Several optimizers over disjoint parameters, used as one (`zero_grad`, `step`, `state_dict`, `param_groups`).
+    """
+
+    def __init__(self, *optimizers):
+        self.optimizers = [optimizer for optimizer in optimizers if optimizer is not None]
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def zero_grad(self, set_to_none=True):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def step(self, closure=None):
+        loss = closure() if closure is not None else None
+        for optimizer in self.optimizers:
+            optimizer.step()
+        return loss
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+SPARSE_OPTIMIZERS = {'lazy_adamw': LazyAdamW, 'rowwise_adagrad': RowWiseAdagrad}
+
+
+def state_bytes(optimizer):
+    """
+    Memory of the optimizer state tensors in bytes.
+    """
+    return sum(value.numel() * value.element_size() for state in optimizer.state.values()
+               for value in state.values() if torch.is_tensor(value))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vocabulary_sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--dim', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads, 0 = default')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    candidates = [
+        ('AdamW dense', False, lambda params: torch.optim.AdamW(params, lr=1e-3, weight_decay=1e-4)),
+        ('LazyAdamW', True, lambda params: LazyAdamW(params, lr=1e-3, weight_decay=1e-4)),
+        ('RowWiseAdagrad', True, lambda params: RowWiseAdagrad(params, lr=1e-2, weight_decay=1e-4)),
+    ]
+    print('embedding dim=%d batch=%d, backward+step ms / optimizer state MB' % (args.dim, args.batch_size))
+    print('%12s' % 'vocabulary' + ''.join('%24s' % name for name, _, _ in candidates))
+    for vocabulary_size in args.vocabulary_sizes:
+        row = '%12d' % vocabulary_size
+        for name, sparse, build in candidates:
+            embedding = torch.nn.Embedding(vocabulary_size, args.dim, sparse=sparse)
+            optimizer = build(embedding.parameters())
+            times = []
+            for _ in range(args.steps):
+                ids = torch.randint(0, vocabulary_size, (args.batch_size, 1))
+                start = time.perf_counter()
+                optimizer.zero_grad()
+                embedding(ids).sum().backward()
+                optimizer.step()
+                times.append((time.perf_counter() - start) * 1000.0)
+            row += '%14.3f /%7.2f' % (statistics.median(times), state_bytes(optimizer) / 2 ** 20)
+        print(row)
@@ -0,0 +1,339 @@
+# coding: utf-8
+"""
+基于feed_embeddings.csv的近似最近邻召回（纯NumPy的IVF-PQ，内积/余弦相似度）
+- 向量L2归一化后，粗聚类（k-means，nlist个倒排表）+ 残差乘积量化（M个子空间，每个256个码字，每个向量M字节）
+- 查询：每个query计算一次与粗聚类中心的内积和PQ查找表 [M, 256]，只扫描nprobe个倒排表，
+  候选得分 = 中心内积 + 查表求和；可选用float16原向量对前 refine*k 个候选精排
+- 保存为目录下的.npy文件，np.load(mmap_mode='r') 加载
+- 用户query向量：用户最近互动过的feed向量按时间衰减加权平均（user_action）
+
+  python ann_index.py build                              # 建索引，写入data/feature/ann_index
+  python ann_index.py benchmark --k 100 --nprobe 1 4 16  # 与暴力检索对比Recall@K和QPS
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from comm import ROOT_PATH, USER_ACTION, FEA_COLUMN_LIST, SEED, read_feed_embeddings
+
+ANN_INDEX_PATH = os.path.join(ROOT_PATH, "feature", "ann_index")
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def kmeans(x, k, iterations=10, max_samples=None, seed=SEED, chunk_size=8192):
+    '''
+    Lloyd k-means（平方欧氏距离），空簇重新取随机样本
+    :param x: float32 array [N, d]
+    :param max_samples: Int or None. 训练时最多使用的样本数
+    :return: float32 array of centroids [k, d]
+    '''
+    rng = np.random.RandomState(seed)
+    if max_samples is not None and len(x) > max_samples:
+        x = x[rng.choice(len(x), max_samples, replace=False)]
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+    for _ in range(iterations):
+        assign = assign_nearest(x, centroids, chunk_size)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids = sums / np.maximum(counts, 1)[:, None]
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()))]
+    return centroids.astype(np.float32)
+
+
+def assign_nearest(x, centroids, chunk_size=8192):
+    '''
+    :return: int64 array [N], 每个向量最近的中心
+    '''
+    half_norm = 0.5 * np.sum(centroids ** 2, axis=1)
+    return np.concatenate([np.argmax(x[i:i + chunk_size] @ centroids.T - half_norm, axis=1)
+                           for i in range(0, len(x), chunk_size)]) if len(x) else np.zeros(0, dtype=np.int64)
+
+
+class IVFPQIndex(object):
+    '''
+    倒排文件 + 乘积量化索引，数组按倒排表顺序存放：第l个表为 [offsets[l], offsets[l+1])
+    '''
+
+    ARRAYS = ["centroids", "codebooks", "codes", "ids", "offsets", "vectors"]
+
+    def __init__(self, centroids, codebooks, codes, ids, offsets, vectors=None):
+        '''
+        :param centroids: float32 [nlist, d]
+        :param codebooks: float32 [M, ksub, d / M]
+        :param codes: uint8 [N, M]
+        :param ids: int64 [N] feedid
+        :param offsets: int64 [nlist + 1]
+        :param vectors: float16 [N, d] 归一化原向量（精排用）或None
+        '''
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.codes = codes
+        self.ids = ids
+        self.offsets = offsets
+        self.vectors = vectors
+        self.nlist, self.dim = centroids.shape
+        self.num_subspaces = codebooks.shape[0]
+        self._position = None
+
+    @classmethod
+    def build(cls, ids, vectors, nlist=0, num_subspaces=32, ksub=256, iterations=10, keep_vectors=True):
+        '''
+        :param ids: int array [N]
+        :param vectors: float array [N, d]，d需能被num_subspaces整除
+        :param nlist: Int. 倒排表个数，0为 4 * sqrt(N)
+        :param ksub: Int. 每个子空间的码字个数（<=256）
+        :param keep_vectors: Boolean. 保存float16原向量用于精排
+        '''
+        vectors = normalize(vectors)
+        n, dim = vectors.shape
+        if dim % num_subspaces:
+            raise ValueError("dim %d is not a multiple of num_subspaces %d" % (dim, num_subspaces))
+        nlist = min(nlist or max(1, int(4 * np.sqrt(n))), n)
+        ksub = min(ksub, 256, n)
+        centroids = kmeans(vectors, nlist, iterations, max_samples=64 * nlist)
+        assign = assign_nearest(vectors, centroids)
+
+        # 残差按子空间分别训练码本并编码
+        residuals = vectors - centroids[assign]
+        dsub = dim // num_subspaces
+        codebooks = np.zeros((num_subspaces, ksub, dsub), dtype=np.float32)
+        codes = np.zeros((n, num_subspaces), dtype=np.uint8)
+        for m in range(num_subspaces):
+            sub = np.ascontiguousarray(residuals[:, m * dsub:(m + 1) * dsub])
+            codebooks[m] = kmeans(sub, ksub, iterations, max_samples=64 * ksub, seed=SEED + m)
+            codes[:, m] = assign_nearest(sub, codebooks[m])
+
+        order = np.argsort(assign, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+        return cls(centroids, codebooks, codes[order], np.asarray(ids, dtype=np.int64)[order], offsets,
+                   vectors[order].astype(np.float16) if keep_vectors else None)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            if getattr(self, name) is not None:
+                np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"nlist": self.nlist, "dim": self.dim, "num_subspaces": self.num_subspaces,
+                       "num_vectors": len(self.ids)}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        arrays = {}
+        for name in cls.ARRAYS:
+            file = os.path.join(path, name + ".npy")
+            arrays[name] = np.load(file, mmap_mode=mmap_mode) if os.path.exists(file) else None
+        return cls(**arrays)
+
+    def vectors_of(self, feed_ids):
+        '''
+        :return: float32 [len(feed_ids), d] 归一化向量（需要keep_vectors），不在索引中的feed为0
+        '''
+        if self._position is None:
+            position = np.full(int(self.ids.max()) + 2, len(self.ids), dtype=np.int64)
+            position[self.ids] = np.arange(len(self.ids))
+            self._position = position
+        feed_ids = np.asarray(feed_ids, dtype=np.int64)
+        rows = np.take(self._position, feed_ids, mode="clip")
+        rows = np.where((feed_ids >= 0) & (feed_ids < len(self._position) - 1), rows, len(self.ids))
+        known = rows < len(self.ids)
+        result = np.zeros((len(feed_ids), self.dim), dtype=np.float32)
+        result[known] = self.vectors[rows[known]]
+        return result
+
+    def search(self, queries, k=100, nprobe=8, refine=0, exclude=None):
+        '''
+        批量top-K检索（内积）
+        :param queries: float array [B, d]（内部归一化）
+        :param nprobe: Int. 每个query扫描的倒排表个数
+        :param refine: Int. >0时对PQ得分前 refine * k 个候选用原向量精排
+        :param exclude: List of int arrays or None. 每个query需要排除的feedid（如已看过的feed）
+        :return: (int64 ids [B, k], float32 scores [B, k])，候选不足k个时id为-1、得分为-inf
+        '''
+        queries = normalize(np.atleast_2d(queries))
+        batch = len(queries)
+        nprobe = min(nprobe, self.nlist)
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        dsub = self.dim // self.num_subspaces
+        # 查找表 [B, M, ksub]：query子向量与各码字的内积
+        luts = np.einsum("bmd,mkd->bmk", queries.reshape(batch, self.num_subspaces, dsub), self.codebooks)
+        subspaces = np.arange(self.num_subspaces)
+        result_ids = np.full((batch, k), -1, dtype=np.int64)
+        result_scores = np.full((batch, k), -np.inf, dtype=np.float32)
+        for b in range(batch):
+            starts, ends = self.offsets[probes[b]], self.offsets[probes[b] + 1]
+            sizes = ends - starts
+            if sizes.sum() == 0:
+                continue
+            # 各倒排表的下标拼接
+            rows = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+            scores = np.repeat(coarse[b, probes[b]], sizes) + luts[b][subspaces, self.codes[rows]].sum(axis=1)
+            if exclude is not None and len(exclude[b]):
+                scores[np.isin(self.ids[rows], exclude[b])] = -np.inf
+            if refine > 0 and self.vectors is not None:
+                top = self._top(scores, refine * k)
+                rows = rows[top]
+                scores = np.where(np.isinf(scores[top]), -np.inf,
+                                  self.vectors[rows].astype(np.float32) @ queries[b])
+            top = self._top(scores, k)
+            top = top[~np.isinf(scores[top])]
+            result_ids[b, :len(top)] = self.ids[rows[top]]
+            result_scores[b, :len(top)] = scores[top]
+        return result_ids, result_scores
+
+    @staticmethod
+    def _top(scores, k):
+        '''
+        前k大的下标（降序），先argpartition再只对k个排序
+        '''
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        return top[np.argsort(-scores[top], kind="stable")]
+
+
+def user_history(user_ids, recent=20, day=None):
+    '''
+    用户最近互动（任一行为为1）的feed，没有互动的用户取最近观看的feed
+    :param user_ids: int array of users
+    :param recent: Int. 每个用户最多取的feed个数
+    :param day: Int or None. 只使用该日之前的行为
+    :return: DataFrame [userid, feedid, date_]，每个用户最近的recent条；以及Dict userid -> 所有看过的feedid
+    '''
+    actions = pd.read_csv(USER_ACTION, usecols=["userid", "feedid", "date_"] + FEA_COLUMN_LIST)
+    actions = actions[actions["userid"].isin(user_ids)]
+    if day is not None:
+        actions = actions[actions["date_"] < day]
+    actions = actions.sort_values(["userid", "date_"], kind="mergesort")
+    engaged = actions[actions[FEA_COLUMN_LIST].sum(axis=1) > 0]
+    viewed_only = actions[~actions["userid"].isin(engaged["userid"].unique())]
+    history = pd.concat([engaged, viewed_only]).sort_values(["userid", "date_"], kind="mergesort")
+    history = history.groupby("userid").tail(recent)[["userid", "feedid", "date_"]]
+    seen = {user: feeds.values for user, feeds in actions.groupby("userid")["feedid"]}
+    return history, seen
+
+
+def user_query_vectors(index, user_ids, recent=20, half_life=3.0, day=None):
+    '''
+    用户query向量：最近互动feed的向量按时间衰减加权（半衰期half_life天）求和后归一化
+    :return: (float32 [len(user_ids), d]，没有历史的用户为0向量；List of 每个用户看过的feedid数组，用于exclude)
+    '''
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    history, seen = user_history(user_ids, recent, day)
+    row_of = pd.Series(np.arange(len(user_ids)), index=user_ids)
+    rows = row_of.reindex(history["userid"].values).values.astype(np.int64)
+    last_day = history["date_"].max() if len(history) else 0
+    weights = 0.5 ** ((last_day - history["date_"].values) / half_life)
+    queries = np.zeros((len(user_ids), index.dim), dtype=np.float32)
+    np.add.at(queries, rows, index.vectors_of(history["feedid"].values) * weights[:, None].astype(np.float32))
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    queries = np.where(norms > 0, queries / np.maximum(norms, 1e-12), 0.0).astype(np.float32)
+    return queries, [seen.get(user, np.zeros(0, dtype=np.int64)) for user in user_ids]
+
+
+def exact_search(vectors, ids, queries, k, exclude=None, chunk_size=4096):
+    '''
+    暴力检索（精确内积top-K），作为召回率的基准
+    '''
+    vectors = normalize(vectors)
+    queries = normalize(queries)
+    result = np.full((len(queries), k), -1, dtype=np.int64)
+    for start in range(0, len(queries), chunk_size):
+        scores = queries[start:start + chunk_size] @ vectors.T
+        if exclude is not None:
+            for b, excluded in enumerate(exclude[start:start + chunk_size]):
+                scores[b, np.isin(ids, excluded)] = -np.inf
+        for b in range(len(scores)):
+            top = IVFPQIndex._top(scores[b], k)
+            top = top[~np.isinf(scores[b][top])]
+            result[start + b, :len(top)] = ids[top]
+    return result
+
+
+def recall_at_k(approx, exact):
+    '''
+    mean |approx ∩ exact| / |exact|（忽略-1）
+    '''
+    recalls = []
+    for a, e in zip(approx, exact):
+        e = e[e >= 0]
+        if len(e):
+            recalls.append(len(np.intersect1d(a[a >= 0], e)) / float(len(e)))
+    return float(np.mean(recalls)) if recalls else 0.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--path", default=ANN_INDEX_PATH)
+    parser.add_argument("--nlist", type=int, default=0, help="0 = 4 * sqrt(N)")
+    parser.add_argument("--num_subspaces", type=int, default=32)
+    parser.add_argument("--k", type=int, default=100)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--refine", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--num_queries", type=int, default=1000, help="benchmark: users used as queries")
+    parser.add_argument("--batch_size", type=int, default=64, help="benchmark: queries per search call")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="benchmark on n clustered random vectors instead of feed_embeddings.csv")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        rng = np.random.RandomState(SEED)
+        centers = rng.randn(max(1, args.synthetic // 100), 512).astype(np.float32)
+        feed_ids = np.arange(args.synthetic, dtype=np.int64)
+        feed_vectors = centers[rng.randint(len(centers), size=args.synthetic)] + \
+            0.5 * rng.randn(args.synthetic, 512).astype(np.float32)
+    else:
+        feed_ids, feed_vectors = read_feed_embeddings()
+
+    start = time.time()
+    index = IVFPQIndex.build(feed_ids, feed_vectors, args.nlist, args.num_subspaces)
+    index.save(args.path)
+    print("built IVF-PQ index of %d vectors (nlist=%d, M=%d) in %.1fs, saved to %s" % (
+        len(feed_ids), index.nlist, index.num_subspaces, time.time() - start, args.path))
+    if args.command == "benchmark":
+        start = time.time()
+        index = IVFPQIndex.load(args.path)
+        print("mmap load: %.3fs" % (time.time() - start))
+        if args.synthetic:
+            queries = feed_vectors[rng.choice(len(feed_vectors), args.num_queries)] + \
+                0.5 * rng.randn(args.num_queries, 512).astype(np.float32)
+            exclude = None
+        else:
+            users = pd.read_csv(USER_ACTION, usecols=["userid"])["userid"].unique()[:args.num_queries]
+            queries, exclude = user_query_vectors(index, users)
+            keep = np.linalg.norm(queries, axis=1) > 0
+            queries, exclude = queries[keep], [e for e, kept in zip(exclude, keep) if kept]
+
+        def run(fun):
+            start = time.perf_counter()
+            result = [fun(queries[i:i + args.batch_size],
+                          None if exclude is None else exclude[i:i + args.batch_size])
+                      for i in range(0, len(queries), args.batch_size)]
+            return np.concatenate(result), len(queries) / (time.perf_counter() - start)
+
+        exact, qps = run(lambda q, e: exact_search(feed_vectors, feed_ids, q, args.k, e))
+        print("%d queries, k=%d, batch=%d" % (len(queries), args.k, args.batch_size))
+        print("%-24s%12s%12s" % ("method", "recall@k", "QPS"))
+        print("%-24s%12.4f%12.1f" % ("brute force", 1.0, qps))
+        for refine in args.refine:
+            for nprobe in args.nprobe:
+                if nprobe > index.nlist:
+                    continue
+                approx, qps = run(lambda q, e: index.search(q, args.k, nprobe, refine, e)[0])
+                print("%-24s%12.4f%12.1f" % ("nprobe=%d refine=%d" % (nprobe, refine),
+                                             recall_at_k(approx, exact), qps))
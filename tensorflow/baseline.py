@@ -6,8 +6,11 @@ import numpy as np
 import pandas as pd
 import tensorflow.compat.v1 as tf
 from tensorflow import feature_column as fc
-from comm import ACTION_LIST, STAGE_END_DAY, FEA_COLUMN_LIST
+from comm import ACTION_LIST, ACTION_WEIGHT, STAGE_END_DAY, FEA_COLUMN_LIST, PROFILER, ROOT_PATH, build_pipeline, \
+    ACTION_SAMPLE_RATE, ACTION_DAY_NUM, SAMPLE_FEATURES, ENGINE_FEATURES, load_interaction_store
 from evaluation import uAUC, compute_weighted_score
+from prediction_cache import PredictionCache, file_signature, version_hash
+from sampler import NegativeSampler, window_rows
 
 
 flags = tf.app.flags
@@ -20,10 +23,71 @@ flags.DEFINE_integer('batch_size', 128, 'batch_size')
 flags.DEFINE_integer('embed_dim', 10, 'embed_dim')
 flags.DEFINE_float('learning_rate', 0.1, 'learning_rate')
 flags.DEFINE_float('embed_l2', None, 'embedding l2 reg')
+flags.DEFINE_string('embedding_mode', 'full', 'id embeddings: full / qr / mixed')
+flags.DEFINE_integer('qr_collisions', 4, 'qr: ids sharing one quotient row')
+flags.DEFINE_integer('hot_embed_dim', 16, 'mixed: embed_dim of the hot ids (comm.py hot vocabulary)')
+flags.DEFINE_integer('tail_embed_dim', 4, 'mixed: embed_dim of the shared hash buckets of all ids')
+flags.DEFINE_bool('feed_embedding', True, 'dnn input: compressed feed vector looked up by feedid (comm.py)')
+flags.DEFINE_integer('tail_hash_ratio', 10, 'mixed: tail hash buckets = hash buckets of full / tail_hash_ratio')
+flags.DEFINE_bool('prediction_cache', True, 'evaluate/submit: reuse the predictions of an unchanged checkpoint and '
+                                            'sample file ({model_checkpoint_dir}/prediction_cache)')
+flags.DEFINE_bool('importance_weight', True, 'train: weight the sampled negatives by 1 / ACTION_SAMPLE_RATE so the '
+                                           'loss matches the full data')
+flags.DEFINE_bool('check_samples', True, 'train/evaluate/submit: regenerate the stage samples first if comm.py '
+                                       'inputs or sampling parameters changed (pipeline.py)')
 
 SEED = 2021
+# 训练样本的loss权重列（负采样的重要性权重，estimator的weight_column）
+SAMPLE_WEIGHT = "sample_weight"
+# id特征的hash桶数（embedding_mode=full）
+HASH_BUCKETS = {"userid": 40000, "feedid": 240000, "authorid": 40000, "bgm_singer_id": 40000, "bgm_song_id": 60000}
+# 导出模型（export阶段）的输入：concat_sample格式的原始特征
+SERVING_ID_FEATURES = list(HASH_BUCKETS)
+SERVING_NUMERIC_FEATURES = ["device", "videoplayseconds"] + [b + "sum" for b in FEA_COLUMN_LIST] + \
+                           [b + "sum_user" for b in FEA_COLUMN_LIST] + ENGINE_FEATURES
 
 
+class StageFrameCache(object):
+    '''
+    evaluate/submit 阶段所有行为共用同一份样本文件（{stage}_all_{day}_concate_sample.csv），
+    每个阶段只读取并转换一次，供所有行为的模型复用，阶段结束后释放
+    '''
+
+    def __init__(self):
+        self._frames = {}
+
+    def get(self, stage):
+        '''
+        获取阶段样本，首次访问时读取文件
+        :param stage: String. Including "evaluate"/"submit"
+        :return: Tuple of (ids df, feature dict of numpy arrays, userid list)
+        '''
+        if stage not in self._frames:
+            with PROFILER.stage("load_sample[%s]" % stage):
+                df = pd.read_csv(self.path(stage))
+                # 转为模型输入格式（列名 -> numpy array），各行为共用
+                features = {name: df[name].values for name in df.columns}
+                userid_list = df['userid'].astype(str).tolist()
+                self._frames[stage] = (df[["userid", "feedid"]], features, userid_list)
+        return self._frames[stage]
+
+    @staticmethod
+    def path(stage):
+        file_name = "{stage}_{action}_{day}_concate_sample.csv".format(stage=stage, action="all",
+                                                                      day=STAGE_END_DAY[stage])
+        return os.path.join(FLAGS.root_path, stage, file_name)
+
+    def release(self, stage):
+        '''
+        释放阶段样本
+        '''
+        self._frames.pop(stage, None)
+
+
+STAGE_FRAME_CACHE = StageFrameCache()
+# evaluate/submit阶段的预测缓存（main中创建），None为不使用
+PREDICTION_CACHE = None
+
 
 class WideAndDeep(object):
 
@@ -65,12 +129,13 @@ class WideAndDeep(object):
             dnn_feature_columns=self.dnn_feature_columns,
             dnn_hidden_units=[32, 8],
             dnn_optimizer=optimizer,
+            weight_column=SAMPLE_WEIGHT,
             config=config)
 
     def df_to_dataset(self, df, stage, action, shuffle=True, batch_size=128, num_epochs=1):
         '''
         把DataFrame转为tensorflow dataset
-        :param df: pandas dataframe. 
+        :param df: pandas dataframe, or dict of numpy arrays (column name -> values). 
         :param stage: String. Including "online_train"/"offline_train"/"evaluate"/"submit"
         :param action: String. Including "read_comment"/"like"/"click_avatar"/"favorite"/"forward"/"comment"/"follow"
         :param shuffle: Boolean. 
@@ -78,83 +143,178 @@ class WideAndDeep(object):
         :param num_epochs: Int. Epochs num
         :return: tf.data.Dataset object. 
         '''
-        print(df.shape)
-        print(df.columns)
+        if isinstance(df, dict):
+            features = df
+            num_rows = len(next(iter(features.values())))
+        else:
+            features = dict(df)
+            num_rows = len(df)
+        features = add_embedding_features(features)
+        print((num_rows, len(features)))
+        print(list(features.keys()))
         print("batch_size: ", batch_size)
         print("num_epochs: ", num_epochs)
         if stage != "submit":
-            label = df[action]
-            ds = tf.data.Dataset.from_tensor_slices((dict(df), label))
+            label = features[action]
+            ds = tf.data.Dataset.from_tensor_slices((features, label))
         else:
-            ds = tf.data.Dataset.from_tensor_slices((dict(df)))
+            ds = tf.data.Dataset.from_tensor_slices((features))
         if shuffle:
-            ds = ds.shuffle(buffer_size=len(df), seed=SEED)
-        ds = ds.batch(batch_size)
+            ds = ds.shuffle(buffer_size=num_rows, seed=SEED)
+        ds = self.add_feed_embed(ds.batch(batch_size))
         if stage in ["online_train", "offline_train"]:
             ds = ds.repeat(num_epochs)
         return ds
 
-    def input_fn_train(self, df, stage, action, num_epochs):
-        return self.df_to_dataset(df, stage, action, shuffle=True, batch_size=FLAGS.batch_size,
-                                  num_epochs=num_epochs)
+    @staticmethod
+    def add_feed_embed(ds):
+        '''
+        按batch查feed向量表，样本中只有feedid
+        '''
+        if not FLAGS.feed_embedding:
+            return ds
+        table = tf.constant(load_feed_embedding())
+
+        def add_feed_embed(features, *label):
+            features = dict(features)
+            features["feed_embed"] = tf.cast(tf.gather(table, features["feedid"]), tf.float32)
+            return (features,) + label if label else features
+        return ds.map(add_feed_embed)
+
+    def training_sample(self):
+        '''
+        :return: (训练样本库 dict of arrays, 阶段最后ACTION_DAY_NUM天样本上的NegativeSampler)
+        '''
+        store = load_interaction_store(os.path.join(FLAGS.root_path, "interactions"))
+        rows = window_rows(store["date_"], STAGE_END_DAY[self.stage], ACTION_DAY_NUM[self.action])
+        return store, NegativeSampler(store[self.action], ACTION_SAMPLE_RATE[self.action], SEED, rows,
+                                      FLAGS.importance_weight)
+
+    def sampled_dataset(self, store, sampler, num_epochs):
+        '''
+        每个epoch重新抽取负样本的训练数据：按batch从样本库gather特征（batch内行号升序，mmap读取更连续），
+        负样本的重要性权重为SAMPLE_WEIGHT列
+        :return: tf.data.Dataset object.
+        '''
+        def batches():
+            for epoch in range(num_epochs):
+                rows, weights = sampler.epoch(epoch)
+                order = np.random.RandomState(SEED + epoch).permutation(len(rows))
+                for start in range(0, len(rows), FLAGS.batch_size):
+                    index = np.sort(order[start:start + FLAGS.batch_size])
+                    features = {name: store[name][rows[index]] for name in SAMPLE_FEATURES}
+                    features[SAMPLE_WEIGHT] = weights[index, 0]
+                    yield add_embedding_features(features), store[self.action][rows[index]].astype(np.int64)
+
+        example = add_embedding_features({name: np.asarray(store[name][:1]) for name in SAMPLE_FEATURES})
+        types = {name: tf.as_dtype(values.dtype) for name, values in example.items()}
+        types[SAMPLE_WEIGHT] = tf.float32
+        shapes = {name: tf.TensorShape([None]) for name in types}
+        print("%s: %d samples in %d days, about %d per epoch, batch_size: %d, num_epochs: %d" % (
+            self.action, len(sampler.rows), ACTION_DAY_NUM[self.action], len(sampler), FLAGS.batch_size,
+            num_epochs))
+        ds = tf.data.Dataset.from_generator(batches, (types, tf.int64), (shapes, tf.TensorShape([None])))
+        return self.add_feed_embed(ds).prefetch(1)
 
     def input_fn_predict(self, df, stage, action):
-        return self.df_to_dataset(df, stage, action, shuffle=False, batch_size=len(df), num_epochs=1)
+        if isinstance(df, dict):
+            batch_size = len(next(iter(df.values())))
+        else:
+            batch_size = len(df)
+        return self.df_to_dataset(df, stage, action, shuffle=False, batch_size=batch_size, num_epochs=1)
 
     def train(self):
         """
-        训练单个行为的模型
+        训练单个行为的模型，每个epoch从训练样本库重新抽取负样本
         """
-        file_name = "{stage}_{action}_{day}_concate_sample.csv".format(stage=self.stage, action=self.action,
-                                                                      day=STAGE_END_DAY[self.stage])
-        stage_dir = os.path.join(FLAGS.root_path, self.stage, file_name)
-        df = pd.read_csv(stage_dir)
-        self.estimator.train(
-            input_fn=lambda: self.input_fn_train(df, self.stage, self.action, self.num_epochs_dict[self.action])
-        )
+        with PROFILER.stage("fit[%s]" % self.action):
+            store, sampler = self.training_sample()
+            self.estimator.train(
+                input_fn=lambda: self.sampled_dataset(store, sampler, self.num_epochs_dict[self.action])
+            )
 
     def evaluate(self):
         """
         评估单个行为的uAUC值
         """
         if self.stage in ["online_train", "offline_train"]:
-            # 训练集，每个action一个文件
-            action = self.action
+            # 训练集：第一个epoch抽取的样本
+            store, sampler = self.training_sample()
+            rows, _ = sampler.epoch(0)
+            features = {name: store[name][rows] for name in SAMPLE_FEATURES + [self.action]}
+            ids = pd.DataFrame({"userid": features["userid"], "feedid": features["feedid"]})
+            userid_list = features['userid'].astype(str).tolist()
         else:
-            # 测试集，所有action在同一个文件
-            action = "all"
-        file_name = "{stage}_{action}_{day}_concate_sample.csv".format(stage=self.stage, action=action,
-                                                                      day=STAGE_END_DAY[self.stage])
-        evaluate_dir = os.path.join(FLAGS.root_path, self.stage, file_name)
-        df = pd.read_csv(evaluate_dir)
-        userid_list = df['userid'].astype(str).tolist()
-        predicts = self.estimator.predict(
-            input_fn=lambda: self.input_fn_predict(df, self.stage, self.action)
-        )
-        predicts_df = pd.DataFrame.from_dict(predicts)
-        logits = predicts_df["logistic"].map(lambda x: x[0])
-        labels = df[self.action].values
-        uauc = uAUC(labels, logits, userid_list)
-        return df[["userid", "feedid"]], logits, uauc
+            # 测试集，所有action在同一个文件，各行为共用缓存
+            ids, features, userid_list = STAGE_FRAME_CACHE.get(self.stage)
+        logits = self.predict_logits(features, STAGE_FRAME_CACHE.path(self.stage))
+        labels = features[self.action]
+        with PROFILER.stage("score[%s]" % self.action):
+            uauc = uAUC(labels, logits, userid_list)
+        return ids, logits, uauc
 
     
     def predict(self):
         '''
         预测单个行为的发生概率
         '''
-        file_name = "{stage}_{action}_{day}_concate_sample.csv".format(stage=self.stage, action="all",
-                                                                      day=STAGE_END_DAY[self.stage])
-        submit_dir = os.path.join(FLAGS.root_path, self.stage, file_name)
-        df = pd.read_csv(submit_dir)
+        ids, features, _ = STAGE_FRAME_CACHE.get(self.stage)
         t = time.time()
-        predicts = self.estimator.predict(
-            input_fn=lambda: self.input_fn_predict(df, self.stage, self.action)
-        )
-        predicts_df = pd.DataFrame.from_dict(predicts)
-        logits = predicts_df["logistic"].map(lambda x: x[0])
-        # 计算2000条样本平均预测耗时（毫秒）
-        ts = (time.time()-t)*1000.0/len(df)*2000.0
-        return df[["userid", "feedid"]], logits, ts
+        logits = self.predict_logits(features, STAGE_FRAME_CACHE.path(self.stage))
+        # 计算2000条样本平均预测耗时（毫秒），包括缓存命中的样本
+        ts = (time.time()-t)*1000.0/len(ids)*2000.0
+        return ids, logits, ts
+
+    def predict_logits(self, features, sample_file):
+        '''
+        预测features中所有样本，使用PREDICTION_CACHE时只预测缓存中没有的 (userid, feedid)
+        :param features: Dict. 列名 -> numpy array
+        :param sample_file: String. features的样本文件（缓存版本的一部分）
+        :return: pandas Series of probabilities
+        '''
+        with PROFILER.stage("predict[%s]" % self.action):
+            return self._predict_logits(features, sample_file)
+
+    def _predict_logits(self, features, sample_file):
+        if PREDICTION_CACHE is None:
+            predicts = self.estimator.predict(
+                input_fn=lambda: self.input_fn_predict(features, self.stage, self.action)
+            )
+            return pd.DataFrame.from_dict(predicts)["logistic"].map(lambda x: x[0])
+        version = self.cache_version(sample_file)
+        hit, cached = PREDICTION_CACHE.get(version, features["userid"], features["feedid"])
+        logits = np.zeros(len(hit), dtype=np.float32)
+        if hit.any():
+            logits[hit] = cached[hit, 0]
+        if not hit.all():
+            miss = {name: values[~hit] for name, values in features.items()}
+            predicts = self.estimator.predict(
+                input_fn=lambda: self.input_fn_predict(miss, self.stage, self.action)
+            )
+            logits[~hit] = [p["logistic"][0] for p in predicts]
+            PREDICTION_CACHE.put(version, miss["userid"], miss["feedid"], logits[~hit])
+        print("%s: %d of %d predictions from cache" % (self.action, hit.sum(), len(hit)))
+        return pd.Series(logits)
+
+    def cache_version(self, sample_file):
+        '''
+        预测缓存的版本：最新checkpoint、样本文件、feed向量表及特征参数，任一改变则缓存失效
+        '''
+        checkpoint = self.estimator.latest_checkpoint()
+        return version_hash(self.action, checkpoint, file_signature(checkpoint + ".index") if checkpoint else None,
+                            file_signature(sample_file, os.path.join(FLAGS.root_path, "feature",
+                                                                     "feed_embedding.npy")),
+                            FLAGS.embedding_mode, FLAGS.qr_collisions, FLAGS.feed_embedding)
+
+    def export(self):
+        '''
+        把在线模型导出为SavedModel（serving.py加载），签名"predict"的输入为SERVING_*_FEATURES，
+        派生id列和feed向量在图内计算
+        :return: String. 导出目录 {model_checkpoint_dir}/export/{action}/{timestamp}
+        '''
+        export_dir = os.path.join(FLAGS.model_checkpoint_dir, "export", self.action)
+        path = self.estimator.export_saved_model(export_dir, serving_input_receiver_fn)
+        return path.decode() if isinstance(path, bytes) else path
 
     
 
@@ -172,6 +332,97 @@ def del_file(path):
             os.remove(c_path)
 
 
+_FEED_EMBEDDING = []
+
+
+def load_feed_embedding():
+    '''
+    读取comm.py生成的feed向量表（行号为feedid），进程内只读一次
+    :return: float16 array [max feedid + 1, k]
+    '''
+    if not _FEED_EMBEDDING:
+        path = os.path.join(FLAGS.root_path, "feature", "feed_embedding.npy")
+        if not os.path.exists(path):
+            raise IOError("%s not found, run comm.py first" % path)
+        _FEED_EMBEDDING.append(np.load(path))
+    return _FEED_EMBEDDING[0]
+
+
+def add_embedding_features(features):
+    '''
+    embedding_mode需要的派生id列（同一个key不能对应多个特征列）
+    - qr: {id}_q = id // qr_collisions, {id}_r = id % qr_collisions
+    - mixed: {id}_tail = id，所有id共享的窄hash桶
+    :param features: Dict. 列名 -> pandas Series / numpy array
+    :return: Dict. 加入派生列
+    '''
+    if FLAGS.embedding_mode == "full":
+        return features
+    features = dict(features)
+    for feat in HASH_BUCKETS:
+        if feat not in features:
+            continue
+        if FLAGS.embedding_mode == "qr":
+            features[feat + "_q"] = features[feat] // FLAGS.qr_collisions
+            features[feat + "_r"] = features[feat] % FLAGS.qr_collisions
+        elif FLAGS.embedding_mode == "mixed":
+            features[feat + "_tail"] = features[feat]
+    return features
+
+
+def serving_input_receiver_fn():
+    '''
+    导出模型的输入：每个特征一个一维placeholder（id为int64，其余为float32）
+    '''
+    receiver_tensors = {name: tf.placeholder(tf.int64, [None], name=name) for name in SERVING_ID_FEATURES}
+    receiver_tensors.update({name: tf.placeholder(tf.float32, [None], name=name)
+                             for name in SERVING_NUMERIC_FEATURES})
+    features = add_embedding_features(receiver_tensors)
+    if FLAGS.feed_embedding:
+        table = tf.constant(load_feed_embedding())
+        features["feed_embed"] = tf.cast(tf.gather(table, features["feedid"]), tf.float32)
+    return tf.estimator.export.ServingInputReceiver(features, receiver_tensors)
+
+
+def get_id_embedding_columns():
+    '''
+    id特征的embedding列，按embedding_mode：
+    - full: 每个id一个hash桶，维度embed_dim
+    - qr: 商、余两个小表的embedding拼接（各embed_dim/2），(商, 余)对每个id唯一，参数量 (桶数/m + m) * embed_dim/2
+    - mixed: 高频id（comm.py生成的词表）用hot_embed_dim维的独立向量，其余id为0；
+      所有id另有tail_embed_dim维的共享hash桶（桶数为full的1/tail_hash_ratio）
+    :return: (List of embedding columns, Int. embedding参数量)
+    '''
+    columns = []
+    num_params = 0
+    for feat, buckets in HASH_BUCKETS.items():
+        if FLAGS.embedding_mode == "qr":
+            dim = max(1, FLAGS.embed_dim // 2)
+            quotient_buckets = (buckets - 1) // FLAGS.qr_collisions + 1
+            quotient_cate = fc.categorical_column_with_hash_bucket(feat + "_q", quotient_buckets, tf.int64)
+            remainder_cate = fc.categorical_column_with_identity(feat + "_r", FLAGS.qr_collisions)
+            columns.append(fc.embedding_column(quotient_cate, dim, max_norm=FLAGS.embed_l2))
+            columns.append(fc.embedding_column(remainder_cate, dim, max_norm=FLAGS.embed_l2))
+            num_params += (quotient_buckets + FLAGS.qr_collisions) * dim
+        elif FLAGS.embedding_mode == "mixed":
+            vocab_path = os.path.join(FLAGS.root_path, "feature", "hot_" + feat + ".txt")
+            if not os.path.exists(vocab_path):
+                raise IOError("%s not found, run comm.py first" % vocab_path)
+            hot_size = len(np.loadtxt(vocab_path, dtype=np.int64, ndmin=1))
+            tail_buckets = max(1, buckets // FLAGS.tail_hash_ratio)
+            # 词表外的id为-1，embedding为0
+            hot_cate = fc.categorical_column_with_vocabulary_file(feat, vocab_path, dtype=tf.int64, default_value=-1)
+            tail_cate = fc.categorical_column_with_hash_bucket(feat + "_tail", tail_buckets, tf.int64)
+            columns.append(fc.embedding_column(hot_cate, FLAGS.hot_embed_dim, max_norm=FLAGS.embed_l2))
+            columns.append(fc.embedding_column(tail_cate, FLAGS.tail_embed_dim, max_norm=FLAGS.embed_l2))
+            num_params += hot_size * FLAGS.hot_embed_dim + tail_buckets * FLAGS.tail_embed_dim
+        else:
+            cate = fc.categorical_column_with_hash_bucket(feat, buckets, tf.int64)
+            columns.append(fc.embedding_column(cate, FLAGS.embed_dim, max_norm=FLAGS.embed_l2))
+            num_params += buckets * FLAGS.embed_dim
+    return columns, num_params
+
+
 def get_feature_columns():
     '''
     获取特征列
@@ -179,21 +430,11 @@ def get_feature_columns():
     dnn_feature_columns = list()
     linear_feature_columns = list()
     # DNN features
-    user_cate = fc.categorical_column_with_hash_bucket("userid", 40000, tf.int64)
-    feed_cate = fc.categorical_column_with_hash_bucket("feedid", 240000, tf.int64)
-    author_cate = fc.categorical_column_with_hash_bucket("authorid", 40000, tf.int64)
-    bgm_singer_cate = fc.categorical_column_with_hash_bucket("bgm_singer_id", 40000, tf.int64)
-    bgm_song_cate = fc.categorical_column_with_hash_bucket("bgm_song_id", 60000, tf.int64)
-    user_embedding = fc.embedding_column(user_cate, FLAGS.embed_dim, max_norm=FLAGS.embed_l2)
-    feed_embedding = fc.embedding_column(feed_cate, FLAGS.embed_dim, max_norm=FLAGS.embed_l2)
-    author_embedding = fc.embedding_column(author_cate, FLAGS.embed_dim, max_norm=FLAGS.embed_l2)
-    bgm_singer_embedding = fc.embedding_column(bgm_singer_cate, FLAGS.embed_dim, max_norm=FLAGS.embed_l2)
-    bgm_song_embedding = fc.embedding_column(bgm_song_cate, FLAGS.embed_dim, max_norm=FLAGS.embed_l2)
-    dnn_feature_columns.append(user_embedding)
-    dnn_feature_columns.append(feed_embedding)
-    dnn_feature_columns.append(author_embedding)
-    dnn_feature_columns.append(bgm_singer_embedding)
-    dnn_feature_columns.append(bgm_song_embedding)
+    id_embedding_columns, num_params = get_id_embedding_columns()
+    print("embedding_mode: %s, embedding params: %d" % (FLAGS.embedding_mode, num_params))
+    dnn_feature_columns.extend(id_embedding_columns)
+    if FLAGS.feed_embedding:
+        dnn_feature_columns.append(fc.numeric_column("feed_embed", shape=(load_feed_embedding().shape[1],)))
     # Linear features
     video_seconds = fc.numeric_column("videoplayseconds", default_value=0.0)
     device = fc.numeric_column("device", default_value=0.0)
@@ -205,6 +446,9 @@ def get_feature_columns():
         linear_feature_columns.append(feed_b)
         user_b = fc.numeric_column(b+"sum_user", default_value=0.0)
         linear_feature_columns.append(user_b)
+    # 多窗口曝光数、平滑点击率、原始比率（含userid×authorid等组合key）
+    for name in ENGINE_FEATURES:
+        linear_feature_columns.append(fc.numeric_column(name, default_value=0.0))
     return dnn_feature_columns, linear_feature_columns
 
 
@@ -217,37 +461,53 @@ def main(argv):
     predict_dict = {}
     predict_time_cost = {}
     ids = None
-    for action in ACTION_LIST:
-        print("Action:", action)
-        model = WideAndDeep(linear_feature_columns, dnn_feature_columns, stage, action)
-        model.build_estimator()
+    global PREDICTION_CACHE
+    if FLAGS.check_samples and stage in STAGE_END_DAY and \
+            os.path.normpath(FLAGS.root_path) == os.path.normpath(ROOT_PATH):
+        # 阶段样本过期（原始数据、采样参数或代码改变）时先重新生成，没有改变时只比较hash
+        build_pipeline().run(["sample[%s]" % stage if stage in ["evaluate", "submit"] else "interaction_store"])
+    if FLAGS.prediction_cache and stage in ["evaluate", "submit"]:
+        PREDICTION_CACHE = PredictionCache(disk_path=os.path.join(FLAGS.model_checkpoint_dir, "prediction_cache"))
+    try:
+        for action in ACTION_LIST:
+            print("Action:", action)
+            model = WideAndDeep(linear_feature_columns, dnn_feature_columns, stage, action)
+            model.build_estimator()
 
-        if stage in ["online_train", "offline_train"]:
-            # 训练 并评估
-            model.train()
-            # remove event which can be very large
-            os.system('find data/model -iname event* -print -delete')
-            ids, logits, action_uauc = model.evaluate()
-            eval_dict[action] = action_uauc
-
-        if stage == "evaluate":
-            # 评估线下测试集结果，计算单个行为的uAUC值，并保存预测结果
-            ids, logits, action_uauc = model.evaluate()
-            eval_dict[action] = action_uauc
-            predict_dict[action] = logits
-
-        if stage == "submit":
-            # 预测线上测试集结果，保存预测结果
-            ids, logits, ts = model.predict()
-            predict_time_cost[action] = ts
-            predict_dict[action] = logits
+            if stage in ["online_train", "offline_train"]:
+                # 训练 并评估
+                model.train()
+                # remove event which can be very large
+                os.system('find data/model -iname event* -print -delete')
+                ids, logits, action_uauc = model.evaluate()
+                eval_dict[action] = action_uauc
+
+            if stage == "evaluate":
+                # 评估线下测试集结果，计算单个行为的uAUC值，并保存预测结果
+                ids, logits, action_uauc = model.evaluate()
+                eval_dict[action] = action_uauc
+                predict_dict[action] = logits
+
+            if stage == "submit":
+                # 预测线上测试集结果，保存预测结果
+                ids, logits, ts = model.predict()
+                predict_time_cost[action] = ts
+                predict_dict[action] = logits
+
+            if stage == "export":
+                # 导出在线模型，供serving.py加载
+                print('Export to: %s' % model.export())
+    finally:
+        # 阶段结束，释放共用的样本缓存
+        STAGE_FRAME_CACHE.release(stage)
+        if PREDICTION_CACHE is not None:
+            PREDICTION_CACHE.flush()
+            print("Prediction cache:", PREDICTION_CACHE.stats())
 
     if stage in ["evaluate", "offline_train", "online_train"]:
         # 计算所有行为的加权uAUC
         print(eval_dict)
-        weight_dict = {"read_comment": 4, "like": 3, "click_avatar": 2, "favorite": 1, "forward": 1,
-                       "comment": 1, "follow": 1}
-        weight_auc = compute_weighted_score(eval_dict, weight_dict)
+        weight_auc = compute_weighted_score(eval_dict, ACTION_WEIGHT)
         print("Weighted uAUC: ", weight_auc)
 
 
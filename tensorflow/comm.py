@@ -1,5 +1,7 @@
 # coding: utf-8
 import os
+import shutil
+import sys
 import time
 import logging 
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s" 
@@ -8,6 +10,13 @@ logger = logging.getLogger(__file__)
 import numpy as np
 import pandas as pd
 
+# tensorflow/ 和 pytorch/ 共用的模块（pipeline、profiler、prediction_cache、sampler）在 ../common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import feature_engine
+from feature_engine import FeatureTables, build_tables, day_counts, window_sums, feature_names
+from pipeline import Pipeline, Stage
+from profiler import StageProfiler
+
 # 存储数据的根目录
 ROOT_PATH = "./data"
 # 比赛数据集路径
@@ -25,16 +34,46 @@ SEED = 2021
 ACTION_LIST = ["read_comment", "like", "click_avatar",  "forward"]
 # 复赛待预测行为列表
 # ACTION_LIST = ["read_comment", "like", "click_avatar",  "forward", "comment", "follow", "favorite"]
+# 各行为uAUC的加权权重（evaluation.compute_weighted_score），排序时各行为概率按同样的权重加权
+ACTION_WEIGHT = {"read_comment": 4, "like": 3, "click_avatar": 2, "favorite": 1, "forward": 1, "comment": 1, "follow": 1}
 # 用于构造特征的字段列表
 FEA_COLUMN_LIST = ["read_comment", "like", "click_avatar",  "forward", "comment", "follow", "favorite"]
 # 每个行为的负样本下采样比例(下采样后负样本数/原负样本数)
 POS_RATIO = {"read_comment": 0.156, "like": 0.112, "click_avatar": 0.0362, "forward": 0.0335, "comment": 0.1, "follow": 0.1, "favorite": 0.1}
+# 训练时每个epoch按该比例重新抽取负样本（sampler.NegativeSampler，被抽中的负样本loss权重为1/比例）
 ACTION_SAMPLE_RATE = {"read_comment": 0.2, "like": 0.2, "click_avatar": 0.2, "forward": 0.1, "comment": 0.1, "follow": 0.1, "favorite": 0.1}
 
 # 各个阶段数据集的设置的最后一天
 STAGE_END_DAY = {"online_train": 14, "offline_train": 12, "evaluate": 13, "submit": 15}
 # 各个行为构造训练数据的天数
 ACTION_DAY_NUM = {"read_comment": 5, "like": 5, "click_avatar": 5, "forward": 5, "comment": 5, "follow": 5, "favorite": 5}
+# feed多模态向量（512维）降维后的维度，按feedid存为float16表（baseline.py feed_embed特征）
+FEED_EMBEDDING_DIM = 32
+FEED_EMBEDDING_TABLE = os.path.join(ROOT_PATH, "feature", "feed_embedding.npy")
+# 各阶段耗时和峰值内存，进程退出时写入 data/profile/{脚本名}_{参数}_{时间}.json（见../common/profiler.py）
+PROFILER = StageProfiler(os.path.join(ROOT_PATH, "profile"))
+# 数据处理DAG的状态（各阶段上次运行的key和输出hash，见../common/pipeline.py）
+PIPELINE_STATE = os.path.join(ROOT_PATH, "pipeline_state.json")
+HOT_VOCAB_DIMS = ["userid", "feedid", "authorid", "bgm_song_id", "bgm_singer_id"]
+# 多窗口统计特征（feature_engine.py）：各key过去ENGINE_WINDOWS天及按天衰减的曝光数、各行为的平滑点击率和原始比率
+FEATURE_ENGINE_PATH = os.path.join(ROOT_PATH, "feature", "engine")
+ENGINE_KEYS = {"userid": ["userid"], "feedid": ["feedid"], "authorid": ["authorid"],
+               "userid_authorid": ["userid", "authorid"], "userid_bgm_singer_id": ["userid", "bgm_singer_id"]}
+ENGINE_WINDOWS = [3, 7]
+# 衰减计数每天的衰减系数
+ENGINE_DECAY = 0.8
+# 平滑点击率的先验强度（先验曝光数）
+ENGINE_PRIOR_STRENGTH = 20.0
+# 计算特征的样本日期：最早的训练样本日期到submit日，更早的样本这些特征为0
+ENGINE_DAYS = list(range(min(STAGE_END_DAY["offline_train"], STAGE_END_DAY["online_train"]) -
+                         max(ACTION_DAY_NUM.values()) + 1, END_DAY + 1))
+ENGINE_FEATURES = feature_names(ENGINE_KEYS, ENGINE_WINDOWS, ACTION_LIST)
+# 训练样本库：(userid, feedid) 去重后的全部曝光及特征，按列存为npy，训练时每个epoch重新抽取负样本（../common/sampler.py）
+INTERACTION_STORE_PATH = os.path.join(ROOT_PATH, "interactions")
+# 样本的模型输入列（concat_sample和训练样本库相同，不含标签）
+SAMPLE_ID_FEATURES = ["userid", "feedid", "authorid", "bgm_song_id", "bgm_singer_id"]
+SAMPLE_FEATURES = SAMPLE_ID_FEATURES + ["device", "videoplayseconds"] + [b + "sum" for b in FEA_COLUMN_LIST] + \
+                  [b + "sum_user" for b in FEA_COLUMN_LIST] + ENGINE_FEATURES
 
 
 def create_dir():
@@ -46,7 +85,7 @@ def create_dir():
         print('Create dir: %s'%ROOT_PATH)
         os.mkdir(ROOT_PATH)
     # data目录下需要创建的子目录
-    need_dirs = ["offline_train", "online_train", "evaluate", "submit",
+    need_dirs = ["evaluate", "submit",
                  "feature", "model", "model/online_train", "model/offline_train"]
     for need_dir in need_dirs:
         need_dir = os.path.join(ROOT_PATH, need_dir)
@@ -59,7 +98,7 @@ def check_file():
     '''
     检查数据文件是否存在
     '''
-    paths = [USER_ACTION, FEED_INFO, TEST_FILE]
+    paths = [USER_ACTION, FEED_INFO, FEED_EMBEDDINGS, TEST_FILE]
     flag = True
     not_exist_file = []
     for f in paths:
@@ -73,7 +112,7 @@ def statis_data():
     """
     统计特征最大，最小，均值
     """
-    paths = [USER_ACTION, FEED_INFO, TEST_FILE]
+    paths = [USER_ACTION, FEED_INFO, FEED_EMBEDDINGS, TEST_FILE]
     pd.set_option('display.max_columns', None)
     for path in paths:
         df = pd.read_csv(path)
@@ -83,89 +122,138 @@ def statis_data():
         print(df.nunique())
 
 
-def statis_feature(start_day=1, before_day=7, agg='sum'):
+@PROFILER.profiled()
+def statis_feature(start_day=1, before_day=7):
     """
-    统计用户/feed 过去n天各类行为的次数
+    统计用户/feed 过去n天各类行为的次数（每天的计数立方体上一次得到所有日期的窗口和，见feature_engine.py）
     :param start_day: Int. 起始日期
     :param before_day: Int. 时间范围（天数）
-    :param agg: String. 统计方法
     """
     history_data = pd.read_csv(USER_ACTION)[["userid", "date_", "feedid"] + FEA_COLUMN_LIST]
     feature_dir = os.path.join(ROOT_PATH, "feature")
+    days = np.arange(start_day + before_day, END_DAY + 1)
+    dates = history_data["date_"].values
+    channels = np.hstack([np.ones((len(history_data), 1)), history_data[FEA_COLUMN_LIST].values]).astype(np.float32)
     for dim in ["userid", "feedid"]:
         print(dim)
-        user_data = history_data[[dim, "date_"] + FEA_COLUMN_LIST]
-        res_arr = []
-        for start in range(start_day, END_DAY-before_day+1):
-            temp = user_data[((user_data["date_"]) >= start) & (user_data["date_"] < (start + before_day))]
-            temp = temp.drop(columns=['date_'])
-            temp = temp.groupby([dim]).agg([agg]).reset_index()
-            temp.columns = list(map(''.join, temp.columns.values))
-            temp["date_"] = start + before_day
-            res_arr.append(temp)
-        dim_feature = pd.concat(res_arr)
+        ids, codes = np.unique(history_data[dim].values, return_inverse=True)
+        sums = window_sums(day_counts(codes.reshape(-1), dates, channels, len(ids), END_DAY), days, [before_day])
+        # 按日期、id排序，只保留窗口内有曝光的id
+        sums = sums[:, :, 0].transpose(1, 0, 2)
+        day_index, id_index = np.nonzero(sums[..., 0] > 0)
+        dim_feature = pd.DataFrame(np.rint(sums[day_index, id_index, 1:]).astype(np.int64),
+                                   columns=[b + "sum" for b in FEA_COLUMN_LIST])
+        dim_feature.insert(0, dim, ids[id_index])
+        dim_feature["date_"] = days[day_index]
         feature_path = os.path.join(feature_dir, dim+"_feature.csv")
         print('Save to: %s'%feature_path)
         dim_feature.to_csv(feature_path, index=False)
 
 
-def generate_sample(stage="offline_train"):
+@PROFILER.profiled()
+def generate_hot_vocab(coverage=0.8):
+    """
+    按出现次数从高到低取id，直到覆盖coverage比例的曝光，作为高频词表（baseline.py embedding_mode=mixed 使用）
+    只统计evaluate日之前的数据，避免线下评估穿越
+    :param coverage: Float. 高频id覆盖的曝光比例
     """
-    对负样本进行下采样，生成各个阶段所需样本
-    :param stage: String. Including "online_train"/"offline_train"/"evaluate"/"submit"
+    history_data = pd.read_csv(USER_ACTION)[["userid", "feedid", "date_"]]
+    history_data = history_data[history_data["date_"] < STAGE_END_DAY["evaluate"]]
+    feed_info = pd.read_csv(FEED_INFO)[["feedid", "authorid", "bgm_song_id", "bgm_singer_id"]]
+    history_data = history_data.merge(feed_info, on="feedid", how="left")
+    feature_dir = os.path.join(ROOT_PATH, "feature")
+    for dim in HOT_VOCAB_DIMS:
+        ids = history_data[dim].dropna().astype(int)
+        if dim in ["authorid", "bgm_song_id", "bgm_singer_id"]:
+            ids = ids + 1  # 与concat_sample一致，0 用于填未知
+        counts = ids.value_counts()
+        hot_num = int(np.searchsorted(np.cumsum(counts.values) / counts.values.sum(), coverage)) + 1
+        vocab_path = os.path.join(feature_dir, "hot_" + dim + ".txt")
+        print('%s: %d hot ids of %d, save to: %s' % (dim, hot_num, len(counts), vocab_path))
+        np.savetxt(vocab_path, counts.index.values[:hot_num], fmt="%d")
+
+
+def read_feed_embeddings():
+    """
+    读取feed多模态向量
+    :return: (int64 array of feedids [num_feeds], float32 array of vectors [num_feeds, 512])
+    """
+    feed_embed = pd.read_csv(FEED_EMBEDDINGS)
+    vectors = np.stack([np.fromstring(str(x), dtype=np.float32, sep=" ") for x in feed_embed["feed_embedding"]])
+    return feed_embed["feedid"].values.astype(np.int64), vectors
+
+
+@PROFILER.profiled()
+def compress_feed_embeddings(k=FEED_EMBEDDING_DIM, method="pca"):
+    """
+    在所有feed的512维向量上拟合一次PCA/随机投影，保存 [max(feedid)+1, k] 的float16表（行号为feedid，
+    没有向量的feed为0），模型在输入时按feedid查表，样本文件中不需要存512维向量
+    :param k: Integer. 降维后的维度
+    :param method: String. "pca" or "random_projection"
+    """
+    from sklearn.decomposition import PCA
+    from sklearn.random_projection import GaussianRandomProjection
+
+    feedids, vectors = read_feed_embeddings()
+    if method == "pca":
+        projection = PCA(n_components=k, random_state=SEED)
+    else:
+        projection = GaussianRandomProjection(n_components=k, random_state=SEED)
+    projected = projection.fit_transform(vectors)
+    # 整体缩放到单位标准差，float16下保持精度
+    projected = projected / max(float(projected.std()), 1e-12)
+    table = np.zeros((max(feedids.max(), pd.read_csv(FEED_INFO)["feedid"].max()) + 1, k), dtype=np.float16)
+    table[feedids] = projected
+    print('Save to: %s' % FEED_EMBEDDING_TABLE)
+    np.save(FEED_EMBEDDING_TABLE, table)
+
+
+@PROFILER.profiled(key="stage")
+def generate_sample(stage="evaluate"):
+    """
+    生成评估/提交阶段的样本（训练样本由build_interaction_store生成，训练时按epoch抽取负样本）
+    :param stage: String. Including "evaluate"/"submit"
     :return: List of sample df
     """
     day = STAGE_END_DAY[stage]
-    if stage == "submit":
-        sample_path = TEST_FILE
-    else:
-        sample_path = USER_ACTION
     stage_dir = os.path.join(ROOT_PATH, stage)
-    df = pd.read_csv(sample_path)
-    df_arr = []
+    file_name = os.path.join(stage_dir, stage + "_" + "all" + "_" + str(day) + "_generate_sample.csv")
     if stage == "evaluate":
         # 线下评估
+        df = pd.read_csv(USER_ACTION)
         col = ["userid", "feedid", "date_", "device"] + ACTION_LIST
         df = df[df["date_"] == day][col]
-        file_name = os.path.join(stage_dir, stage + "_" + "all" + "_" + str(day) + "_generate_sample.csv")
-        print('Save to: %s'%file_name)
-        df.to_csv(file_name, index=False)
-        df_arr.append(df)
     elif stage == "submit":
         # 线上提交
-        file_name = os.path.join(stage_dir, stage + "_" + "all" + "_" + str(day) + "_generate_sample.csv")
+        df = pd.read_csv(TEST_FILE)
         df["date_"] = 15
-        print('Save to: %s'%file_name)
-        df.to_csv(file_name, index=False)
-        df_arr.append(df)
     else:
-        # 线下/线上训练
-        # 同行为取按时间最近的样本
-        for action in ACTION_LIST:
-            df = df.drop_duplicates(subset=['userid', 'feedid', action], keep='last')
-        # 负样本下采样
-        for action in ACTION_LIST:
-            action_df = df[(df["date_"] <= day) & (df["date_"] >= day - ACTION_DAY_NUM[action] + 1)]
-            df_neg = action_df[action_df[action] == 0]
-            df_pos = action_df[action_df[action] == 1]
-            # df_pos = pd.concat([df_pos] * int(1 / POS_RATIO[action]))
-            df_neg = df_neg.sample(frac=ACTION_SAMPLE_RATE[action], random_state=SEED, replace=False)
-            df_all = pd.concat([df_neg, df_pos])
-            col = ["userid", "feedid", "date_", "device"] + [action]
-            file_name = os.path.join(stage_dir, stage + "_" + action + "_" + str(day) + "_generate_sample.csv")
-            print('Save to: %s'%file_name)
-            df_all[col].to_csv(file_name, index=False)
-            df_arr.append(df_all[col])
-    return df_arr
-
-
-def concat_sample(sample_arr, stage="offline_train"):
+        raise ValueError("training samples are drawn per epoch from the interaction store, stage: %s" % stage)
+    print('Save to: %s'%file_name)
+    df.to_csv(file_name, index=False)
+    return [df]
+
+
+@PROFILER.profiled()
+def build_feature_engine():
     """
-    基于样本数据和特征，生成特征数据
-    :param sample_arr: List of sample df
-    :param stage: String. Including "online_train"/"offline_train"/"evaluate"/"submit"
+    userid/feedid/authorid及userid×authorid、userid×bgm_singer_id的多窗口统计特征表（feature_engine.build_tables）
+    """
+    history_data = pd.read_csv(USER_ACTION)[["userid", "feedid", "date_"] + ACTION_LIST]
+    feed_info = pd.read_csv(FEED_INFO)[["feedid", "authorid", "bgm_song_id", "bgm_singer_id"]]
+    history_data = history_data.merge(feed_info, on="feedid", how="left")
+    # 与样本一致，feed属性加1，0 用于填未知
+    for col in ["authorid", "bgm_song_id", "bgm_singer_id"]:
+        history_data[col] = (history_data[col] + 1).fillna(0).astype(np.int64)
+    build_tables(history_data, ENGINE_KEYS, ACTION_LIST, ENGINE_DAYS, ENGINE_WINDOWS, ENGINE_DECAY,
+                 ENGINE_PRIOR_STRENGTH, FEATURE_ENGINE_PATH)
+    print('Save to: %s' % FEATURE_ENGINE_PATH)
+
+
+def read_feature_tables():
+    """
+    :return: (feed信息表, feedid历史统计特征, userid历史统计特征, 多窗口统计特征表)，按join的key建索引
     """
-    day = STAGE_END_DAY[stage]
     # feed信息表
     feed_info = pd.read_csv(FEED_INFO)
     feed_info = feed_info.set_index('feedid')
@@ -177,63 +265,190 @@ def concat_sample(sample_arr, stage="offline_train"):
     feed_date_feature_path = os.path.join(ROOT_PATH, "feature", "feedid_feature.csv")
     feed_date_feature = pd.read_csv(feed_date_feature_path)
     feed_date_feature = feed_date_feature.set_index(["feedid", "date_"])
+    return feed_info, feed_date_feature, user_date_feature, FeatureTables(FEATURE_ENGINE_PATH)
+
+
+def join_features(sample, feed_info, feed_date_feature, user_date_feature, engine_tables):
+    """
+    样本 (userid, feedid, date_, device, ...) 拼接feed信息和样本日期的历史统计特征（多窗口特征按 (key, 日期) gather），
+    并做与模型输入相同的变换
+    :return: DataFrame with SAMPLE_FEATURES
+    """
+    sample = sample.join(feed_info, on="feedid", how="left", rsuffix="_feed")
+    sample = sample.join(feed_date_feature, on=["feedid", "date_"], how="left", rsuffix="_feed")
+    sample = sample.join(user_date_feature, on=["userid", "date_"], how="left", rsuffix="_user")
+    feed_feature_col = [b+"sum" for b in FEA_COLUMN_LIST]
+    user_feature_col = [b+"sum_user" for b in FEA_COLUMN_LIST]
+    sample[feed_feature_col] = sample[feed_feature_col].fillna(0.0)
+    sample[user_feature_col] = sample[user_feature_col].fillna(0.0)
+    sample[feed_feature_col] = np.log(sample[feed_feature_col] + 1.0)
+    sample[user_feature_col] = np.log(sample[user_feature_col] + 1.0)
+
+    sample[["authorid", "bgm_song_id", "bgm_singer_id"]] += 1  # 0 用于填未知
+    sample[["authorid", "bgm_song_id", "bgm_singer_id", "videoplayseconds"]] = \
+        sample[["authorid", "bgm_song_id", "bgm_singer_id", "videoplayseconds"]].fillna(0)
+    sample["videoplayseconds"] = np.log(sample["videoplayseconds"] + 1.0)
+
+    sample[["authorid", "bgm_song_id", "bgm_singer_id"]] = \
+        sample[["authorid", "bgm_song_id", "bgm_singer_id"]].astype(int)
+    engine_features = engine_tables.gather({name: sample[name].values for name in SAMPLE_ID_FEATURES},
+                                           sample["date_"].values)
+    sample = pd.concat([sample.reset_index(drop=True), pd.DataFrame(engine_features)], axis=1)
+    return sample
 
-    for index, sample in enumerate(sample_arr):
-        features = ["userid", "feedid", "device", "authorid", "bgm_song_id", "bgm_singer_id",
-                    "videoplayseconds"]
-        if stage == "evaluate":
-            action = "all"
-            features += ACTION_LIST
-        elif stage == "submit":
-            action = "all"
-        else:
-            action = ACTION_LIST[index]
-            features += [action]
-        print("action: ", action)
-        sample = sample.join(feed_info, on="feedid", how="left", rsuffix="_feed")
-        sample = sample.join(feed_date_feature, on=["feedid", "date_"], how="left", rsuffix="_feed")
-        sample = sample.join(user_date_feature, on=["userid", "date_"], how="left", rsuffix="_user")
-        feed_feature_col = [b+"sum" for b in FEA_COLUMN_LIST]
-        user_feature_col = [b+"sum_user" for b in FEA_COLUMN_LIST]
-        sample[feed_feature_col] = sample[feed_feature_col].fillna(0.0)
-        sample[user_feature_col] = sample[user_feature_col].fillna(0.0)
-        sample[feed_feature_col] = np.log(sample[feed_feature_col] + 1.0)
-        sample[user_feature_col] = np.log(sample[user_feature_col] + 1.0)
-        features += feed_feature_col
-        features += user_feature_col
-
-        sample[["authorid", "bgm_song_id", "bgm_singer_id"]] += 1  # 0 用于填未知
-        sample[["authorid", "bgm_song_id", "bgm_singer_id", "videoplayseconds"]] = \
-            sample[["authorid", "bgm_song_id", "bgm_singer_id", "videoplayseconds"]].fillna(0)
-        sample["videoplayseconds"] = np.log(sample["videoplayseconds"] + 1.0)
-
-        sample[["authorid", "bgm_song_id", "bgm_singer_id"]] = \
-            sample[["authorid", "bgm_song_id", "bgm_singer_id"]].astype(int)
-        file_name = os.path.join(ROOT_PATH, stage, stage + "_" + action + "_" + str(day) + "_concate_sample.csv")
+
+@PROFILER.profiled()
+def build_interaction_store():
+    """
+    训练样本库：user_action按 (userid, feedid) 去重（保留最近一次）后的全部曝光，拼接特征后按列保存
+    （id为int64，特征为float32，标签和日期为int8），线上/线下训练的各个行为共用，训练时按日期窗口
+    （ACTION_DAY_NUM）选样本、每个epoch按ACTION_SAMPLE_RATE重新抽取负样本，改变采样参数不需要重建
+    """
+    tables = read_feature_tables()
+    df = pd.read_csv(USER_ACTION)[["userid", "feedid", "date_", "device"] + ACTION_LIST]
+    df = df.sort_values("date_", kind="mergesort").drop_duplicates(["userid", "feedid"], keep="last")
+    columns = {name: [] for name in SAMPLE_FEATURES + ["date_"] + ACTION_LIST}
+    # 按天拼接特征，限制峰值内存
+    for _, part in df.groupby("date_", sort=True):
+        part = join_features(part, *tables)
+        for name, parts in columns.items():
+            parts.append(part[name].values)
+    tmp_dir = INTERACTION_STORE_PATH + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, parts in columns.items():
+        dtype = np.int64 if name in SAMPLE_ID_FEATURES else np.int8 if name in ["date_"] + ACTION_LIST else np.float32
+        np.save(os.path.join(tmp_dir, name + ".npy"), np.concatenate(parts).astype(dtype))
+    shutil.rmtree(INTERACTION_STORE_PATH, ignore_errors=True)
+    os.rename(tmp_dir, INTERACTION_STORE_PATH)
+    print('Save %d interactions to: %s' % (len(df), INTERACTION_STORE_PATH))
+
+
+def load_interaction_store(path=INTERACTION_STORE_PATH):
+    """
+    :return: Dict. column name -> np.memmap
+    """
+    return {name[:-len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r")
+            for name in os.listdir(path) if name.endswith(".npy")}
+
+
+@PROFILER.profiled(key="stage")
+def concat_sample(sample_arr, stage="evaluate"):
+    """
+    基于样本数据和特征，生成特征数据
+    :param sample_arr: List of sample df
+    :param stage: String. Including "evaluate"/"submit"
+    """
+    day = STAGE_END_DAY[stage]
+    tables = read_feature_tables()
+    for sample in sample_arr:
+        features = SAMPLE_FEATURES + (ACTION_LIST if stage == "evaluate" else [])
+        sample = join_features(sample, *tables)
+        file_name = os.path.join(ROOT_PATH, stage, stage + "_all_" + str(day) + "_concate_sample.csv")
         print('Save to: %s'%file_name)
         sample[features].to_csv(file_name, index=False)
 
 
-def main():
+def sample_files(stage):
+    """
+    评估/提交阶段的样本文件：generate_sample和concat_sample的输出
+    :return: List of paths
+    """
+    return [os.path.join(ROOT_PATH, stage, "%s_all_%d_%s.csv" % (stage, STAGE_END_DAY[stage], kind))
+            for kind in ["generate_sample", "concate_sample"]]
+
+
+def stage_sample(stage):
+    """
+    生成stage阶段的样本并拼接特征
+    """
+    concat_sample(generate_sample(stage), stage)
+
+
+def build_feature_store():
+    # feature_store依赖本模块的常量，在此处导入
+    from feature_store import build_snapshot
+    with PROFILER.stage("build_snapshot"):
+        build_snapshot(day=STAGE_END_DAY["submit"])
+
+
+def build_pipeline(workers=1):
+    """
+    数据处理DAG：统计特征、高频词表、feed向量压缩、训练样本库、评估/提交样本、特征库快照
+    每个阶段声明读取的文件、常量和写入的文件，输入、常量或代码没有改变且输出完好时跳过
+    :param workers: Int. 并发运行的阶段数
+    :return: Pipeline
+    """
+    from feature_store import FEATURE_STORE_PATH, CURRENT_FILE, build_snapshot
+
+    feature_dir = os.path.join(ROOT_PATH, "feature")
+    stat_files = [os.path.join(feature_dir, dim + "_feature.csv") for dim in ["userid", "feedid"]]
+    stages = [
+        Stage("statis_feature", statis_feature, inputs=[USER_ACTION], outputs=stat_files,
+              params={"END_DAY": END_DAY, "FEA_COLUMN_LIST": FEA_COLUMN_LIST}),
+        Stage("generate_hot_vocab", generate_hot_vocab, inputs=[USER_ACTION, FEED_INFO],
+              outputs=[os.path.join(feature_dir, "hot_" + dim + ".txt") for dim in HOT_VOCAB_DIMS],
+              params={"evaluate_day": STAGE_END_DAY["evaluate"]}),
+        Stage("compress_feed_embeddings", compress_feed_embeddings, inputs=[FEED_EMBEDDINGS, FEED_INFO],
+              outputs=[FEED_EMBEDDING_TABLE], params={"SEED": SEED}, kwargs={"k": FEED_EMBEDDING_DIM}),
+        Stage("feature_engine", build_feature_engine, inputs=[USER_ACTION, FEED_INFO], outputs=[FEATURE_ENGINE_PATH],
+              params={"ACTION_LIST": ACTION_LIST, "ENGINE_KEYS": ENGINE_KEYS, "ENGINE_WINDOWS": ENGINE_WINDOWS,
+                      "ENGINE_DECAY": ENGINE_DECAY, "ENGINE_PRIOR_STRENGTH": ENGINE_PRIOR_STRENGTH,
+                      "ENGINE_DAYS": ENGINE_DAYS},
+              code=[build_feature_engine, feature_engine]),
+    ]
+    # 拼接样本特征的阶段读取统计特征和多窗口特征表
+    stat_files = stat_files + [FEATURE_ENGINE_PATH]
+    # 训练样本不做下采样（ACTION_SAMPLE_RATE、ACTION_DAY_NUM在训练时使用），采样参数不是任何阶段的参数
+    stages.append(Stage("interaction_store", build_interaction_store, inputs=[USER_ACTION, FEED_INFO] + stat_files,
+                        outputs=[INTERACTION_STORE_PATH], params={"ACTION_LIST": ACTION_LIST,
+                                                                  "FEA_COLUMN_LIST": FEA_COLUMN_LIST},
+                        code=[build_interaction_store, join_features, read_feature_tables]))
+    for stage in ["evaluate", "submit"]:
+        stages.append(Stage("sample[%s]" % stage, stage_sample, kwargs={"stage": stage},
+                            inputs=[TEST_FILE if stage == "submit" else USER_ACTION, FEED_INFO] + stat_files,
+                            outputs=sample_files(stage),
+                            params={"day": STAGE_END_DAY[stage], "ACTION_LIST": ACTION_LIST,
+                                    "FEA_COLUMN_LIST": FEA_COLUMN_LIST},
+                            code=[stage_sample, generate_sample, concat_sample, join_features, read_feature_tables]))
+    stages.append(Stage("build_snapshot", build_feature_store, inputs=[FEED_INFO, USER_ACTION] + stat_files,
+                        outputs=[os.path.join(FEATURE_STORE_PATH, CURRENT_FILE)],
+                        params={"day": STAGE_END_DAY["submit"]}, code=[build_feature_store, build_snapshot]))
+    return Pipeline(stages, PIPELINE_STATE, workers, PROFILER)
+
+
+def main(command="run", targets=None, force=(), workers=1):
+    """
+    :param command: String. "run": 运行需要重跑的阶段；"status": 只检查；"statis": 打印原始数据的统计信息
+    :param targets: List of stage names or None (all)
+    :param force: List of stage names to rerun
+    :param workers: Int. 并发运行的阶段数
+    """
     t = time.time()
-    statis_data()
+    if command == "statis":
+        statis_data()
+        return
     logger.info('Create dir and check file')
     create_dir()
     flag, not_exists_file = check_file()
     if not flag:
         print("请检查目录中是否存在下列文件: ", ",".join(not_exists_file))
         return
-    logger.info('Generate statistic feature')
-    statis_feature()
-    for stage in STAGE_END_DAY:
-        logger.info("Stage: %s"%stage)
-        logger.info('Generate sample')
-        sample_arr = generate_sample(stage)
-        logger.info('Concat sample with feature')
-        concat_sample(sample_arr, stage)
+    pipeline = build_pipeline(workers)
+    if command == "status":
+        pipeline.status(targets)
+        return
+    ran = pipeline.run(targets, force)
+    print('Ran %d stages: %s' % (len(ran), ", ".join(ran) or "none"))
     print('Time cost: %.2f s'%(time.time()-t))
 
 
 if __name__ == "__main__":
-    main()
-    
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "status", "statis"])
+    parser.add_argument("--targets", nargs="+", help="stages to bring up to date (default: all)")
+    parser.add_argument("--force", nargs="+", default=[], help="stages to rerun even if up to date")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1))
+    args = parser.parse_args()
+    main(args.command, args.targets, args.force, args.workers)
@@ -77,6 +77,19 @@ def compute_weighted_score(score_dict, weight_dict):
     return score
 
 
+def compute_weighted_scores(scores, actions, weight_dict):
+    '''按compute_weighted_score的权重，对每行多个行为的得分加权平均（向量化，不取整）
+    Input:
+        scores: 每行各行为的得分, array [N, len(actions)]
+        actions: scores各列对应的行为, list
+        weights_dict: 多个行为的权重映射字典, dict
+    Output:
+        score: 加权得分, float array [N]
+    '''
+    weights = np.array([float(weight_dict[action]) for action in actions])
+    return np.asarray(scores, dtype=np.float64).dot(weights / weights.sum())
+
+
 def score(result_data, label_data, mode="初赛"):
     '''评测结果: 多个行为的加权uAUC分数
     Input:
@@ -0,0 +1,217 @@
+# coding: utf-8
+"""
+多窗口行为统计特征引擎：所有窗口、所有派生特征在一次向量化计算中得到，不再按 (窗口, 特征) 分别groupby
+- key：单个id（userid/feedid/authorid）或组合id（userid×authorid等，int64组合key = a << 32 | b），
+  np.unique排序后的下标为key的行号
+- 按key分块构建每天的计数立方体 counts [块内key数, 天, 通道]（通道：曝光数 + 各行为正样本数，np.bincount），
+  沿天累加一次后，任意目标日t、窗口w（t之前的w天）的计数都是两个前缀和之差；指数衰减计数按天递推
+- 派生特征（每个窗口及衰减各一组）：log(1+曝光数)，各行为的贝叶斯平滑点击率 (正样本 + s*m) / (曝光 + s)，
+  先验Beta(s*m, s*(1-m))的均值m为同一窗口的全局比率，以及各行为的原始比率 正样本 / max(曝光, 1)
+- 输出：每种key一个目录，keys.npy（升序int64）和values.npy（float16 [key数+1, 目标日数, 特征数]，
+  最后一行为没有历史的key的默认值），np.load(mmap_mode='r') 读取，按 (key, 样本日期) searchsorted + gather
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+def composite_keys(columns):
+    '''
+    :param columns: List of non-negative int arrays (< 2**32)
+    :return: int64 array. 一列为原值，两列为 a << 32 | b
+    '''
+    keys = np.asarray(columns[0], dtype=np.int64)
+    for column in columns[1:]:
+        keys = (keys << 32) | (np.asarray(column, dtype=np.int64) & 0xFFFFFFFF)
+    return keys
+
+
+def lookup(keys, query):
+    '''
+    :param keys: Sorted int64 array
+    :return: int64 array of rows, 不在keys中的为len(keys)（默认行）
+    '''
+    rows = np.searchsorted(keys, query)
+    found = rows < len(keys)
+    found[found] = keys[rows[found]] == query[found]
+    return np.where(found, rows, len(keys))
+
+
+def day_counts(codes, dates, channels, num_keys, num_days):
+    '''
+    :param codes: int array [N]. key行号，[0, num_keys)
+    :param dates: int array [N]. 日期，[0, num_days]
+    :param channels: float array [N, C]. 每条曝光的计数（曝光为1，各行为的标签）
+    :return: float32 array [num_keys, num_days + 1, C]（下标为日期）
+    '''
+    index = np.asarray(codes, dtype=np.int64) * (num_days + 1) + np.asarray(dates, dtype=np.int64)
+    size = num_keys * (num_days + 1)
+    cube = np.empty((size, channels.shape[1]), dtype=np.float32)
+    for c in range(channels.shape[1]):
+        cube[:, c] = np.bincount(index, weights=channels[:, c], minlength=size)
+    return cube.reshape(num_keys, num_days + 1, channels.shape[1])
+
+
+def window_sums(counts, days, windows):
+    '''
+    :param counts: Array [K, D + 1, C]. day_counts的结果
+    :param days: List of target days (<= D + 1)
+    :param windows: List of window lengths
+    :return: float32 array [K, len(days), len(windows), C]. 目标日t之前w天 [t - w, t - 1] 的和
+    '''
+    prefix = np.zeros((counts.shape[0], counts.shape[1] + 1, counts.shape[2]), dtype=np.float32)
+    np.cumsum(counts, axis=1, out=prefix[:, 1:])
+    days = np.asarray(days)
+    low = np.maximum(days[:, None] - np.asarray(windows)[None, :], 0)
+    return prefix[:, days][:, :, None] - prefix[:, low]
+
+
+def decayed_sums(counts, days, decay):
+    '''
+    :return: float32 array [K, len(days), C]. 目标日t之前各天的计数按decay ** (t - 1 - d) 加权的和
+    '''
+    index = {day: i for i, day in enumerate(days)}
+    result = np.zeros((counts.shape[0], len(days), counts.shape[2]), dtype=np.float32)
+    state = np.zeros((counts.shape[0], counts.shape[2]), dtype=np.float32)
+    for day in range(1, max(days) + 1):
+        state = state * decay + counts[:, day - 1]
+        if day in index:
+            result[:, index[day]] = state
+    return result
+
+
+def feature_names(keys, windows, actions):
+    '''
+    :param keys: Iterable of key names
+    :return: List of feature names in the order of values.npy (key by key)
+    '''
+    names = []
+    for name in keys:
+        for window in ["%dd" % w for w in windows] + ["decay"]:
+            names.append("%s_exposure_%s" % (name, window))
+            names.extend("%s_%s_ctr_%s" % (name, action, window) for action in actions)
+            names.extend("%s_%s_rate_%s" % (name, action, window) for action in actions)
+    return names
+
+
+def _sums(counts, days, windows, decay):
+    '''
+    :return: float32 array [K, len(days), len(windows) + 1, C]. 各窗口的和及衰减和
+    '''
+    return np.concatenate([window_sums(counts, days, windows), decayed_sums(counts, days, decay)[:, :, None]], axis=2)
+
+
+def _features(counts, days, windows, decay, prior_strength, prior):
+    '''
+    :return: float32 array [K, len(days), (len(windows) + 1) * (2 * C - 1)]. 每组：曝光数、平滑点击率、原始比率
+    '''
+    sums = _sums(counts, days, windows, decay)
+    exposure = sums[..., :1]
+    ctr = (sums[..., 1:] + prior_strength * prior) / (exposure + prior_strength)
+    rate = sums[..., 1:] / np.maximum(exposure, 1.0)
+    return np.concatenate([np.log1p(exposure), ctr, rate], axis=3).reshape(len(counts), len(days), -1)
+
+
+def build_tables(data, keys, actions, days, windows, decay, prior_strength, path, block_size=1 << 16):
+    '''
+    计算所有key的特征表并写入path（先写临时目录再改名）
+    :param data: Dict or DataFrame. 每条曝光一行：date_、keys用到的id列、actions标签列
+    :param keys: Dict. key name -> list of id columns (1 or 2)
+    :param actions: List of label columns
+    :param days: List of target days (样本日期)
+    :param windows: List of window lengths (days)
+    :param decay: Float. 衰减计数每天的衰减系数
+    :param prior_strength: Float. 平滑点击率的先验强度s（相当于s次先验曝光）
+    :param block_size: Int. 每块的key数，限制计数立方体的内存
+    '''
+    days = [int(day) for day in days]
+    dates = np.asarray(data["date_"], dtype=np.int64)
+    num_days = max(int(dates.max()), max(days) - 1)
+    channels = np.ones((len(dates), len(actions) + 1), dtype=np.float32)
+    for i, action in enumerate(actions):
+        channels[:, i + 1] = data[action]
+    # 先验均值：所有key合计的同一窗口比率
+    totals = _sums(day_counts(np.zeros_like(dates), dates, channels, 1, num_days), days, windows, decay)[0]
+    prior = totals[..., 1:] / np.maximum(totals[..., :1], 1.0)
+
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    meta = {"days": days, "windows": list(windows), "decay": decay, "prior_strength": prior_strength,
+            "actions": list(actions), "keys": {}}
+    for name, columns in keys.items():
+        unique, codes = np.unique(composite_keys([data[column] for column in columns]), return_inverse=True)
+        codes = codes.reshape(-1)
+        # 按key行号排序，每块key的曝光是连续的一段
+        order = np.argsort(codes, kind="stable")
+        starts = np.searchsorted(codes[order], np.arange(0, len(unique) + block_size, block_size))
+        num_features = (len(windows) + 1) * (2 * len(actions) + 1)
+        os.makedirs(os.path.join(tmp, name))
+        np.save(os.path.join(tmp, name, "keys.npy"), unique)
+        values = np.lib.format.open_memmap(os.path.join(tmp, name, "values.npy"), mode="w+", dtype=np.float16,
+                                           shape=(len(unique) + 1, len(days), num_features))
+        for block, start in enumerate(range(0, len(unique), block_size)):
+            end = min(start + block_size, len(unique))
+            rows = order[starts[block]:starts[block + 1]]
+            counts = day_counts(codes[rows] - start, dates[rows], channels[rows], end - start, num_days)
+            values[start:end] = _features(counts, days, windows, decay, prior_strength, prior)
+        values[-1] = _features(np.zeros((1, num_days + 1, len(actions) + 1), dtype=np.float32), days, windows,
+                               decay, prior_strength, prior)[0]
+        values.flush()
+        del values
+        meta["keys"][name] = {"columns": list(columns), "size": len(unique),
+                              "features": feature_names([name], windows, actions)}
+        print("%s: %d keys, %d features x %d days" % (name, len(unique), num_features, len(days)))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+
+
+class FeatureTables(object):
+    '''
+    读取build_tables的输出（mmap）
+    '''
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.days = np.asarray(self.meta["days"], dtype=np.int64)
+        self.keys, self.values = {}, {}
+        for name in self.meta["keys"]:
+            self.keys[name] = np.load(os.path.join(path, name, "keys.npy"), mmap_mode="r")
+            self.values[name] = np.load(os.path.join(path, name, "values.npy"), mmap_mode="r")
+
+    @property
+    def feature_names(self):
+        return [feature for key in self.meta["keys"].values() for feature in key["features"]]
+
+    def gather(self, columns, dates):
+        '''
+        :param columns: Dict. id column name -> int array [N]（feed属性列与样本一致，已加1）
+        :param dates: int array [N] or int. 样本日期，不在目标日中的样本特征为0
+        :return: Dict. feature name -> float32 array [N]
+        '''
+        dates = np.asarray(dates, dtype=np.int64)
+        day_index = np.searchsorted(self.days, dates)
+        valid = (day_index < len(self.days)) & (self.days[np.minimum(day_index, len(self.days) - 1)] == dates)
+        day_index = np.minimum(day_index, len(self.days) - 1)
+        features = {}
+        for name, key in self.meta["keys"].items():
+            rows = lookup(self.keys[name], composite_keys([columns[column] for column in key["columns"]]))
+            values = np.asarray(self.values[name][rows, day_index], dtype=np.float32)
+            values = values * np.reshape(valid, valid.shape + (1,))
+            for i, feature in enumerate(key["features"]):
+                features[feature] = values[..., i]
+        return features
+
+    def day_table(self, name, day):
+        '''
+        :return: (sorted int64 keys, float32 values [K + 1, F]). 一个目标日的特征表（在线特征库快照）
+        '''
+        day_index = int(np.searchsorted(self.days, day))
+        if day_index >= len(self.days) or self.days[day_index] != day:
+            raise ValueError("day %d not in the feature tables, days: %s" % (day, self.days.tolist()))
+        return np.asarray(self.keys[name]), np.asarray(self.values[name][:, day_index], dtype=np.float32)
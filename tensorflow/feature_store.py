@@ -0,0 +1,252 @@
+# coding: utf-8
+"""
+在线打分用的内存特征库：feed_info列、用户/feed历史行为统计、多窗口统计特征（concat_sample拼接的特征）
+- 按id下标的紧凑数组表：id -> 行号（int32，未知为最后一行的默认值），每张表一个typed矩阵
+- 多窗口统计特征：每种key（含userid×authorid等组合key）快照日的一张表，升序key + searchsorted
+- 快照：每次构建写入 {store_dir}/snapshots/{version}/*.npy，np.load(mmap_mode='r') 打开，进程启动不需要解析CSV
+- 原子切换：CURRENT文件记录当前版本，先写临时文件再os.replace；读进程refresh()时切换到新快照，
+  get() 只读取一次快照引用，切换期间的请求不受影响
+- get(user_ids, feed_ids) 一次gather组装模型输入（与concat_sample的变换相同）
+
+  python feature_store.py build --day=15          # comm.py之后构建并发布快照（comm.main中自动执行）
+  python feature_store.py benchmark               # get()与pandas join的耗时对比
+"""
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from comm import ROOT_PATH, DATASET_PATH, END_DAY, FEA_COLUMN_LIST
+from feature_engine import FeatureTables, composite_keys, lookup
+
+FEATURE_STORE_PATH = os.path.join(ROOT_PATH, "feature_store")
+# feed表：id列（authorid/bgm id加1，0为缺失）和数值列（log(x+1)）
+FEED_ID_COLUMNS = ["authorid", "bgm_song_id", "bgm_singer_id"]
+FEED_VALUE_COLUMNS = ["videoplayseconds"] + [b + "sum" for b in FEA_COLUMN_LIST]
+# 用户表：最近一次行为的device和历史行为次数（log(x+1)）
+USER_VALUE_COLUMNS = ["device"] + [b + "sum_user" for b in FEA_COLUMN_LIST]
+CURRENT_FILE = "CURRENT"
+
+
+def _index(ids):
+    '''
+    id -> 行号的下标数组，未出现的id为len(ids)（默认行）
+    '''
+    index = np.full(int(ids.max()) + 1 if len(ids) else 0, len(ids), dtype=np.int32)
+    index[ids] = np.arange(len(ids), dtype=np.int32)
+    return index
+
+
+def build_snapshot(store_dir=FEATURE_STORE_PATH, day=END_DAY, root_path=ROOT_PATH, keep=3):
+    '''
+    从comm.py的输出构建day日的特征快照并发布为当前版本
+    :param day: Int. 请求所在日期，用户/feed统计特征取该日（前7天）的值
+    :param keep: Int. 保留的快照个数（含当前版本）
+    :return: String. 版本号
+    '''
+    dataset_path = os.path.join(root_path, os.path.basename(DATASET_PATH))
+    feed_info = pd.read_csv(os.path.join(dataset_path, "feed_info.csv"))
+    feed_stat = pd.read_csv(os.path.join(root_path, "feature", "feedid_feature.csv"))
+    feed_stat = feed_stat[feed_stat["date_"] == day].set_index("feedid")
+    user_stat = pd.read_csv(os.path.join(root_path, "feature", "userid_feature.csv"))
+    user_stat = user_stat[user_stat["date_"] == day].set_index("userid")
+    user_action = pd.read_csv(os.path.join(dataset_path, "user_action.csv"), usecols=["userid", "date_", "device"])
+
+    # feed表：行号按feed_info顺序，最后一行为默认值（全0）
+    feed_ids = feed_info["feedid"].values.astype(np.int64)
+    feed_id_matrix = np.zeros((len(feed_ids) + 1, len(FEED_ID_COLUMNS)), dtype=np.int64)
+    feed_id_matrix[:-1] = (feed_info[FEED_ID_COLUMNS] + 1).fillna(0).values.astype(np.int64)
+    feed_values = np.zeros((len(feed_ids) + 1, len(FEED_VALUE_COLUMNS)), dtype=np.float32)
+    feed_values[:-1, 0] = np.log(feed_info["videoplayseconds"].fillna(0).values + 1.0)
+    stat = feed_stat.reindex(feed_ids)[[b + "sum" for b in FEA_COLUMN_LIST]].fillna(0.0).values
+    feed_values[:-1, 1:] = np.log(stat + 1.0)
+
+    # 用户表：出现在行为日志或统计特征中的用户
+    user_ids = np.union1d(user_action["userid"].unique(), user_stat.index.values).astype(np.int64)
+    user_values = np.zeros((len(user_ids) + 1, len(USER_VALUE_COLUMNS)), dtype=np.float32)
+    last = user_action.sort_values("date_", kind="mergesort").drop_duplicates("userid", keep="last")
+    user_values[:-1, 0] = last.set_index("userid")["device"].reindex(user_ids).fillna(0).values
+    stat = user_stat.reindex(user_ids)[[b + "sum" for b in FEA_COLUMN_LIST]].fillna(0.0).values
+    user_values[:-1, 1:] = np.log(stat + 1.0)
+
+    # 多窗口统计特征：day日的表
+    engine = FeatureTables(os.path.join(root_path, "feature", "engine"))
+    engine_keys = {name: {"columns": key["columns"], "features": key["features"]}
+                   for name, key in engine.meta["keys"].items()}
+
+    # 版本号以构建时间开头，按名称排序即按构建顺序
+    now = time.time()
+    version = "%s%03d_day%d" % (time.strftime("%Y%m%d%H%M%S", time.localtime(now)), int(now * 1000) % 1000, day)
+    snapshot_dir = os.path.join(store_dir, "snapshots", version)
+    tmp_dir = snapshot_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    arrays = {"feed_index": _index(feed_ids), "feed_ids": feed_id_matrix, "feed_values": feed_values,
+              "user_index": _index(user_ids), "user_values": user_values}
+    for name in engine_keys:
+        arrays["engine_%s_keys" % name], arrays["engine_%s_values" % name] = engine.day_table(name, day)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), array)
+    meta = {"version": version, "day": day, "num_feeds": len(feed_ids), "num_users": len(user_ids),
+            "feed_id_columns": FEED_ID_COLUMNS, "feed_value_columns": FEED_VALUE_COLUMNS,
+            "user_value_columns": USER_VALUE_COLUMNS, "engine_keys": engine_keys}
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    os.rename(tmp_dir, snapshot_dir)
+    publish(store_dir, version)
+    print("Feature store snapshot %s: %d feeds, %d users" % (version, len(feed_ids), len(user_ids)))
+
+    # 清理旧快照
+    snapshots = sorted(name for name in os.listdir(os.path.join(store_dir, "snapshots"))
+                       if not name.endswith(".tmp"))
+    for name in snapshots[:-keep]:
+        if name != version:
+            shutil.rmtree(os.path.join(store_dir, "snapshots", name), ignore_errors=True)
+    return version
+
+
+def publish(store_dir, version):
+    '''
+    原子地把CURRENT指向version
+    '''
+    tmp = os.path.join(store_dir, CURRENT_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(store_dir, CURRENT_FILE))
+
+
+class _Snapshot(object):
+
+    def __init__(self, snapshot_dir):
+        with open(os.path.join(snapshot_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.version = self.meta["version"]
+        for name in ["feed_index", "feed_ids", "feed_values", "user_index", "user_values"]:
+            setattr(self, name, np.load(os.path.join(snapshot_dir, name + ".npy"), mmap_mode="r"))
+        self.engine = {name: (np.load(os.path.join(snapshot_dir, "engine_%s_keys.npy" % name), mmap_mode="r"),
+                              np.load(os.path.join(snapshot_dir, "engine_%s_values.npy" % name), mmap_mode="r"))
+                       for name in self.meta.get("engine_keys", {})}
+
+
+class FeatureStore(object):
+    '''
+    读取当前快照的特征库，get() 线程安全
+    '''
+
+    def __init__(self, store_dir=FEATURE_STORE_PATH):
+        self.store_dir = store_dir
+        self._snapshot = None
+        self._lock = threading.Lock()
+        if not self.refresh():
+            raise IOError("no feature store snapshot in %s, run feature_store.py build" % store_dir)
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def refresh(self):
+        '''
+        如果CURRENT指向新版本，打开新快照并切换
+        :return: Boolean. 是否切换
+        '''
+        path = os.path.join(self.store_dir, CURRENT_FILE)
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            version = f.read().strip()
+        with self._lock:
+            if self._snapshot is not None and self._snapshot.version == version:
+                return False
+            self._snapshot = _Snapshot(os.path.join(self.store_dir, "snapshots", version))
+        return True
+
+    @staticmethod
+    def _rows(index, ids):
+        '''
+        id -> 行号，超出下标数组范围的id为默认行
+        '''
+        rows = np.take(index, ids, mode="clip")
+        return np.where((ids >= 0) & (ids < len(index)), rows, index.dtype.type(-1))
+
+    def get(self, user_ids, feed_ids, devices=None):
+        '''
+        :param user_ids: int array [N], or one int: 一个用户的所有候选feed，用户特征只查一次再广播（只读视图）
+        :param feed_ids: int array [N]
+        :param devices: Array [N] or None (the last device of every user)
+        :return: Dict. feature name -> array [N]（concat_sample的特征列）
+        '''
+        snapshot = self._snapshot
+        feed_ids = np.asarray(feed_ids, dtype=np.int64)
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        feed_rows = self._rows(snapshot.feed_index, feed_ids)
+        user_rows = self._rows(snapshot.user_index, user_ids.reshape(-1))
+        feed_id_matrix = snapshot.feed_ids[feed_rows]
+        feed_values = snapshot.feed_values[feed_rows]
+        user_values = snapshot.user_values[user_rows]
+        if user_ids.ndim == 0:
+            user_ids = np.broadcast_to(user_ids, feed_ids.shape)
+            user_values = np.broadcast_to(user_values, (len(feed_ids), user_values.shape[1]))
+        features = {"userid": user_ids, "feedid": feed_ids}
+        for i, name in enumerate(FEED_ID_COLUMNS):
+            features[name] = feed_id_matrix[:, i]
+        for i, name in enumerate(FEED_VALUE_COLUMNS):
+            features[name] = feed_values[:, i]
+        for i, name in enumerate(USER_VALUE_COLUMNS):
+            features[name] = user_values[:, i]
+        if devices is not None:
+            features["device"] = np.asarray(devices, dtype=np.float32)
+        for name, (keys, values) in snapshot.engine.items():
+            key = snapshot.meta["engine_keys"][name]
+            rows = lookup(keys, composite_keys([features[column] for column in key["columns"]]))
+            engine_values = values[rows]
+            for i, feature in enumerate(key["features"]):
+                features[feature] = engine_values[:, i]
+        return features
+
+
+def benchmark(store, day=END_DAY, num_candidates=100, repeat=200):
+    '''
+    每个请求 (1个用户, num_candidates个feed) 组装特征的耗时：FeatureStore.get vs pandas join
+    '''
+    feed_info = pd.read_csv(os.path.join(DATASET_PATH, "feed_info.csv")).set_index("feedid")
+    feed_stat = pd.read_csv(os.path.join(ROOT_PATH, "feature", "feedid_feature.csv")).set_index(["feedid", "date_"])
+    user_stat = pd.read_csv(os.path.join(ROOT_PATH, "feature", "userid_feature.csv")).set_index(["userid", "date_"])
+    rng = np.random.RandomState(2021)
+    feed_ids = feed_info.index.values
+    user_ids = user_stat.index.get_level_values(0).unique().values
+    requests = [(user_ids[rng.randint(len(user_ids))], rng.choice(feed_ids, num_candidates)) for _ in range(repeat)]
+
+    def store_get(user, feeds):
+        store.get(np.full(len(feeds), user), feeds)
+
+    def pandas_join(user, feeds):
+        sample = pd.DataFrame({"userid": user, "feedid": feeds, "date_": day})
+        sample = sample.join(feed_info, on="feedid", how="left", rsuffix="_feed")
+        sample = sample.join(feed_stat, on=["feedid", "date_"], how="left", rsuffix="_feed")
+        sample.join(user_stat, on=["userid", "date_"], how="left", rsuffix="_user")
+
+    for name, fun in [("FeatureStore.get", store_get), ("pandas join", pandas_join)]:
+        times = []
+        for user, feeds in requests:
+            start = time.perf_counter()
+            fun(user, feeds)
+            times.append((time.perf_counter() - start) * 1e6)
+        print("%-18s %d candidates: median %.1f us, p99 %.1f us" % (
+            name, num_candidates, np.median(times), np.percentile(times, 99)))
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if command == "build":
+        day = END_DAY
+        for arg in sys.argv[2:]:
+            if arg.startswith("--day="):
+                day = int(arg.split("=", 1)[1])
+        build_snapshot(day=day)
+    elif command == "benchmark":
+        benchmark(FeatureStore())
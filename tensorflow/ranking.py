@@ -0,0 +1,163 @@
+# coding: utf-8
+"""
+按用户排序：对一个用户的候选feed预测所有行为的概率，按compute_weighted_score的权重加权，返回前K个feed
+- 特征：FeatureStore.get 传入单个userid，用户特征只查一次再广播到所有候选
+- 模型：一次前向得到所有候选、所有行为的概率（serving.py的TFSavedModelBackend / TorchScriptBackend）
+- top-K：argpartition部分排序，只对前K个排序
+- rank_many：多个用户的候选拼成一个batch查特征和前向，再按用户分段取top-K
+- serving.py的ScoringService.rank / POST /rank 经micro-batching打分后用同样的方法排序
+
+  # 逐行特征+全排序 与 广播+部分排序、多用户batch的耗时对比（模型参数同serving.py）
+  python ranking.py --num_requests=200 --max_candidates=500
+"""
+import collections
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from comm import ACTION_WEIGHT
+from evaluation import compute_weighted_scores
+
+# 一个用户的排序结果：前K个feedid（按加权得分降序）、加权得分 [K]、各行为概率 [K, 行为数]
+Ranking = collections.namedtuple("Ranking", ["feed_ids", "scores", "action_scores"])
+
+
+def top_k(scores, k):
+    '''
+    前k大的下标（降序）
+    '''
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top])]
+
+
+def rank_scores(feed_ids, action_scores, actions, k, weights=ACTION_WEIGHT):
+    '''
+    :param feed_ids: int array [N]
+    :param action_scores: float array [N, len(actions)]
+    :param weights: Dict. action -> weight
+    :return: Ranking
+    '''
+    scores = compute_weighted_scores(action_scores, actions, weights)
+    top = top_k(scores, k)
+    return Ranking(np.asarray(feed_ids)[top], scores[top], action_scores[top])
+
+
+class Ranker(object):
+    '''
+    进程内排序（不经过micro-batching）：特征库 + 模型后端
+    '''
+
+    def __init__(self, lookup, backend, weights=ACTION_WEIGHT):
+        '''
+        :param lookup: feature_store.FeatureStore
+        :param backend: serving.TFSavedModelBackend or serving.TorchScriptBackend
+        :param weights: Dict. action -> weight，默认与加权uAUC相同
+        '''
+        self.lookup = lookup
+        self.backend = backend
+        self.actions = backend.actions
+        self.weights = weights
+
+    def rank(self, user_id, candidate_feed_ids, k=10, weights=None, device=None):
+        '''
+        :param candidate_feed_ids: int array of candidate feeds
+        :param weights: Dict or None (self.weights)
+        :param device: Int or None (the last device of the user)
+        :return: Ranking
+        '''
+        candidate_feed_ids = np.asarray(candidate_feed_ids, dtype=np.int64).reshape(-1)
+        features = self.lookup.get(int(user_id), candidate_feed_ids)
+        if device is not None:
+            features["device"] = np.full(len(candidate_feed_ids), device, dtype=np.float32)
+        return rank_scores(candidate_feed_ids, self.backend.predict(features), self.actions, k,
+                           weights or self.weights)
+
+    def rank_many(self, user_ids, candidates, k=10, weights=None):
+        '''
+        多个用户一次查特征、一次前向
+        :param user_ids: List of int
+        :param candidates: List of int arrays, candidate feeds of every user
+        :return: List of Ranking
+        '''
+        sizes = [len(feeds) for feeds in candidates]
+        feed_ids = np.concatenate([np.asarray(feeds, dtype=np.int64).reshape(-1) for feeds in candidates])
+        action_scores = self.backend.predict(self.lookup.get(np.repeat(np.asarray(user_ids, dtype=np.int64), sizes),
+                                                             feed_ids))
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        return [rank_scores(feed_ids[start:end], action_scores[start:end], self.actions, k, weights or self.weights)
+                for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def benchmark(ranker, root_path, num_requests=200, num_candidates=100, k=10, batch_users=32):
+    '''
+    测试集中的用户，候选为该用户的测试feed加随机feed（共num_candidates个，模拟召回结果），比较：
+    - per-row: 逐行查用户特征，所有候选的加权得分全排序
+    - rank: 用户特征查一次再广播，argpartition部分排序
+    - rank_many: batch_users个用户一个batch
+    '''
+    test = pd.read_csv(os.path.join(root_path, "wechat_algo_data1", "test_a.csv"))
+    all_feeds = pd.read_csv(os.path.join(root_path, "wechat_algo_data1", "feed_info.csv"))["feedid"].values
+    groups = [(user, feeds.values) for user, feeds in test.groupby("userid")["feedid"]]
+    rng = np.random.RandomState(2021)
+    requests = []
+    for i in rng.randint(len(groups), size=num_requests):
+        user, feeds = groups[i]
+        extra = rng.choice(all_feeds, max(num_candidates - len(feeds), 0))
+        requests.append((user, np.concatenate([feeds, extra])[:num_candidates]))
+    lookup, backend = ranker.lookup, ranker.backend
+
+    def per_row_features(user, feeds):
+        return lookup.get(np.full(len(feeds), user), feeds)
+
+    def per_row(user, feeds):
+        scores = compute_weighted_scores(backend.predict(per_row_features(user, feeds)), ranker.actions,
+                                         ranker.weights)
+        return feeds[np.argsort(-scores)[:k]]
+
+    def timed(fun):
+        start = time.perf_counter()
+        for user, feeds in requests:
+            fun(user, feeds)
+        return (time.perf_counter() - start) * 1000.0 / len(requests)
+
+    def rank_many():
+        for i in range(0, len(requests), batch_users):
+            part = requests[i:i + batch_users]
+            ranker.rank_many([user for user, _ in part], [feeds for _, feeds in part], k)
+
+    # 结果一致性（比较得分，得分相同的候选顺序不确定）
+    user, feeds = requests[0]
+    ranking = ranker.rank(user, feeds, k)
+    scores = compute_weighted_scores(backend.predict(per_row_features(user, feeds)), ranker.actions, ranker.weights)
+    assert np.allclose(np.sort(scores)[::-1][:k], ranking.scores)
+    assert np.allclose(ranker.rank_many([user], [feeds], k)[0].scores, ranking.scores)
+
+    print("%d users, %d candidates / user, top %d" % (
+        len(requests), sum(len(feeds) for _, feeds in requests) / len(requests), k))
+    print("%-16s%14s%14s" % ("method", "features ms", "total ms"))
+    print("%-16s%14.3f%14.3f" % ("per-row + sort", timed(per_row_features), timed(per_row)))
+    print("%-16s%14.3f%14.3f" % ("rank", timed(lambda user, feeds: lookup.get(int(user), feeds)),
+                                 timed(lambda user, feeds: ranker.rank(user, feeds, k))))
+    start = time.perf_counter()
+    rank_many()
+    print("%-16s%14s%14.3f" % ("rank_many(%d)" % batch_users, "-",
+                               (time.perf_counter() - start) * 1000.0 / len(requests)))
+    print("(milliseconds per user)")
+
+
+def main(argv):
+    ranker = Ranker(FeatureStore(FLAGS.feature_store), build_backend())
+    benchmark(ranker, FLAGS.root_path, FLAGS.num_requests, FLAGS.max_candidates)
+
+
+if __name__ == "__main__":
+    import tensorflow.compat.v1 as tf
+
+    from serving import FLAGS, FeatureStore, build_backend
+
+    tf.app.run(main)
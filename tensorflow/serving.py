@@ -0,0 +1,650 @@
+# coding: utf-8
+"""
+在线打分服务：模型只加载一次，接收 (userid, [feedid...]) 请求，返回各行为的概率
+- 特征：从feature_store的当前快照向量化查表（与comm.concat_sample生成的特征一致），
+  每refresh_seconds秒检查一次新快照并原子切换
+- 动态micro-batching：并发请求合并为一个batch（最多max_batch_size行，最多等待max_wait_ms），
+  查特征和模型前向在worker线程池中执行
+- 模型：TF（baseline.py export导出的SavedModel）或PyTorch（pytorch/export.py导出的TorchScript）
+- 预测缓存：(userid, feedid) 的预测按 (模型版本, 特征快照版本) 缓存（LRU + TTL），模型或快照更新后自动失效
+- 接口：本机HTTP（或Unix socket）POST /score，POST /rank（按加权得分取前k个候选，见ranking.py），
+  GET /metrics 返回各阶段延迟直方图，GET /health
+- 词表外的id：PyTorch模型的词表中没有的userid/feedid不映射为已有id，这些行不经过模型，按训练集各行为的正样本率打分，
+  /score返回每行的oov标记，/metrics中oov_rows为累计行数
+
+  python baseline.py export                 # 导出在线模型
+  python serving.py serve --port=8080       # 启动服务
+  python serving.py benchmark --concurrency=16 --num_requests=2000   # 进程内起服务并压测，输出延迟直方图
+  curl -d '{"userid": 8, "feedids": [71474, 73916]}' http://127.0.0.1:8080/score
+"""
+import glob
+import http.client
+import json
+import os
+import queue
+import random
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import tensorflow.compat.v1 as tf
+
+from baseline import FLAGS, SERVING_ID_FEATURES, SERVING_NUMERIC_FEATURES
+from comm import ACTION_LIST, ACTION_WEIGHT
+from feature_store import FEATURE_STORE_PATH, FeatureStore
+from prediction_cache import PredictionCache, file_signature, version_hash
+from ranking import rank_scores
+
+flags = tf.app.flags
+flags.DEFINE_string('serving_backend', 'tf', 'tf: SavedModel of baseline.py export / torch: TorchScript of pytorch')
+flags.DEFINE_string('torch_models', '', 'torch: comma separated action=path, or one multitask model path')
+flags.DEFINE_string('torch_encoded_path', '../data/encoded', 'torch: encoded vocabularies of pytorch/prepare_data.py')
+flags.DEFINE_string('feature_store', FEATURE_STORE_PATH, 'feature store directory (feature_store.py build)')
+flags.DEFINE_integer('refresh_seconds', 60, 'check for a new feature store snapshot every n seconds')
+flags.DEFINE_string('host', '127.0.0.1', 'http host')
+flags.DEFINE_integer('port', 8080, 'http port, 0 = any free port')
+flags.DEFINE_string('unix_socket', '', 'serve on this unix socket path instead of host:port')
+flags.DEFINE_integer('max_batch_size', 2048, 'max rows of one micro-batch')
+flags.DEFINE_float('max_wait_ms', 2.0, 'max wait of the first request of a micro-batch')
+flags.DEFINE_integer('num_workers', 2, 'worker threads (feature lookup + forward)')
+flags.DEFINE_integer('prediction_cache_size', 1 << 20, 'cached (userid, feedid) predictions, 0 = off')
+flags.DEFINE_float('prediction_cache_ttl', 600.0, 'seconds a cached prediction is reused')
+flags.DEFINE_integer('concurrency', 16, 'benchmark: concurrent clients')
+flags.DEFINE_integer('num_requests', 2000, 'benchmark: total requests')
+flags.DEFINE_integer('max_candidates', 100, 'benchmark: max feedids per request')
+
+
+class LatencyHistogram(object):
+    '''
+    线程安全的延迟直方图，桶边界按对数均匀分布（0.01ms ~ 100s，每10倍20个桶）
+    '''
+
+    BOUNDS_MS = np.logspace(-2, 5, 141)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = np.zeros(len(self.BOUNDS_MS) + 1, dtype=np.int64)
+        self._sum = 0.0
+        self._max = 0.0
+
+    def record(self, ms):
+        i = int(np.searchsorted(self.BOUNDS_MS, ms))
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += ms
+            self._max = max(self._max, ms)
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        '''
+        :return: Dict. count, mean, max and p{q} (upper bound of the bucket holding the q-th percentile)
+        '''
+        with self._lock:
+            counts, total, largest = self._counts.copy(), self._sum, self._max
+        count = int(counts.sum())
+        result = {"count": count, "mean": total / count if count else 0.0, "max": largest}
+        cumulative = np.cumsum(counts)
+        bounds = np.append(self.BOUNDS_MS, np.inf)
+        for q in percentiles:
+            i = int(np.searchsorted(cumulative, max(1, int(np.ceil(count * q / 100.0)))))
+            result["p%d" % q] = min(float(bounds[i]), largest) if count else 0.0
+        return result
+
+
+class TFSavedModelBackend(object):
+    '''
+    每个行为一个SavedModel（baseline.py export），各自一个Session，同一个Session可被多个线程并发run
+    '''
+
+    def __init__(self, export_root, actions=ACTION_LIST):
+        '''
+        :param export_root: String. {model_checkpoint_dir}/export，每个行为取最新的导出目录
+        '''
+        self.actions = list(actions)
+        self.models = []
+        versions = []
+        for action in self.actions:
+            paths = sorted(glob.glob(os.path.join(export_root, action, "[0-9]*")))
+            if not paths:
+                raise IOError("no SavedModel under %s, run baseline.py export first"
+                              % os.path.join(export_root, action))
+            graph = tf.Graph()
+            session = tf.Session(graph=graph)
+            meta_graph = tf.saved_model.loader.load(session, [tf.saved_model.tag_constants.SERVING], paths[-1])
+            signature = meta_graph.signature_def["predict"]
+            inputs = {name: graph.get_tensor_by_name(info.name) for name, info in signature.inputs.items()
+                      if name in SERVING_ID_FEATURES + SERVING_NUMERIC_FEATURES}
+            output = graph.get_tensor_by_name(signature.outputs["logistic"].name)
+            self.models.append((session, inputs, output))
+            versions.append(paths[-1])
+        self.version = version_hash(versions)
+
+    def predict(self, features, return_oov=False):
+        '''
+        :param return_oov: Boolean. 同时返回词表外的行（TF模型的特征列自行处理未知id，全为False）
+        :return: float array [N, number of actions], (and bool array [N])
+        '''
+        scores = np.stack([session.run(output, {tensor: features[name] for name, tensor in inputs.items()})
+                           .reshape(-1) for session, inputs, output in self.models], axis=1)
+        return (scores, np.zeros(len(scores), dtype=bool)) if return_oov else scores
+
+
+class TorchScriptBackend(object):
+    '''
+    pytorch/export.py导出的TorchScript模型：每个行为一个模型，或一个多任务模型（meta中的task_names）
+    原始特征按pytorch/prepare_data.py的词表和归一化参数编码
+    '''
+
+    def __init__(self, paths, encoded_path, actions=ACTION_LIST, oov_scores=None):
+        '''
+        :param paths: Dict. action -> model path, or {None: multitask model path}
+        :param encoded_path: String. pytorch编码缓存目录（vocab_*.npy, scaler_*.npy）
+        :param oov_scores: List of floats or None. 词表外userid/feedid的行的各行为得分，
+            None为训练集各行为的正样本率（encoded_path/train_data/{action}.npy）
+        '''
+        import torch
+
+        self.torch = torch
+        self.actions = list(actions)
+        self.models = []
+        for action, path in paths.items():
+            extra_files = {"meta.json": ""}
+            module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+            module = module.eval()
+            # torch.jit.freeze / optimize_for_inference 需要torch>=1.10，低版本直接使用TorchScript模型
+            if hasattr(torch.jit, "optimize_for_inference"):
+                module = torch.jit.optimize_for_inference(torch.jit.freeze(module))
+            meta = json.loads(extra_files["meta.json"])
+            tasks = meta.get("task_names") or [action]
+            self.models.append((module, [tasks.index(a) if a in tasks else None for a in self.actions], meta))
+        self.meta = self.models[0][2]
+        self.version = version_hash(file_signature(*paths.values()), encoded_path)
+        self.vocabs = {name: np.load(os.path.join(encoded_path, "vocab_%s.npy" % name))
+                       for name in self.meta["sparse_feature_names"]}
+        self.scalers = {name: np.load(os.path.join(encoded_path, "scaler_%s.npy" % name))
+                        for name in self.meta["dense_feature_names"]}
+        if oov_scores is None:
+            oov_scores = [np.load(os.path.join(encoded_path, "train_data", "%s.npy" % action), mmap_mode="r").mean()
+                          for action in self.actions]
+        self.oov_scores = np.asarray(oov_scores, dtype=np.float32)
+
+    def encode(self, features):
+        '''
+        concat_sample格式 -> (sparse_ids int64 [N, n_sparse], dense_values float32 [N, n_dense], oov bool [N])
+        oov为userid或feedid不在词表中的行（其id编码为0只是占位，不应使用这些行的模型输出）
+        '''
+        sparse = []
+        oov = np.zeros(len(features["userid"]), dtype=bool)
+        for name in self.meta["sparse_feature_names"]:
+            values = features[name]
+            if name in ("authorid", "bgm_song_id", "bgm_singer_id"):
+                # concat_sample中已知id加1、未知为0，pytorch中未知也为0
+                values = np.maximum(values - 1, 0)
+            vocab = self.vocabs[name]
+            index = np.minimum(np.searchsorted(vocab, values), len(vocab) - 1)
+            found = vocab[index] == values
+            if name in ("userid", "feedid"):
+                oov |= ~found
+            sparse.append(np.where(found, index, 0))
+        dense = []
+        for name in self.meta["dense_feature_names"]:
+            low, high = self.scalers[name]
+            dense.append((features[name] - low) / (high - low if high > low else 1.0))
+        return (self.torch.from_numpy(np.stack(sparse, axis=1).astype(np.int64)),
+                self.torch.from_numpy(np.stack(dense, axis=1).astype(np.float32)), oov)
+
+    def predict(self, features, return_oov=False):
+        '''
+        :param return_oov: Boolean. 同时返回词表外的行
+        :return: float array [N, number of actions]（词表外的行为oov_scores）, (and bool array [N])
+        '''
+        sparse_ids, dense_values, oov = self.encode(features)
+        result = np.zeros((len(oov), len(self.actions)), dtype=np.float32)
+        result[oov] = self.oov_scores
+        known = np.flatnonzero(~oov)
+        if len(known) > 0:
+            known_index = self.torch.from_numpy(known)
+            sparse_ids, dense_values = sparse_ids[known_index], dense_values[known_index]
+            with self.torch.no_grad():
+                for module, columns, _ in self.models:
+                    output = module(sparse_ids, dense_values).numpy().reshape(len(known), -1)
+                    for i, column in enumerate(columns):
+                        if column is not None:
+                            result[known, i] = output[:, column]
+        return (result, oov) if return_oov else result
+
+
+# 关闭服务时放入队列
+_STOP = object()
+
+
+class _Request(object):
+    __slots__ = ["user_id", "feed_ids", "device", "future", "enqueue_time"]
+
+    def __init__(self, user_id, feed_ids, device):
+        self.user_id = user_id
+        self.feed_ids = feed_ids
+        self.device = device
+        self.future = Future()
+        self.enqueue_time = time.perf_counter()
+
+
+class ScoringService(object):
+    '''
+    动态micro-batching：收集线程取出第一个请求后，继续合并请求直到达到max_batch_size行或等待max_wait_ms，
+    再等待一个空闲worker；等待期间到达的请求也并入该batch（负载越高batch越大）
+    '''
+
+    def __init__(self, lookup, backend, max_batch_size=2048, max_wait_ms=2.0, num_workers=2, cache=None):
+        '''
+        :param lookup: feature_store.FeatureStore
+        :param backend: TFSavedModelBackend or TorchScriptBackend
+        :param cache: prediction_cache.PredictionCache or None. 指定device的请求不使用缓存
+        '''
+        self.lookup = lookup
+        self.backend = backend
+        self.cache = cache
+        self.actions = backend.actions
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.histograms = {name: LatencyHistogram() for name in ["request", "queue", "feature", "model"]}
+        self.batch_rows = LatencyHistogram()
+        # 词表外userid/feedid的累计行数
+        self.oov_rows = 0
+        self._oov_lock = threading.Lock()
+        # 预热（首次run/前向会构建执行计划），不计入直方图
+        backend.predict(lookup.get([0], [0]))
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(num_workers)
+        self._pool = ThreadPoolExecutor(max_workers=num_workers)
+        self._closed = False
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, user_id, feed_ids, device=None):
+        '''
+        :return: Future of (float array [len(feed_ids), number of actions], bool array [len(feed_ids)] 词表外的行)
+        '''
+        if self._closed:
+            raise RuntimeError("service is closed")
+        request = _Request(int(user_id), np.asarray(feed_ids, dtype=np.int64).reshape(-1), device)
+        self._queue.put(request)
+        return request.future
+
+    def score(self, user_id, feed_ids, device=None, timeout=None, return_oov=False):
+        '''
+        :return: float array [len(feed_ids), number of actions], (and bool array [len(feed_ids)] 词表外的行)
+        '''
+        scores, oov = self.submit(user_id, feed_ids, device).result(timeout)
+        return (scores, oov) if return_oov else scores
+
+    def rank(self, user_id, feed_ids, k=10, weights=None, device=None, timeout=None):
+        '''
+        打分后按加权得分取前k个候选
+        :param weights: Dict. action -> weight, None为ACTION_WEIGHT
+        :return: ranking.Ranking
+        '''
+        feed_ids = np.asarray(feed_ids, dtype=np.int64).reshape(-1)
+        return rank_scores(feed_ids, self.score(user_id, feed_ids, device, timeout), self.actions, k,
+                           weights or ACTION_WEIGHT)
+
+    def _collect(self):
+        pending = None
+        while True:
+            first = pending if pending is not None else self._queue.get()
+            pending = None
+            if first is _STOP:
+                break
+            batch, rows = [first], len(first.feed_ids)
+            deadline = first.enqueue_time + self.max_wait
+            while rows < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is _STOP or rows + len(request.feed_ids) > self.max_batch_size:
+                    pending = request
+                    break
+                batch.append(request)
+                rows += len(request.feed_ids)
+            self._slots.acquire()
+            # 等待worker期间到达的请求
+            while pending is None and rows < self.max_batch_size:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is _STOP or rows + len(request.feed_ids) > self.max_batch_size:
+                    pending = request
+                    break
+                batch.append(request)
+                rows += len(request.feed_ids)
+            self._pool.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        try:
+            start = time.perf_counter()
+            for request in batch:
+                self.histograms["queue"].record((start - request.enqueue_time) * 1000.0)
+            sizes = [len(request.feed_ids) for request in batch]
+            user_ids = np.repeat([request.user_id for request in batch], sizes)
+            feed_ids = np.concatenate([request.feed_ids for request in batch])
+            # 请求指定的device，nan为使用特征库中的值
+            devices = np.repeat([np.nan if request.device is None else request.device for request in batch], sizes)
+            scores = np.zeros((len(feed_ids), len(self.actions)), dtype=np.float32)
+            oov = np.zeros(len(feed_ids), dtype=bool)
+            todo = np.ones(len(feed_ids), dtype=bool)
+            if self.cache is not None:
+                version = version_hash(self.backend.version, self.lookup.version)
+                cacheable = np.flatnonzero(np.isnan(devices))
+                hit, cached = self.cache.get(version, user_ids[cacheable], feed_ids[cacheable])
+                if hit.any():
+                    scores[cacheable[hit]] = cached[hit]
+                    todo[cacheable[hit]] = False
+            if todo.any():
+                features = self.lookup.get(user_ids[todo], feed_ids[todo])
+                features["device"] = np.where(np.isnan(devices[todo]), features["device"],
+                                              devices[todo]).astype(np.float32)
+            feature_end = time.perf_counter()
+            if todo.any():
+                scores[todo], oov[todo] = self.backend.predict(features, return_oov=True)
+                if oov.any():
+                    with self._oov_lock:
+                        self.oov_rows += int(oov.sum())
+                if self.cache is not None:
+                    # 词表外的行不缓存（命中时无法标记）
+                    put = todo & np.isnan(devices) & ~oov
+                    self.cache.put(version, user_ids[put], feed_ids[put], scores[put])
+            end = time.perf_counter()
+            self.histograms["feature"].record((feature_end - start) * 1000.0)
+            self.histograms["model"].record((end - feature_end) * 1000.0)
+            self.batch_rows.record(float(len(feed_ids)))
+            offset = 0
+            for request, size in zip(batch, sizes):
+                request.future.set_result((scores[offset:offset + size], oov[offset:offset + size]))
+                self.histograms["request"].record((end - request.enqueue_time) * 1000.0)
+                offset += size
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self._slots.release()
+
+    def metrics(self):
+        '''
+        :return: Dict. 各阶段延迟直方图（毫秒）及batch行数分布，oov_rows为词表外userid/feedid的累计行数，
+            使用缓存时prediction_cache为缓存统计
+        '''
+        result = {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+        result["batch_rows"] = self.batch_rows.snapshot()
+        result["oov_rows"] = self.oov_rows
+        if self.cache is not None:
+            result["prediction_cache"] = self.cache.stats()
+        return result
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_STOP)
+            self._collector.join()
+            self._pool.shutdown(wait=True)
+
+
+def make_handler(service):
+    '''
+    HTTP接口：POST /score {"userid": int, "feedids": [int], "device": 可选}
+    -> {"actions": [...], "scores": [[各行为概率] 每个feedid一行], "oov": [每个feedid是否为词表外的行]}；
+    POST /rank {"userid": int, "feedids": [int], "k": int, "weights": {action: weight} 可选, "device": 可选}
+    -> {"feedids": [前k个feedid], "scores": [加权得分]}；GET /metrics；GET /health
+    '''
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._reply(200, service.metrics())
+            elif self.path == "/health":
+                self._reply(200, {"status": "ok"})
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path not in ("/score", "/rank"):
+                self._reply(404, {"error": "not found"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if self.path == "/rank":
+                    ranking = service.rank(body["userid"], body["feedids"], int(body.get("k", 10)),
+                                           body.get("weights"), body.get("device"))
+                    result = {"feedids": ranking.feed_ids.tolist(), "scores": ranking.scores.tolist()}
+                else:
+                    scores, oov = service.score(body["userid"], body["feedids"], body.get("device"), return_oov=True)
+                    result = {"actions": service.actions, "scores": scores.tolist(), "oov": oov.tolist()}
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {"error": repr(e)})
+                return
+            except Exception as e:
+                self._reply(500, {"error": repr(e)})
+                return
+            self._reply(200, result)
+
+        def address_string(self):
+            return str(self.client_address)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_server(service, host="127.0.0.1", port=8080, unix_socket=None):
+    '''
+    在后台线程中启动HTTP服务
+    :return: server（server.server_address 为实际监听地址，server.shutdown() 停止）
+    '''
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, make_handler(service))
+    else:
+        server = ThreadingHTTPServer((host, port), make_handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class LocalClient(object):
+    '''
+    进程内客户端，直接调用服务（不经过HTTP），用于测试
+    '''
+
+    def __init__(self, service):
+        self.service = service
+
+    def score(self, user_id, feed_ids, device=None):
+        return dict(zip(self.service.actions, self.service.score(user_id, feed_ids, device).T.tolist()))
+
+    def rank(self, user_id, feed_ids, k=10, weights=None, device=None):
+        ranking = self.service.rank(user_id, feed_ids, k, weights, device)
+        return ranking.feed_ids.tolist(), ranking.scores.tolist()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=60):
+        super(_UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class HTTPClient(object):
+    '''
+    HTTP客户端（保持连接），每个线程各用一个
+    '''
+
+    def __init__(self, host="127.0.0.1", port=8080, unix_socket=None, timeout=60):
+        if unix_socket:
+            self.connection = _UnixHTTPConnection(unix_socket, timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, path, body=None):
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        self.connection.request(method, path, data, headers)
+        response = self.connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError("%d: %s" % (response.status, result.get("error")))
+        return result
+
+    def score(self, user_id, feed_ids, device=None):
+        '''
+        :return: Dict. action -> list of probabilities (one per feedid)
+        '''
+        body = {"userid": int(user_id), "feedids": [int(f) for f in feed_ids]}
+        if device is not None:
+            body["device"] = device
+        result = self._request("POST", "/score", body)
+        return dict(zip(result["actions"], np.asarray(result["scores"]).T.tolist()))
+
+    def rank(self, user_id, feed_ids, k=10, weights=None, device=None):
+        '''
+        :return: (list of the top k feedids, list of their weighted scores)
+        '''
+        body = {"userid": int(user_id), "feedids": [int(f) for f in feed_ids], "k": int(k)}
+        if weights is not None:
+            body["weights"] = weights
+        if device is not None:
+            body["device"] = device
+        result = self._request("POST", "/rank", body)
+        return result["feedids"], result["scores"]
+
+    def metrics(self):
+        return self._request("GET", "/metrics")
+
+    def close(self):
+        self.connection.close()
+
+
+def build_backend():
+    '''
+    按FLAGS加载模型
+    '''
+    if FLAGS.serving_backend == "torch":
+        paths = {}
+        for item in FLAGS.torch_models.split(","):
+            action, _, path = item.rpartition("=")
+            paths[action or None] = path
+        return TorchScriptBackend(paths, FLAGS.torch_encoded_path)
+    return TFSavedModelBackend(os.path.join(FLAGS.model_checkpoint_dir, "export"))
+
+
+def build_service():
+    '''
+    按FLAGS加载特征和模型
+    '''
+    cache = PredictionCache(FLAGS.prediction_cache_size, FLAGS.prediction_cache_ttl) \
+        if FLAGS.prediction_cache_size > 0 else None
+    return ScoringService(FeatureStore(FLAGS.feature_store), build_backend(), FLAGS.max_batch_size,
+                          FLAGS.max_wait_ms, FLAGS.num_workers, cache)
+
+
+def benchmark(service, server):
+    '''
+    用测试集中的 (userid, feedid列表) 作为请求，concurrency个客户端线程经HTTP并发请求
+    '''
+    test = pd.read_csv(os.path.join(FLAGS.root_path, "wechat_algo_data1", "test_a.csv"))
+    groups = [(user, feeds.values) for user, feeds in test.groupby("userid")["feedid"]]
+    rng = random.Random(2021)
+    requests = []
+    for _ in range(FLAGS.num_requests):
+        user, feeds = groups[rng.randrange(len(groups))]
+        requests.append((user, feeds[:FLAGS.max_candidates]))
+    address = server.server_address
+    errors = []
+
+    def run(part):
+        client = HTTPClient(unix_socket=address) if FLAGS.unix_socket else HTTPClient(*address[:2])
+        try:
+            for user, feeds in part:
+                client.score(user, feeds)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=run, args=(requests[i::FLAGS.concurrency],))
+               for i in range(FLAGS.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    rows = sum(len(feeds) for _, feeds in requests)
+    print("%d requests (%d rows) in %.2fs: %.1f requests/s, %.0f rows/s" % (
+        len(requests), rows, elapsed, len(requests) / elapsed, rows / elapsed))
+    print("%-12s%10s%10s%10s%10s%10s%10s" % ("histogram", "count", "mean", "p50", "p90", "p99", "max"))
+    metrics = service.metrics()
+    cache_stats = metrics.pop("prediction_cache", None)
+    oov_rows = metrics.pop("oov_rows")
+    for name, h in metrics.items():
+        print("%-12s%10d%10.2f%10.2f%10.2f%10.2f%10.2f" % (
+            name, h["count"], h["mean"], h["p50"], h["p90"], h["p99"], h["max"]))
+    print("(milliseconds; batch_rows in rows)")
+    print("out-of-vocabulary userid/feedid rows: %d" % oov_rows)
+    if cache_stats is not None:
+        print("prediction cache: hit rate %.3f (%d of %d rows), %d evictions, %d expired" % (
+            cache_stats["hit_rate"], cache_stats["memory_hits"], cache_stats["lookups"], cache_stats["evictions"],
+            cache_stats["expired"]))
+
+
+def main(argv):
+    stage = argv[1] if len(argv) > 1 else "serve"
+    service = build_service()
+    server = start_server(service, FLAGS.host, FLAGS.port, FLAGS.unix_socket or None)
+    print("Serving %s on %s" % (FLAGS.serving_backend, server.server_address))
+    try:
+        if stage == "benchmark":
+            benchmark(service, server)
+        else:
+            while True:
+                time.sleep(FLAGS.refresh_seconds)
+                if service.lookup.refresh():
+                    print("Feature store snapshot: %s" % service.lookup.version)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    tf.app.run(main)